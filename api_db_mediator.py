@@ -11,40 +11,158 @@ Author: Nikolas Kovacs
 """
 
 import pyodbc
-from bls_data import get_unemployment_data, get_county_workers, get_employment_data
-from census_data import get_census_timeseries, get_census_data
-from bea_data import get_gdp_data, get_bea_tables_and_linecodes_combined
+from bls_data import get_unemployment_data, get_county_workers, get_employment_units, get_employment_singlefile
+from bls_data import fetch_employment_file, parse_employment_file, get_latest_qcew_quarter
+from qcew_cache import get_missing_files
+from bls_data import get_year_windows, BLS_TIMESERIES_URL
+from bls_data import get_laus_county_data, LAUS_UNEMPLOYMENT_RATE, LAUS_LABOR_FORCE
+from rate_limiter import check_quota, get_host
+from census_data import iter_census_timeseries, iter_census_data
+from bea_data import fetch_gdp_linecode, parse_gdp_response, get_bea_tables_and_linecodes_combined
+from pipeline import run_pipeline
+from sharded_writer import ShardedWriter
+from fan_out import Targets, FanOut
+from work_queue import WorkQueue, WorkQueueError, LEASE_SECONDS, POLL_INTERVAL
+from rollups import get_rollups, get_population_variable, POPULATION_VARIABLES
 import json
-import numpy as np
+import os
+import shutil
 from datetime import datetime as dt
 from datetime import date
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed, BrokenExecutor
+from functools import partial
+import re
+import threading
+
+# number of census rows inserted at a time while a response is being decoded
+CENSUS_INSERT_BATCH_SIZE = 5000
+
+# number of rows of a wide gdp load (one upsert per row) between two checks of the cancel_event
+GDP_CANCEL_CHECK_ROWS = 500
+
+# secondary indexes built once a table is loaded, for the common query shapes: table -> [(index name, columns)]
+SECONDARY_INDEXES = {
+    "us_employment": [("ix_us_employment_industry", "industry_code, year, qtr")],
+    "state_employment": [("ix_state_employment_industry", "industry_code, year, qtr")],
+    "county_employment": [
+        ("ix_county_employment_industry", "industry_code, year, qtr"),
+        ("ix_county_employment_period", "year, qtr, state"),
+    ],
+    "state_unemployment_rate": [("ix_state_unemployment_rate_period", "year, period")],
+    "county_unemployment_rate": [("ix_county_unemployment_rate_period", "year, period, state")],
+    "county_workers": [("ix_county_workers_period", "year, period, state")],
+    "census_zipcodes": [("ix_census_zipcodes_zipcode", "zipcode_tab_area, year")],
+    "census_school_districts": [("ix_census_school_districts_year", "year, state")],
+}
+
+# directory of the change feed files (<table>.jsonl) written with change_feed = "jsonl"
+CHANGE_FEED_DIR = "changes"
+
+# fact tables that can be partitioned by year (see API_DB_Mediator.partition_by_year): table -> type of the year column
+PARTITIONED_TABLES = {
+    "us_employment": "smallint",
+    "state_employment": "smallint",
+    "county_employment": "smallint",
+    "state_unemployment_rate": "int",
+    "county_unemployment_rate": "int",
+    "county_workers": "int",
+    "census_state_data": "int",
+    "census_county_data": "int",
+    "state_gdp": "smallint",
+    "county_gdp": "smallint",
+    "state_gdp_values": "smallint",
+    "county_gdp_values": "smallint",
+}
+
+def get_connection_string(config_file="config.json"):
+    """
+    @param config_file: the json file with the server, database, username and password
+
+    @return: the pyodbc connection string of the database
+    """
+    with open(config_file, 'r') as f:
+        config = json.load(f)
+        server = config["server"]
+        database = config["database"]
+        username = config["username"]
+        password = config["password"]
+    return 'Driver={SQL Server};' + f'Server={server};Database={database};UID={username};PWD={password}'
+
+
+class LoadCancelled(Exception):
+    """
+    Raised between batches of a table load when the cancel_event of the API_DB_Mediator is set
+    """
+    pass
+
 
 class API_DB_Mediator:
-    def __init__(self):
+    def __init__(self, resume=False, targets=None):
+        """
+        @param resume: if True, tables that support checkpointing are not dropped and only the work units
+                       that have not been completed by a previous (failed) run are loaded
+        @param targets: list of the config files of the databases to load (None -> ["config.json"]).
+                        With several, every statement is run on all of them concurrently (see fan_out.py)
+        """
+        self.resume = resume
+
         # initalize connection to database
-        with open("config.json", 'r') as f:
-            config = json.load(f)
-            server = config["server"]
-            database = config["database"]
-            username = config["username"]
-            password = config["password"]
-        self.__connection = pyodbc.connect('Driver={SQL Server};' + f'Server={server};Database={database};UID={username};PWD={password}')
+        self.__connection_strings = {target: get_connection_string(target) for target in (targets or ["config.json"])}
+        self.__targets = Targets(self.__connection_strings)
+        self.__targets.connections = {target: pyodbc.connect(x) for target, x in self.__connection_strings.items()}
+        self.__cursors = {target: x.cursor() for target, x in self.__targets.connections.items()}
+        if len(self.__targets.names) == 1:
+            self.__connection = self.__targets.connections[self.__targets.names[0]]
+            self.__cursor = self.__cursors[self.__targets.names[0]]
+        else:
+            self.__connection = FanOut(self.__targets, self.__targets.connections)
+            self.__cursor = FanOut(self.__targets, self.__cursors)
         self.__connection.autocommit = True
-        self.__cursor = self.__connection.cursor()
         self.__cursor.fast_executemany = True
 
-        self.__insert_into_state_unemployment_skeleton = """
-                        INSERT INTO dbo.state_unemployment_rate (state, year, period, value)
-                        VALUES ('{st}', {yr}, '{prd}', {val});
-                    """
-        self.__insert_into_county_unemployment_skeleton = """
-                        INSERT INTO dbo.county_unemployment_rate (state, county, year, period, value)
-                        VALUES ('{st}', '{cnty}', {yr}, '{prd}', {val});
-                    """
-        self.__insert_into_county_workers_skeleton = """
-                        INSERT INTO dbo.county_workers (state, county, year, period, value)
-                        VALUES ('{st}', '{cnty}', {yr}, '{prd}', {val});
-                    """
+        # first year requested by the BLS timeseries tables (None -> the last 3 years)
+        self.backfill_start_year = None
+        # number of concurrent requests made by a table load (BLS timeseries, QCEW area files, census years, BEA linecodes)
+        self.fetch_workers = 4
+        # number of processes parsing the QCEW and BEA responses (None -> one per cpu, 0 -> parse in the download threads)
+        self.parse_workers = None
+        # "area" -> one QCEW csv per area per quarter, "singlefile" -> one QCEW archive per year with every area
+        self.employment_source = "area"
+        # "api" -> the county unemployment and workers tables are requested from the BLS timeseries API, 50 series at a time,
+        # "flatfile" -> read from the LAUS county flat file, downloaded once (and only again when it changed)
+        self.laus_source = "api"
+        # "wide" -> one BIGINT column per table_linecode, "long" -> columnstore of (geo, year, table_linecode, value)
+        self.gdp_format = "wide"
+        # "upfront" -> clustered primary key at creation, "deferred" -> load a heap and build the keys afterwards,
+        # "sorted" -> primary key at creation, each batch is sorted by it before insertion
+        self.index_strategy = "upfront"
+        self.__primary_keys = {}
+        # number of connections a single table load writes through, sharded by state (1 -> only this connection)
+        self.writer_connections = 1
+        self.__sharded_writer = None
+        self.__sharded_writers = {} # <- target name -> its ShardedWriter
+        self.__active_writer = None # <- the sharded writer of the unit being loaded, if any
+        self.__completed_units = {}
+        # if True, the PARTITIONED_TABLES are partitioned by year and are never dropped: a load goes to
+        # dbo.<table>_staging, its years are switched into the table and the years before the window are switched out
+        self.partition_by_year = False
+        # with partition_by_year, only the last refresh_years years of the window (and the years missing from the
+        # table) are requested, the other years are kept as they are (None -> every year of the window)
+        self.refresh_years = None
+
+        # threading.Event that cancels the running load between batches when set
+        self.cancel_event = None
+        # optional function called with (table, unit) every time a unit has been committed
+        self.progress_callback = None
+        # number of rows inserted through __bulk_insert since the mediator was created
+        self.rows_inserted = 0
+        # None, "coordinator" -> the QCEW area and BLS timeseries loads create the table and enqueue their units in
+        # dbo.work_queue, loading them together with any number of "worker"s, which only claim and load units (see work_queue.py)
+        self.queue_mode = None
+        # None, "table" -> the rows inserted, updated and deleted by each load are written to dbo.change_log,
+        # "jsonl" -> to CHANGE_FEED_DIR/<table>.jsonl
+        self.change_feed = None
 
 
     def initialize_db(self):
@@ -63,12 +181,8 @@ class API_DB_Mediator:
             print(f"Initializing county workers table...({dt.now()})", file=f)
             self.__init_county_workers_table()
 
-            print(f"Initializing US employment table...({dt.now()})", file=f)
-            self.__init_employment_table("us")
-            print(f"Initializing state employment table...({dt.now()})", file=f)
-            self.__init_employment_table("state")
-            print(f"Initializing county employment table...({dt.now()})", file=f)
-            self.__init_employment_table("state")
+            print(f"Initializing US, state and county employment tables...({dt.now()})", file=f)
+            self.__init_employment_tables()
 
             print(f"Initializing census state data table...({dt.now()})", file=f)
             self.__init_census_state_data_table()
@@ -85,10 +199,8 @@ class API_DB_Mediator:
             print(f"Initializing zipcodes table...({dt.now()})", file=f)
             self.__init_zipcodes_table()
 
-            print(f"Initializing state GDP table...({dt.now()})", file=f)
-            self.__init_gdp_table("state")
-            print(f"Initializing county GDP table...({dt.now()})", file=f)
-            self.__init_gdp_table("county")
+            print(f"Initializing state and county GDP tables...({dt.now()})", file=f)
+            self.__init_gdp_tables()
 
             print(f"Initialization complete.({dt.now()})", file=f)
 
@@ -100,18 +212,16 @@ class API_DB_Mediator:
         """
         if not isinstance(for_, str) or for_.upper() not in ["STATE", "COUNTY"]:
             raise TypeError("for_ must be str \"STATE\" or \"COUNTY\"")
-        
-        # Because this method is used both for state and county gdp data, the sql statements must work with both,
-        # hence these if_county* variables
-        if_county_create = "county VARCHAR(3) NOT NULL,"
-        if_county_compare = "county = '{}' AND "
-        if_county_column = "county, "
-        if_county = "'{}',"
-        if for_.upper() == "STATE":
-            if_county_create, if_county_compare, if_county_column, if_county = "", "", "", ""
-            
-        for_ = for_.lower()
+        self.__init_gdp_tables([for_.lower()])
+
 
+    def __init_gdp_tables(self, for_list=["state", "county"]):
+        """
+        Initializes the state and/or county gdp tables. The linecodes of every table are requested concurrently
+        through a single pipeline, so the county requests do not wait for the state table to be loaded.
+
+        @param for_list: list of "state" and/or "county"
+        """
         tables_linecodes = get_bea_tables_and_linecodes_combined()
 
         # make gdp_table_description table
@@ -126,223 +236,305 @@ class API_DB_Mediator:
             );
         """)
 
+        prepare = self.__prepare_long_gdp_table if self.gdp_format == "long" else self.__prepare_gdp_table
+        writers = {for_: prepare(for_, tables_linecodes) for for_ in for_list} # <- for_ -> (write, finish)
+
+        def write_linecode(unit, items):
+            for_, table_linecode = unit
+            self.__check_cancelled()
+            writers[for_][0](items)
+            if self.progress_callback:
+                self.progress_callback(f"{for_}_gdp", table_linecode)
+
+        units = [(for_, x) for for_ in for_list for x in tables_linecodes]
+        self.__run_pipeline(units, lambda unit: fetch_gdp_linecode(*unit), write_linecode, parse=parse_gdp_response)
+        for write, finish in writers.values():
+            finish()
+
+
+    def __prepare_gdp_table(self, for_, tables_linecodes):
+        """
+        Creates the wide gdp table (one BIGINT column per table_linecode) for states or counties.
+
+        @param for_: "state" or "county"
+        @param tables_linecodes: list of the table_linecodes (e.g. CAGDP9_1)
+
+        @return: tuple of (function writing the data items of one linecode response into the table,
+                 function finishing the load)
+        """
+        # Because this method is used both for state and county gdp data, the sql statements must work with both,
+        # hence these if_county* variables
+        if_county_create = "county VARCHAR(3) NOT NULL,"
+        if_county_compare = "county = '{}' AND "
+        if_county_column = "county, "
+        if_county = "'{}',"
+        if for_ == "state":
+            if_county_create, if_county_compare, if_county_column, if_county = "", "", "", ""
+
         # make gdp table (county or state depending on for_)
         tables_linecodes_for_table_creation = " ".join([f"{x} BIGINT," for x in tables_linecodes])
-        self.__cursor.execute(f"""
-            IF OBJECT_ID('dbo.{for_}_gdp') IS NOT NULL
-                DROP TABLE dbo.{for_}_gdp;
-            CREATE TABLE dbo.{for_}_gdp (
+        gdp_columns = f"""
                 state CHAR(2) NOT NULL,
                 {if_county_create}
                 year smallint NOT NULL,
                 {tables_linecodes_for_table_creation}
                 PRIMARY KEY (state, {if_county_column}year),
-            );
-        """)
+            """
+        if self.__is_partitioned(f"{for_}_gdp"):
+            self.__cursor.execute(f"""
+                IF OBJECT_ID('dbo.{for_}_gdp', 'V') IS NOT NULL
+                    DROP VIEW dbo.{for_}_gdp;
+            """)
+            self.__create_table(f"{for_}_gdp", gdp_columns)
+            curr_year = self.__get_curr_year()
+            self.__add_year_boundaries(f"{for_}_gdp", curr_year-6, curr_year) # <- BEA returns the last 5 published years
+        else:
+            self.__cursor.execute(f"""
+                IF OBJECT_ID('dbo.{for_}_gdp', 'V') IS NOT NULL
+                    DROP VIEW dbo.{for_}_gdp;
+                IF OBJECT_ID('dbo.{for_}_gdp') IS NOT NULL
+                    DROP TABLE dbo.{for_}_gdp;
+                CREATE TABLE dbo.{for_}_gdp (
+                    {gdp_columns}
+                );
+            """)
+        gdp_table = self.__target(f"{for_}_gdp")
 
-        for values in get_gdp_data(for_):
-            table_linecode = '_'.join(values["Code"].split('-'))
-            cl_unit, unit_mult = values["CL_UNIT"], values["UNIT_MULT"]
-            state, county, year = values["GeoFips"][:2], values["GeoFips"][2:], values["TimePeriod"]
+        def write_linecode(items):
+            for i, values in enumerate(items):
+                if i % GDP_CANCEL_CHECK_ROWS == 0:
+                    self.__check_cancelled()
+                table_linecode = '_'.join(values["Code"].split('-'))
+                cl_unit, unit_mult = values["CL_UNIT"], values["UNIT_MULT"]
+                state, county, year = values["GeoFips"][:2], values["GeoFips"][2:], values["TimePeriod"]
 
-            value = ''.join(values["DataValue"].split(','))
-            value = "NULL" if not value.isdigit() else value
+                value = ''.join(values["DataValue"].split(','))
+                value = "NULL" if not value.isdigit() else value
 
-            # insert the data into the tables if and only if the sample does not already exist.
-            self.__cursor.execute(f"""
-                IF NOT EXISTS (SELECT TOP 1 * FROM dbo.gdp_table_description WHERE table_linecode = '{table_linecode}')
-                BEGIN
-                    INSERT INTO dbo.gdp_table_description (table_linecode, cl_unit, unit_mult)
-                    VALUES ('{table_linecode}', '{cl_unit}', {unit_mult});
-                END;
+                # insert the data into the tables if and only if the sample does not already exist.
+                self.__cursor.execute(f"""
+                    IF NOT EXISTS (SELECT TOP 1 * FROM dbo.gdp_table_description WHERE table_linecode = '{table_linecode}')
+                    BEGIN
+                        INSERT INTO dbo.gdp_table_description (table_linecode, cl_unit, unit_mult)
+                        VALUES ('{table_linecode}', '{cl_unit}', {unit_mult});
+                    END;
+                """)
+
+                self.__cursor.execute(f"""
+                    IF EXISTS (SELECT TOP 1 * from dbo.{gdp_table} WHERE {if_county_compare.format(county)}state = '{state}' AND year = {year})
+                    begin
+                        UPDATE dbo.{gdp_table} SET {table_linecode} = {value} WHERE {if_county_compare.format(county)}state = '{state}' AND year = {year};
+                    end
+                    ELSE
+                    begin
+                        INSERT INTO dbo.{gdp_table} (state, {if_county_column}year, {table_linecode})
+                        VALUES ('{state}', {if_county.format(county)}{year}, {value});
+                    end
+                """)
+        return write_linecode, partial(self.__finish_load, f"{for_}_gdp")
+
+
+    def __prepare_long_gdp_table(self, for_, tables_linecodes):
+        """
+        Creates the gdp data table in long format: one row per (geography, year, table_linecode) in dbo.<for_>_gdp_values,
+        stored as a clustered columnstore. Once the rows are collected, they are inserted and a pivot view named
+        dbo.<for_>_gdp exposes the same wide shape as the wide format table, so existing queries keep working.
+
+        @param for_: "state" or "county"
+        @param tables_linecodes: list of the table_linecodes (e.g. CAGDP9_1)
+
+        @return: tuple of (function collecting the data items of one linecode response, function finishing the load)
+        """
+        county_create = "county VARCHAR(3) NOT NULL," if for_ == "county" else ""
+        county_column = "county, " if for_ == "county" else ""
+
+        self.__cursor.execute(f"""
+            IF OBJECT_ID('dbo.{for_}_gdp', 'V') IS NOT NULL
+                DROP VIEW dbo.{for_}_gdp;
+            IF OBJECT_ID('dbo.{for_}_gdp', 'U') IS NOT NULL
+                DROP TABLE dbo.{for_}_gdp;
+        """)
+        # the gdp load has no checkpoints, so even when resuming it starts over instead of inserting every row again
+        # (the values table has no key to reject them, and the pivot's MAX() would hide them)
+        self.__cursor.execute(f"""
+            IF OBJECT_ID('dbo.{self.__target(f"{for_}_gdp_values")}', 'U') IS NOT NULL
+                DROP TABLE dbo.{self.__target(f"{for_}_gdp_values")};
+        """)
+        self.__create_table(f"{for_}_gdp_values", f"""
+                state CHAR(2) NOT NULL,
+                {county_create}
+                year smallint NOT NULL,
+                table_linecode VARCHAR(20) NOT NULL,
+                value BIGINT,
+                INDEX cci_{for_}_gdp_values CLUSTERED COLUMNSTORE
             """)
+        if self.__is_partitioned(f"{for_}_gdp_values"):
+            curr_year = self.__get_curr_year()
+            self.__add_year_boundaries(f"{for_}_gdp_values", curr_year-6, curr_year) # <- BEA returns the last 5 published years
+
+        descriptions = {}
+        rows = []
+        def collect_linecode(items):
+            for values in items:
+                table_linecode = '_'.join(values["Code"].split('-'))
+                descriptions[table_linecode] = (values["CL_UNIT"], values["UNIT_MULT"])
+                state, county, year = values["GeoFips"][:2], values["GeoFips"][2:], values["TimePeriod"]
+
+                value = ''.join(values["DataValue"].split(','))
+                value = int(value) if value.isdigit() else None
+                rows.append((state, county, int(year), table_linecode, value) if county_column else (state, int(year), table_linecode, value))
+
+        def finish():
+            # the state and county tables share the descriptions
+            self.__cursor.executemany("""
+                IF NOT EXISTS (SELECT 1 FROM dbo.gdp_table_description WHERE table_linecode = ?)
+                    INSERT INTO dbo.gdp_table_description (table_linecode, cl_unit, unit_mult)
+                    VALUES (?, ?, ?);
+            """, [(table_linecode, table_linecode, cl_unit, unit_mult) for table_linecode, (cl_unit, unit_mult) in descriptions.items()])
+            self.__bulk_insert(f"{for_}_gdp_values", f"state, {county_column}year, table_linecode, value", rows)
 
+            # CREATE VIEW has to be the only statement in its batch
+            pivot_columns = ", ".join([f"[{x}]" for x in tables_linecodes])
             self.__cursor.execute(f"""
-                IF EXISTS (SELECT TOP 1 * from dbo.{for_}_gdp WHERE {if_county_compare.format(county)}state = '{state}' AND year = {year})
-                begin
-                    UPDATE dbo.{for_}_gdp SET {table_linecode} = {value} WHERE {if_county_compare.format(county)}state = '{state}' AND year = {year};
-                end
-                ELSE
-                begin
-                    INSERT INTO dbo.{for_}_gdp (state, {if_county_column}year, {table_linecode})
-                    VALUES ('{state}', {if_county.format(county)}{year}, {value});
-                end
+                CREATE VIEW dbo.{for_}_gdp AS
+                SELECT state, {county_column}year, {pivot_columns}
+                FROM (SELECT state, {county_column}year, table_linecode, value FROM dbo.{for_}_gdp_values) AS src
+                PIVOT (MAX(value) FOR table_linecode IN ({pivot_columns})) AS p;
             """)
+            self.__finish_load(f"{for_}_gdp_values")
+            self.__record_load_version(f"{for_}_gdp")
+        return collect_linecode, finish
 
 
     def __init_zipcodes_table(self):
         tables = self.__get_census_tables("zipcode_tables")
         # make table named census_zipcodes
-        self.__cursor.execute(f"""
-            IF OBJECT_ID('dbo.census_zipcodes', 'U') IS NOT NULL
-                DROP TABLE dbo.census_zipcodes;
-            CREATE TABLE dbo.census_zipcodes (
+        self.__create_table("census_zipcodes", f"""
                 state varchar(2) NOT NULL,
                 zipcode_tab_area char(5) NOT NULL,
                 year int NOT NULL,
                 name varchar(12),
                 {tables},
                 PRIMARY KEY (state, zipcode_tab_area, year)
-            );
             """)
 
-        curr_year = self.__get_curr_year()
-        data = get_census_data("zipcodes", curr_year-3, curr_year)
         tables = self.__prepare_census_tables_for_query(tables)
-
-        self.__cursor.executemany(f"""
-            INSERT INTO dbo.census_zipcodes ({tables}, name, state, zipcode_tab_area, year)
-            VALUES (
-                {self.__generate_num_blanks(len(data[0][0]))}
-            );
-            """, self.__census_insert_generator(data))
+        self.__insert_census_years("census_zipcodes", f"{tables}, name, state, zipcode_tab_area, year",
+            lambda year: iter_census_data("zipcodes", year))
 
 
     def __init_census_school_districts_table(self):
         tables = self.__get_census_tables("school_districts_tables")
         # make table named "census_school_districts"
-        self.__cursor.execute(f"""
-            IF OBJECT_ID('dbo.census_school_districts', 'U') IS NOT NULL
-                DROP TABLE dbo.census_school_districts;
-            CREATE TABLE dbo.census_school_districts (
+        self.__create_table("census_school_districts", f"""
                 state varchar(2) NOT NULL,
                 sd_unified char(5) NOT NULL,
                 year int NOT NULL,
                 name varchar(82),
                 {tables},
                 PRIMARY KEY (state, sd_unified, year)
-            );
             """)
-        curr_year = self.__get_curr_year()
-        data = get_census_data("school_districts", curr_year-3, curr_year)
-        tables = self.__prepare_census_tables_for_query(tables)
 
-        self.__cursor.executemany(f"""
-            INSERT INTO dbo.census_school_districts ({tables}, name, state, sd_unified, year)
-            VALUES (
-                {self.__generate_num_blanks(len(data[0][0]))}
-            );
-            """, self.__census_insert_generator(data))
+        tables = self.__prepare_census_tables_for_query(tables)
+        self.__insert_census_years("census_school_districts", f"{tables}, name, state, sd_unified, year",
+            lambda year: iter_census_data("school_districts", year))
 
 
     def __init_census_state_poverty_table(self):
         tables = self.__get_census_tables("poverty_tables")
         # make table named "census_state_poverty"
-        self.__cursor.execute(f"""
-            IF OBJECT_ID('dbo.census_state_poverty', 'U') IS NOT NULL
-                DROP TABLE dbo.census_state_poverty;
-            CREATE TABLE dbo.census_state_poverty (
+        self.__create_table("census_state_poverty", f"""
                 state char(2) NOT NULL,
                 year int NOT NULL,
                 {tables},
                 PRIMARY KEY (state, year)
-            );
-        """)
-        curr_year = self.__get_curr_year()
-        data = get_census_timeseries("states", "poverty", curr_year-3, curr_year)
+            """)
 
         tables = self.__prepare_census_tables_for_query(tables)
-
-        exclude = []
-        exclude.append(data[0][0].index('NAME'))
-        exclude.append(data[0][0].index('time'))
-
-        self.__cursor.executemany(f"""
-            INSERT INTO dbo.census_state_poverty ({tables}, year, state)
-            VALUES (
-                {self.__generate_num_blanks(len(data[0][0]) - len(exclude))}
-            );
-        """, self.__census_insert_generator(data, exclude_indexes=exclude))
+        self.__insert_census_years("census_state_poverty", f"{tables}, year, state",
+            lambda year: iter_census_timeseries("states", "poverty", year), exclude=["NAME", "time"])
 
 
     def __init_census_county_poverty_table(self):
         tables = self.__get_census_tables("poverty_tables")
         # make table named "census_county_poverty"
-        self.__cursor.execute(f"""
-            IF OBJECT_ID('dbo.census_county_poverty', 'U') IS NOT NULL
-                DROP TABLE dbo.census_county_poverty;
-            CREATE TABLE dbo.census_county_poverty (
+        self.__create_table("census_county_poverty", f"""
                 state varchar(2) NOT NULL,
                 county varchar(3) NOT NULL,
                 year int NOT NULL,
                 {tables},
                 PRIMARY KEY (state, county, year)
-            );
-        """)
-        curr_year = self.__get_curr_year()
-        data = get_census_timeseries("counties", "poverty", curr_year-3, curr_year)
+            """)
 
         tables = self.__prepare_census_tables_for_query(tables)
-
-        exclude = []
-        exclude.append(data[0][0].index('NAME'))
-        exclude.append(data[0][0].index('time'))
-
-        self.__cursor.executemany(f"""
-            INSERT INTO dbo.census_county_poverty ({tables}, year, state, county)
-            VALUES (
-                {self.__generate_num_blanks(len(data[0][0]) - len(exclude))}
-            );
-        """, self.__census_insert_generator(data, exclude_indexes=exclude))
+        self.__insert_census_years("census_county_poverty", f"{tables}, year, state, county",
+            lambda year: iter_census_timeseries("counties", "poverty", year), exclude=["NAME", "time"])
 
 
     def __init_census_state_data_table(self):
         tables = self.__get_census_tables("census_data_tables")
-        # make table named "census_county_data"
-        self.__cursor.execute(f"""
-            IF OBJECT_ID('dbo.census_state_data', 'U') IS NOT NULL
-                DROP TABLE dbo.census_state_data;
-            CREATE TABLE dbo.census_state_data (
+        # make table named "census_state_data"
+        self.__create_table("census_state_data", f"""
                 state char(2) NOT NULL,
                 year INT NOT NULL,
                 {tables},
                 PRIMARY KEY (state, year)
-            );
-        """)
-        curr_year = self.__get_curr_year()
-        data = get_census_data("states", curr_year-3, curr_year)
+            """)
 
         tables = self.__prepare_census_tables_for_query(tables)
-
-        exclude = []
-        exclude.append(data[0][0].index('NAME'))
-
-        self.__cursor.executemany(f"""
-            INSERT INTO dbo.census_state_data ({tables}, state, year)
-            VALUES (
-                {self.__generate_num_blanks(len(data[0][0])-len(exclude))}
-            );
-        """, self.__census_insert_generator(data, exclude_indexes=exclude))
+        self.__insert_census_years("census_state_data", f"{tables}, state, year",
+            lambda year: iter_census_data("states", year), exclude=["NAME"])
 
 
     def __init_census_county_data_table(self):
         tables = self.__get_census_tables("census_data_tables")
         # make table named "census_county_data"
-        self.__cursor.execute(f"""
-            IF OBJECT_ID('dbo.census_county_data', 'U') IS NOT NULL
-                DROP TABLE dbo.census_county_data;
-            CREATE TABLE dbo.census_county_data (
+        self.__create_table("census_county_data", f"""
                 state char(2) NOT NULL,
                 county char(3) NOT NULL,
                 year INT NOT NULL,
                 {tables},
                 PRIMARY KEY (state, county, year)
-            );
-        """)
-        curr_year = self.__get_curr_year()
-        data = get_census_data("counties", curr_year-3, curr_year)
+            """)
 
         tables = self.__prepare_census_tables_for_query(tables)
+        self.__insert_census_years("census_county_data", f"{tables}, state, county, year",
+            lambda year: iter_census_data("counties", year), exclude=["NAME"])
 
-        # get index of 'NAME' in data[0][0]
-        exclude = [data[0][0].index('NAME')]
 
-        self.__cursor.executemany(f"""
-            INSERT INTO dbo.census_county_data ({tables}, state, county, year)
-            VALUES (
-                {self.__generate_num_blanks(len(data[0][0])-len(exclude))}
-            );
-        """, self.__census_insert_generator(data, exclude_indexes=exclude))
+    def __insert_census_years(self, table, columns, get_year, exclude=[]):
+        """
+        Requests and inserts the census data for the last 4 years, one year at a time.
+        Each year is a checkpointed unit, so a resumed load only requests the years that are missing.
+        The rows are inserted in batches of CENSUS_INSERT_BATCH_SIZE while the response is still being decoded.
+        The years do not go through the pipeline (see pipeline.py): it would hold every year in flight in memory,
+        and the first insert of a year would wait for its whole response.
+
+        @param table: the name of the table to insert into
+        @param columns: the columns (in order) of the insert statement
+        @param get_year: function that takes a year and returns an iterator of the header row and data rows
+        @param exclude: names of the returned columns that are not inserted
+        """
+        completed = self.__start_load(table)
+        curr_year = self.__get_curr_year()
+        for year in self.__years_to_load(table, curr_year-3, curr_year):
+            if str(year) in completed:
+                continue
+            rows = iter(get_year(year))
+            header = next(rows, None)
+            if header is None: # <- not released yet
+                continue
+            exclude_indexes = [header.index(x) for x in exclude]
+
+            with self.__checkpointed_unit(table, str(year)):
+                batch = []
+                for row in self.__census_insert_generator(rows, exclude_indexes=exclude_indexes):
+                    batch.append(row)
+                    if len(batch) == CENSUS_INSERT_BATCH_SIZE:
+                        self.__bulk_insert(table, columns, batch)
+                        batch = []
+                self.__bulk_insert(table, columns, batch)
+        self.__finish_load(table, first_year=curr_year-3)
 
 
     def __prepare_census_tables_for_query(self, tables):
@@ -362,30 +554,127 @@ class API_DB_Mediator:
         if for_ not in ["us", "state", "county"]:
             raise ValueError("for_ must be one of 'US', 'STATE', or 'COUNTY'")
 
+        if self.employment_source == "singlefile":
+            self.__init_employment_tables_from_singlefile([for_])
+            return
+
+        def write_file(unit, emp_data):
+            if emp_data is None: # <- not published
+                return
+            area, year, qtr = unit
+            with self.__checkpointed_unit(f"{for_}_employment", f"{area}/{year}/{qtr}"):
+                self.__insert_employment_rows(for_, emp_data)
+        fetch = lambda unit: fetch_employment_file(*unit)
+
+        def get_unit(name):
+            area, year, qtr = name.split("/")
+            return area, int(year), int(qtr)
+
+        if self.queue_mode == "worker":
+            self.__run_queue(f"{for_}_employment", None, get_unit, fetch, write_file, parse=parse_employment_file)
+            return
+
+        state_codes = self.__get_all_state_fips()
+        county_codes = [self.__get_all_county_fips(state) for state in state_codes]
+        curr_year = self.__get_curr_year()
+
+        for_param = "us"
+        if for_ == "state":
+            for_param = "states"
+        elif for_ == "county":
+            for_param = "counties"
+
+        self.__create_employment_table(for_)
+
+        completed = self.__start_load(f"{for_}_employment")
+        years = self.__years_to_load(f"{for_}_employment", curr_year-3, curr_year)
+        # the quarters that are not published yet and the files known to be missing are not requested
+        latest_quarter, missing = get_latest_qcew_quarter(), get_missing_files()
+        units = [
+            (area, year, qtr) for area, year, qtr in get_employment_units(for_param, curr_year-3, curr_year, state_codes, county_codes, latest_quarter)
+            if f"{area}/{year}/{qtr}" not in completed and year in years and (area, year, qtr) not in missing
+        ]
+
+        if self.queue_mode == "coordinator":
+            self.__run_queue(f"{for_}_employment", ["/".join(map(str, unit)) for unit in units], get_unit, fetch, write_file, parse=parse_employment_file)
+        else:
+            self.__run_pipeline(units, fetch, write_file, parse=parse_employment_file)
+        self.__finish_load(f"{for_}_employment", first_year=curr_year-3)
+
+
+    def __init_employment_tables(self):
+        """
+        Initializes the US, state and county employment tables.
+        With the singlefile source all three are fed from a single pass over the archives.
+        """
+        if self.employment_source == "singlefile":
+            self.__init_employment_tables_from_singlefile(["us", "state", "county"])
+        else:
+            for for_ in ["US", "STATE", "COUNTY"]:
+                self.__init_employment_table(for_)
+
+
+    def __init_employment_tables_from_singlefile(self, for_list):
+        """
+        Initializes the employment tables from the QCEW singlefile archives, which contain every area.
+        Each archive is downloaded once and the rows of each table's areas are inserted into that table.
+
+        @param for_list: list of "us", "state" and/or "county"
+        """
+        state_codes = self.__get_all_state_fips()
+        areas = {}
+        if "us" in for_list:
+            areas.update({"US000": "us"})
+        if "state" in for_list:
+            areas.update({f"{state}000": "state" for state in state_codes})
+        if "county" in for_list:
+            areas.update({f"{state}{county}": "county" for state in state_codes for county in self.__get_all_county_fips(state)})
+
+        tables = [f"{for_}_employment" for for_ in for_list]
+        completed = [self.__start_load(table) for table in tables]
+        for for_ in for_list:
+            self.__create_employment_table(for_)
+
+        curr_year = self.__get_curr_year()
+        years = set().union(*[self.__years_to_load(table, curr_year-3, curr_year) for table in tables])
+        latest_quarter = get_latest_qcew_quarter()
+        for year in sorted(years):
+            if latest_quarter and year > latest_quarter[0]: # <- not published yet
+                continue
+            unit = f"singlefile/{year}"
+            if all(unit in c for c in completed):
+                continue
+            with self.__checkpointed_unit(tables, unit):
+                for emp_data in get_employment_singlefile(year, areas.keys()):
+                    for_column = emp_data["area_fips"].map(areas)
+                    for for_ in for_list:
+                        self.__insert_employment_rows(for_, emp_data[for_column == for_])
+        for table in tables:
+            self.__finish_load(table, first_year=curr_year-3)
+
+
+    def __create_employment_table(self, for_):
+        """
+        @param for_: str "us", "state", or "county"
+        """
         # set up optional sql inserts
         state_create = "state CHAR(2) NOT NULL, "
         state_col = "state, "
         county_create = "county CHAR(3) NOT NULL, "
         county_col = "county, "
 
-        state_codes = self.__get_all_state_fips()
-        county_codes = [self.__get_all_county_fips(state) for state in state_codes]
-
         if for_ == "us":
             state_create, state_col, county_create, county_col = "", "", "", ""
         elif for_ == "state":
             county_create, county_col = "", ""
-        
-        self.__cursor.execute(f"""
-            IF OBJECT_ID('dbo.{for_}_employment', 'U') IS NOT NULL
-                DROP TABLE dbo.{for_}_employment;
-            CREATE TABLE dbo.{for_}_employment (
+
+        self.__create_table(f"{for_}_employment", f"""
                 {state_create}{county_create}
                 year SMALLINT NOT NULL,
                 qtr TINYINT NOT NULL,
-                own_code INT,
-                industry_code VARCHAR(6),
-                agglvl_code INT,
+                own_code INT NOT NULL,
+                industry_code VARCHAR(6) NOT NULL,
+                agglvl_code INT NOT NULL,
                 size_code INT,
                 disclosure_code varchar(5),
                 qtrly_estabs BIGINT,
@@ -397,49 +686,49 @@ class API_DB_Mediator:
                 qtrly_contributions BIGINT,
                 avg_wkly_wage BIGINT,
                 PRIMARY KEY ({state_col}{county_col}own_code, industry_code, agglvl_code, year, qtr)
-            );
-        """)
+            """)
 
-        def insert_into_table(row):
-            new_row = []
-            fip = str(row[0])
-            while len(fip) < 5:
-                fip = "0" + fip
 
-            if state_col:
-                new_row.append(f"{fip[:2]}")
-            if county_col:
-                new_row.append(f"{fip[2:]}")
-            new_row = (*new_row, *row[1:])
+    def __insert_employment_rows(self, for_, emp_data):
+        """
+        Bulk inserts QCEW rows into the employment table, splitting area_fips into state and county as needed.
 
-            self.__cursor.execute(f"""
-                    INSERT INTO dbo.{for_}_employment ( 
-                        {state_col}{county_col}own_code, industry_code, agglvl_code, size_code, year, qtr,
-                        disclosure_code, qtrly_estabs, month1_emplvl, month2_emplvl, month3_emplvl, 
-                        total_qtrly_wages, taxable_qtrly_wages, qtrly_contributions, avg_wkly_wage
-                    )
-                    VALUES (
-                        {self.__generate_num_blanks(len(new_row))}
-                    );
-                """, *new_row)
+        @param for_: str "us", "state", or "county"
+        @param emp_data: dataframe with the bls_data.EMPLOYMENT_COLUMNS (area_fips first)
+        """
+        if len(emp_data) == 0:
+            return
 
-        curr_year = self.__get_curr_year()
+        state_col = "state, " if for_ != "us" else ""
+        county_col = "county, " if for_ == "county" else ""
 
-        for_param = "us"
-        if for_ == "state":
-            for_param = "states"
-        elif for_ == "county":
-            for_param = "counties"
-        
-        for emp_data in get_employment_data(for_param, curr_year-3, curr_year, state_codes, county_codes):
-            emp_data = emp_data[emp_data.columns[:16]] # cut off unwanted columns
-            emp_data = emp_data.replace(np.nan, '-')
-            emp_data = np.array(emp_data.values)
-            np.apply_along_axis(insert_into_table, 1, emp_data)
+        fips = emp_data.iloc[:, 0].astype(str).str.zfill(5)
+        emp_data = emp_data.astype(object).where(emp_data.notna(), None) # <- NULL for missing values
+        keys = []
+        if state_col:
+            keys.append(fips.str[:2])
+        if county_col:
+            keys.append(fips.str[2:])
+        keys = list(zip(*keys)) if keys else [()] * len(emp_data)
+        rows = [(*key, *row) for key, row in zip(keys, emp_data.iloc[:, 1:].itertuples(index=False, name=None))]
+
+        self.__bulk_insert(f"{for_}_employment", f"""
+                {state_col}{county_col}own_code, industry_code, agglvl_code, size_code, year, qtr,
+                disclosure_code, qtrly_estabs, month1_emplvl, month2_emplvl, month3_emplvl, 
+                total_qtrly_wages, taxable_qtrly_wages, qtrly_contributions, avg_wkly_wage
+            """, rows)
 
 
     def close_connection(self):
-        self.__connection.close()
+        self.__close_sharded_writers()
+        self.__targets.close()
+
+
+    def get_target_failures(self) -> dict:
+        """
+        @return: dict of the config file of every target database that failed during this run -> the error
+        """
+        return dict(self.__targets.failures)
 
 
     def __init_states_table(self):
@@ -493,76 +782,276 @@ class API_DB_Mediator:
 
 
     def __init_state_unemployment_table(self):
+        states = self.__get_all_state_fips()
+        # call get_unemployment_data with 50 fips at a time
+        batches = []
+        for lower, upper in self.__bls_timeseries_index_generator(len(states)):
+            batches.append((f"{states[lower]}-{states[upper-1]}", partial(get_unemployment_data, states[lower:upper])))
+
         # make named table "state_unemployment"
-        self.__cursor.execute("""
-            IF OBJECT_ID('dbo.state_unemployment_rate', 'U') IS NOT NULL
-                DROP TABLE dbo.state_unemployment_rate;
-            CREATE TABLE dbo.state_unemployment_rate (
+        self.__load_timeseries_table("state_unemployment_rate", """
                 state char(2) NOT NULL,
                 year int NOT NULL,
                 period char(3) NOT NULL,
                 value float,
                 PRIMARY KEY (state, year, period)
-            );
-        """)
-
-        current_year = self.__get_curr_year()
-        states = self.__get_all_state_fips()
-
-        # call get_unemployment_data with 50 fips at a time
-        for lower, upper in self.__bls_timeseries_index_generator(len(states)):
-            unemp_data = get_unemployment_data(states[lower:upper], start_year=current_year-2, end_year=current_year)
-            self.__iterate_over_timeseries_and_execute_query(unemp_data, self.__insert_into_state_unemployment_skeleton)
+            """, batches)
 
 
     def __init_county_unemployment_table(self):
         # make named table "county_unemployment_rate"
-        self.__cursor.execute("""
-            IF OBJECT_ID('dbo.county_unemployment_rate', 'U') IS NOT NULL
-                DROP TABLE dbo.county_unemployment_rate;
-            CREATE TABLE dbo.county_unemployment_rate (
+        self.__init_county_timeseries_table("county_unemployment_rate", get_unemployment_data, LAUS_UNEMPLOYMENT_RATE)
+
+
+    def __init_county_workers_table(self):
+        # make named table "county_workers"
+        self.__init_county_timeseries_table("county_workers", get_county_workers, LAUS_LABOR_FORCE)
+
+
+    def __init_county_timeseries_table(self, table, get_series, measure_code):
+        """
+        Initializes a county level BLS timeseries table, requesting 50 counties at a time
+        (or reading every county from the LAUS flat file, see laus_source).
+
+        @param table: the name of the table
+        @param get_series: get_unemployment_data or get_county_workers
+        @param measure_code: the LAUS measure code of the table's series
+        """
+        columns = """
                 state char(2) NOT NULL,
                 county char(3) NOT NULL,
                 year int NOT NULL,
                 period char(3) NOT NULL,
                 value float,
                 PRIMARY KEY (state, county, year, period)
-            );
-        """)
+            """
+        if self.laus_source == "flatfile":
+            self.__load_laus_table(table, columns, measure_code)
+            return
+
+        batches = []
+        for state in self.__get_all_state_fips():
+            counties = [x[0] for x in self.__read(f"select county from dbo.counties where state = '{state}';").fetchall()]
+            for lower, upper in self.__bls_timeseries_index_generator(len(counties)):
+                batches.append((f"{state}/{counties[lower]}-{counties[upper-1]}", partial(get_series, [state], counties[lower:upper])))
+
+        self.__load_timeseries_table(table, columns, batches, include_county=True)
 
+
+    def __load_laus_table(self, table, columns, measure_code):
+        """
+        Creates and loads a county BLS timeseries table from the LAUS county flat file, for the same years as
+        __load_timeseries_table. The file has every county, so no API request (or quota) is needed and the whole
+        history costs a single download. The load is one checkpointed unit.
+
+        @param table: the name of the table
+        @param columns: the column and key definitions of the table
+        @param measure_code: the LAUS measure code of the table's series
+        """
         current_year = self.__get_curr_year()
-        states = self.__get_all_state_fips()
+        start_year = self.backfill_start_year or current_year-2
+        completed = self.__start_load(table) if self.resume else set()
+        years = self.__years_to_load(table, start_year, current_year)
 
-        for state in states:
-            counties = [x[0] for x in self.__cursor.execute(f"select county from dbo.counties where state = '{state}';").fetchall()]
-            for lower, upper in self.__bls_timeseries_index_generator(len(counties)):
-                unemp_data = get_unemployment_data([state], counties[lower:upper], start_year=current_year-2, end_year=current_year)
-                self.__iterate_over_timeseries_and_execute_query(unemp_data, self.__insert_into_county_unemployment_skeleton, include_county=True)
+        self.__create_table(table, columns)
+        self.__start_load(table)
 
+        unit = f"flatfile/{years[0]}-{current_year}" if years else None
+        if unit and unit not in completed:
+            areas = [f"{state}{county}" for state, county in self.__read("select state, county from dbo.counties;").fetchall()]
+            with self.__checkpointed_unit(table, unit):
+                for data in get_laus_county_data(measure_code, years[0], current_year, areas):
+                    data = data.astype(object).where(data.notna(), None) # <- NULL for missing values
+                    self.__bulk_insert(table, "state, county, year, period, value", data.itertuples(index=False, name=None))
+        self.__finish_load(table, first_year=start_year)
 
-    def __init_county_workers_table(self):
-        # make named table "county_workers"
-        self.__cursor.execute("""
-            IF OBJECT_ID('dbo.county_workers', 'U') IS NOT NULL
-                DROP TABLE dbo.county_workers;
-            CREATE TABLE dbo.county_workers (
-                state char(2) NOT NULL,
-                county char(3) NOT NULL,
-                year int NOT NULL,
-                period char(3) NOT NULL,
-                value float,
-                PRIMARY KEY (state, county, year, period)
-            );
-        """)
 
+    def __load_timeseries_table(self, table, columns, batches, include_county=False):
+        """
+        Creates and loads a BLS timeseries table.
+
+        The years from self.backfill_start_year (or the last 3 years) through the current year are split into
+        the largest windows BLS allows per request, every (series batch, window) pair is requested concurrently
+        and each response is bulk inserted as its own checkpointed unit.
+        Before the table is touched, the daily BLS quota is checked against the number of requests needed.
+
+        @param table: the name of the table
+        @param columns: the column and key definitions of the table
+        @param batches: list of (batch name, function that requests the batch given start_year and end_year)
+        @param include_county: whether or not the table has a county column
+        """
         current_year = self.__get_curr_year()
-        states = self.__get_all_state_fips()
+        start_year = self.backfill_start_year or current_year-2
+        county_col = "county, " if include_county else ""
+
+        def get_units(years, completed=()):
+            units = []
+            for name, get_batch in batches:
+                for window_start, window_end in get_year_windows(years[0], current_year) if years else []:
+                    unit = f"{name}/{window_start}-{window_end}"
+                    if unit not in completed:
+                        units.append((unit, get_batch, window_start, window_end))
+            return units
+        fetch = lambda unit: unit[1](start_year=unit[2], end_year=unit[3])
+
+        def write_batch(unit, timeseries_data):
+            rows = list(self.__timeseries_rows(timeseries_data, include_county))
+            with self.__checkpointed_unit(table, unit[0]):
+                self.__bulk_insert(table, f"state, {county_col}year, period, value", rows)
+
+        get_batches = dict(batches)
+        def get_unit(name):
+            batch, window = name.rsplit("/", 1) # <- "<batch name>/<window start>-<window end>"
+            window_start, window_end = map(int, window.split("-"))
+            return name, get_batches[batch], window_start, window_end
+
+        if self.queue_mode == "worker":
+            self.__run_queue(table, None, get_unit, fetch, write_batch, quota_url=BLS_TIMESERIES_URL)
+            return
+
+        completed = self.__start_load(table) if self.resume else set()
+        units = get_units(self.__years_to_load(table, start_year, current_year), completed)
+        check_quota(BLS_TIMESERIES_URL, len(units))
+
+        self.__create_table(table, columns)
+        self.__start_load(table)
+
+        if self.queue_mode == "coordinator":
+            self.__run_queue(table, [unit[0] for unit in units], get_unit, fetch, write_batch, quota_url=BLS_TIMESERIES_URL)
+            self.__finish_load(table, first_year=start_year)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.fetch_workers) as executor:
+            futures = {executor.submit(fetch, unit): unit for unit in units}
+            try:
+                for future in as_completed(futures):
+                    write_batch(futures[future], future.result())
+            except BaseException:
+                # don't wait for (or spend quota on) the requests that have not started yet
+                for future in futures:
+                    future.cancel()
+                raise
+        self.__finish_load(table, first_year=start_year)
+
+
+    def __run_pipeline(self, units, fetch, write, parse=None, stop=None, on_error=None):
+        """
+        Runs the units of a load through pipeline.run_pipeline with fetch_workers downloaders and parse_workers parsers.
+        Takes the same fetch, write, parse, stop and on_error as run_pipeline.
+        """
+        run_pipeline(units, fetch, write, parse=parse, fetch_workers=self.fetch_workers, parse_workers=self.parse_workers,
+            stop=stop, on_error=on_error)
 
-        for state in states:
-            counties = [x[0] for x in self.__cursor.execute(f"select county from dbo.counties where state = '{state}';").fetchall()]
-            for lower, upper in self.__bls_timeseries_index_generator(len(counties)):
-                unemp_data = get_county_workers([state], counties[lower:upper], start_year=current_year-2, end_year=current_year)
-                self.__iterate_over_timeseries_and_execute_query(unemp_data, self.__insert_into_county_workers_skeleton, include_county=True)
+
+    def __run_queue(self, table, names, get_unit, fetch, write, parse=None, quota_url=None):
+        """
+        Runs the units of a load through the work queue (see work_queue.py) instead of a single pipeline.
+        The coordinator enqueues the units, then the coordinator and the workers claim fetch_workers units at a time
+        and run them through their own pipeline until no unit is left. The coordinator waits for the units leased
+        to other workers (reclaiming those whose lease runs out), so the load is complete once it returns.
+
+        The leases of the claimed units are renewed every third of LEASE_SECONDS until they are written, however long
+        they wait in the pipeline. A unit whose checkpoint is already there (another worker took it over) is not
+        written again, only marked done. A unit whose download, parsing or insert fails is logged and released, to be
+        claimed again until it runs out of attempts, and the other units carry on.
+
+        @param table: the name of the table being loaded
+        @param names: the names of the units to load (coordinator only, a worker claims them from the queue)
+        @param get_unit: function taking a unit name and returning the unit (as taken by fetch and write). The units
+                         are rebuilt from their names, so the workers load the units the coordinator enqueued
+                         whatever the years it was run with.
+        @param fetch, write, parse: as taken by pipeline.run_pipeline
+        @param quota_url: the url of the API the units are requested from, if it has a daily quota. Its usage is
+                          kept per host and checked by the coordinator for every unit, so the workers have to run
+                          on the host of the coordinator.
+
+        @raise WorkQueueError: (coordinator) if some units failed on every attempt, once every other unit is loaded
+                               (the load can then be finished with --resume),
+                               (worker) if the units spend a daily quota and the coordinator runs on another host
+        """
+        queue = WorkQueue(self.__connection_strings[self.__targets.names[0]], table)
+        stop = threading.Event()
+        leased, leased_lock = set(), threading.Lock()
+        heartbeat_stop = threading.Event()
+
+        def renew_leases():
+            while not heartbeat_stop.wait(LEASE_SECONDS / 3):
+                with leased_lock:
+                    units = list(leased)
+                try:
+                    queue.renew(units)
+                except pyodbc.Error as e:
+                    print(f"Could not renew the leases of {len(units)} units of {table}: {e}")
+        heartbeat = threading.Thread(target=renew_leases, daemon=True, name="work_queue_heartbeat")
+
+        try:
+            if self.queue_mode == "coordinator":
+                queue.enqueue(list(names))
+                print(f"Enqueued {len(names)} units of {table}, workers can be started")
+            else:
+                if quota_url:
+                    # a worker started before the coordinator enqueued the units of its first load waits for them
+                    coordinator = queue.get_coordinator()
+                    while coordinator is None:
+                        self.__check_cancelled()
+                        stop.wait(POLL_INTERVAL)
+                        coordinator = queue.get_coordinator()
+                    if coordinator != queue.host:
+                        raise WorkQueueError(f"The units of {table} spend the daily quota of {get_host(quota_url)}, which is "
+                            f"only tracked on the host of the coordinator ({coordinator}); run the workers there")
+                units_done = self.__read("SELECT unit FROM dbo.load_checkpoints WHERE table_name = ?;", table).fetchall()
+                self.__completed_units[table] = {unit[0] for unit in units_done}
+            heartbeat.start()
+
+            def claimed_units():
+                while not stop.is_set():
+                    claimed = queue.claim(self.fetch_workers)
+                    with leased_lock:
+                        leased.update(claimed)
+                    yield from claimed
+                    if claimed:
+                        continue
+                    counts = queue.counts()
+                    # a worker started before the coordinator enqueued the units of its first load waits for them
+                    if not counts["pending"] and (self.queue_mode == "coordinator" or counts["done"] or counts["failed"]):
+                        return
+                    self.__check_cancelled()
+                    stop.wait(POLL_INTERVAL)
+
+            def is_checkpointed(name):
+                return self.__read("SELECT 1 FROM dbo.load_checkpoints WHERE table_name = ? AND unit = ?;", table, name).fetchone() is not None
+
+            def write_unit(name, data):
+                if not is_checkpointed(name):
+                    try:
+                        write(get_unit(name), data)
+                    except pyodbc.IntegrityError:
+                        # the checkpoint of a worker that took the unit over was committed in the meantime
+                        if not is_checkpointed(name):
+                            raise
+                queue.done(name)
+                with leased_lock:
+                    leased.discard(name)
+
+            def fail_unit(name, error):
+                if isinstance(error, (LoadCancelled, BrokenExecutor)):
+                    raise error
+                print(f"Unit {name} of {table} failed: {error!r}")
+                queue.release(name)
+                with leased_lock:
+                    leased.discard(name)
+            self.__run_pipeline(claimed_units(), lambda name: fetch(get_unit(name)), write_unit, parse=parse, stop=stop,
+                on_error=fail_unit)
+
+            failed = queue.get_failed() if self.queue_mode == "coordinator" else []
+            if failed:
+                raise WorkQueueError(f"{len(failed)} units of {table} failed on every attempt, e.g. {', '.join(failed[:5])}; "
+                    "the other units are loaded, run the coordinator again with --resume to retry them")
+        finally:
+            heartbeat_stop.set()
+            if heartbeat.is_alive():
+                heartbeat.join()
+            queue.close()
 
 
     def __bls_timeseries_index_generator(self, n):
@@ -582,63 +1071,609 @@ class API_DB_Mediator:
             yield lower, upper
 
 
-    def __iterate_over_timeseries_and_execute_query(self, timeseries_data, query, include_county=False):
+    def __timeseries_rows(self, timeseries_data, include_county=False):
         """
-        This method iteratives over the timeseries data and executes the provided query
-
-        NOTE: format your string as follows:
-            {st} -> state, {cnty} -> county, {yr} -> year, {prd} -> period, {val} -> value
-  
+        Generator that converts the timeseries data into rows of (state, [county,] year, period, value)
 
-        @oaram timeseries_data: the timeseries data (json) returned from BLS
-        @param query: the query to be executed
-        @param include_county: whether or not to include the county in the query
+        @param timeseries_data: the timeseries data (json) returned from BLS
+        @param include_county: whether or not to include the county in the rows
         """
         for info in timeseries_data['Results']['series']:
-                series_id, data_key = info.keys()
-                series_id, data = info[series_id], info[data_key]
-                state, county = series_id[5:7], series_id[7:10]
-                for d in data:
-                    year, period, value = d['year'], d['period'], d['value']
-                    value = 'NULL' if value == '-' else value
-            
-                    if include_county:
-                        query_to_exec = query.format(st=state, cnty=county, yr=year, prd=period, val=value)
-                    else:
-                        query_to_exec = query.format(st=state, yr=year, prd=period, val=value)
-                    
-                    self.__cursor.execute(query_to_exec)
+            series_id, data_key = info.keys()
+            series_id, data = info[series_id], info[data_key]
+            state, county = series_id[5:7], series_id[7:10]
+            for d in data:
+                year, period, value = d['year'], d['period'], d['value']
+                value = None if value == '-' else float(value)
+
+                if include_county:
+                    yield state, county, int(year), period, value
+                else:
+                    yield state, int(year), period, value
+
+
+    def __create_table(self, table, columns):
+        """
+        Creates dbo.<table> with the given column definitions.
+        The existing table is dropped first, unless resuming, in which case it is kept so the
+        rows of the completed units are not lost.
+
+        With the "deferred" index strategy the PRIMARY KEY is left out (the table is a heap) and is built by
+        __finish_load once the table is loaded.
+
+        A partitioned table (see partition_by_year) is created on the year partition scheme if it does not exist
+        (or is not partitioned yet) and is not dropped, dbo.<table>_staging is (re)created instead.
+
+        @param table: the name of the table (without the dbo. prefix)
+        @param columns: the column and key definitions of the table
+        """
+        primary_key = re.search(r",\s*PRIMARY KEY\s*\(([^)]*)\)", columns)
+        if primary_key:
+            self.__primary_keys[table] = [x.strip() for x in primary_key.group(1).split(',')]
+            if self.index_strategy == "deferred":
+                columns = columns[:primary_key.start()] + columns[primary_key.end():]
+
+        target, partition_scheme = table, ""
+        if self.__is_partitioned(table):
+            target, partition_scheme = self.__target(table), f"ON {self.__create_partition_scheme(table)}(year)"
+            self.__cursor.execute(f"""
+                IF OBJECT_ID('dbo.{table}', 'U') IS NOT NULL AND NOT EXISTS (
+                    SELECT 1 FROM sys.indexes i JOIN sys.partition_schemes ps ON ps.data_space_id = i.data_space_id
+                    WHERE i.object_id = OBJECT_ID('dbo.{table}') AND i.index_id IN (0, 1)
+                )
+                    DROP TABLE dbo.{table};
+                IF OBJECT_ID('dbo.{table}', 'U') IS NULL
+                    CREATE TABLE dbo.{table} (
+                        {columns}
+                    ) {partition_scheme};
+            """)
+
+        drop = "" if self.resume else f"""
+            IF OBJECT_ID('dbo.{target}', 'U') IS NOT NULL
+                DROP TABLE dbo.{target};
+        """
+        self.__cursor.execute(f"""
+            {drop}
+            IF OBJECT_ID('dbo.{target}', 'U') IS NULL
+                CREATE TABLE dbo.{target} (
+                    {columns}
+                ) {partition_scheme};
+        """)
+
+
+    def __finish_load(self, table, first_year=None):
+        """
+        Builds the deferred clustered primary key (if any) and the secondary indexes of a table after it is loaded.
+        A partitioned table gets the same keys and indexes as its staging table (partition switching requires it)
+        and the loaded years are switched in.
+
+        @param table: the name of the table that has been loaded
+        @param first_year: the first year of the window kept in a partitioned table (None -> the first loaded year)
+        """
+        for name in ([self.__target(table), table] if self.__is_partitioned(table) else [table]):
+            if self.index_strategy == "deferred" and table in self.__primary_keys:
+                self.__cursor.execute(f"""
+                    IF NOT EXISTS (SELECT 1 FROM sys.key_constraints WHERE parent_object_id = OBJECT_ID('dbo.{name}') AND type = 'PK')
+                        ALTER TABLE dbo.{name} ADD CONSTRAINT pk_{name} PRIMARY KEY CLUSTERED ({', '.join(self.__primary_keys[table])});
+                """)
+            for index, columns in SECONDARY_INDEXES.get(table, []):
+                self.__cursor.execute(f"""
+                    IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = '{index}' AND object_id = OBJECT_ID('dbo.{name}'))
+                        CREATE INDEX {index} ON dbo.{name} ({columns});
+                """)
+        if self.__is_partitioned(table):
+            self.__switch_in_years(table, first_year)
+        if self.change_feed:
+            self.__emit_changes(table)
+        self.__record_load_version(table)
+
+
+    def __emit_changes(self, table):
+        """
+        Compares the table, just loaded, with its previous load and emits the rows that were inserted, updated or
+        deleted, by primary key. Only a SHA-256 hash of every row of the previous load is kept (in
+        dbo.change_feed_hashes), so a row counts as updated when its hash changed.
+
+        The first load of a table only records the hashes. Tables without a primary key have no change feed.
+
+        With change_feed "table", the changes are appended to dbo.change_log in the same transaction as the new hashes.
+        With "jsonl", one line per change {"table", "loaded_at", "op", "key", "row"} is appended to CHANGE_FEED_DIR/<table>.jsonl,
+        only once the new hashes are committed (a load that fails before that emits nothing and is compared again next time).
+        """
+        key = [row[0] for row in self.__read(f"""
+            SELECT c.name FROM sys.indexes i
+            JOIN sys.index_columns ic ON ic.object_id = i.object_id AND ic.index_id = i.index_id
+            JOIN sys.columns c ON c.object_id = ic.object_id AND c.column_id = ic.column_id
+            WHERE i.object_id = OBJECT_ID('dbo.{table}') AND i.is_primary_key = 1
+            ORDER BY ic.key_ordinal;
+        """).fetchall()]
+        if not key:
+            return
+
+        self.__cursor.execute("""
+            IF OBJECT_ID('dbo.change_feed_hashes', 'U') IS NULL
+                CREATE TABLE dbo.change_feed_hashes (
+                    table_name varchar(50) NOT NULL,
+                    key_hash binary(32) NOT NULL, -- <- SHA-256 of row_key, keeps the primary key under 900 bytes
+                    row_key nvarchar(max) NOT NULL,
+                    row_hash binary(32) NOT NULL,
+                    PRIMARY KEY (table_name, key_hash)
+                );
+            IF OBJECT_ID('dbo.change_log', 'U') IS NULL
+                CREATE TABLE dbo.change_log (
+                    change_id bigint IDENTITY NOT NULL,
+                    table_name varchar(50) NOT NULL,
+                    loaded_at datetime2 NOT NULL,
+                    op char(1) NOT NULL, -- I(nsert), U(pdate) or D(elete)
+                    row_key nvarchar(max) NOT NULL,
+                    row_data nvarchar(max), -- NULL for deletes
+                    PRIMARY KEY (change_id)
+                );
+        """)
+        key_columns = ", ".join(f"t.{x}" for x in key)
+        self.__cursor.execute(f"""
+            IF OBJECT_ID('tempdb..#new_hashes') IS NOT NULL
+                DROP TABLE #new_hashes;
+            SELECT {key_columns}, k.row_key, HASHBYTES('SHA2_256', k.row_key) AS key_hash,
+                HASHBYTES('SHA2_256', (SELECT t.* FOR JSON PATH, WITHOUT_ARRAY_WRAPPER, INCLUDE_NULL_VALUES)) AS row_hash
+            INTO #new_hashes
+            FROM dbo.{table} t
+            CROSS APPLY (SELECT (SELECT {key_columns} FOR JSON PATH, WITHOUT_ARRAY_WRAPPER) AS row_key) k;
+        """)
+        has_previous = self.__read("SELECT TOP 1 1 FROM dbo.change_feed_hashes WHERE table_name = ?;", table).fetchone()
+        loaded_at = self.__read("SELECT SYSUTCDATETIME();").fetchone()[0]
+        changes = f"""
+            SELECT CASE WHEN o.row_hash IS NULL THEN 'I' WHEN n.row_hash IS NULL THEN 'D' ELSE 'U' END AS op,
+                COALESCE(n.row_key, o.row_key) AS row_key,
+                (SELECT t.* FROM dbo.{table} t WHERE {' AND '.join(f"t.{x} = n.{x}" for x in key)}
+                    FOR JSON PATH, WITHOUT_ARRAY_WRAPPER, INCLUDE_NULL_VALUES) AS row_data
+            FROM #new_hashes n
+            FULL OUTER JOIN (SELECT key_hash, row_key, row_hash FROM dbo.change_feed_hashes WHERE table_name = ?) o ON o.key_hash = n.key_hash
+            WHERE o.row_hash IS NULL OR n.row_hash IS NULL OR o.row_hash <> n.row_hash
+        """
+
+        feed_file = os.path.join(CHANGE_FEED_DIR, f"{table}.jsonl")
+        pending_file = None # <- the changes of this load, appended to the feed file once the new hashes are committed
+        self.__connection.autocommit = False
+        try:
+            if has_previous and self.change_feed == "table":
+                self.__cursor.execute(f"""
+                    INSERT INTO dbo.change_log (table_name, loaded_at, op, row_key, row_data)
+                    SELECT ?, ?, op, row_key, row_data FROM ({changes}) AS changes;
+                """, table, loaded_at, table)
+            elif has_previous:
+                os.makedirs(CHANGE_FEED_DIR, exist_ok=True)
+                cursor = self.__read(changes + ";", table)
+                ops = {"I": "insert", "U": "update", "D": "delete"}
+                pending_file = f"{feed_file}.pending"
+                with open(pending_file, 'w') as f:
+                    while True:
+                        rows = cursor.fetchmany(5000)
+                        if not rows:
+                            break
+                        for op, row_key, row_data in rows:
+                            print(json.dumps({"table": table, "loaded_at": loaded_at.isoformat(), "op": ops[op],
+                                "key": json.loads(row_key), "row": json.loads(row_data) if row_data else None}), file=f)
+            self.__cursor.execute("""
+                DELETE FROM dbo.change_feed_hashes WHERE table_name = ?;
+                INSERT INTO dbo.change_feed_hashes (table_name, key_hash, row_key, row_hash) SELECT ?, key_hash, row_key, row_hash FROM #new_hashes;
+                DROP TABLE #new_hashes;
+            """, table, table)
+            self.__connection.commit()
+        except Exception:
+            self.__connection.rollback()
+            if pending_file and os.path.exists(pending_file):
+                os.remove(pending_file)
+            raise
+        finally:
+            self.__connection.autocommit = True
+
+        if pending_file:
+            with open(pending_file) as src, open(feed_file, 'a') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(pending_file)
+
+
+    def __is_partitioned(self, table) -> bool:
+        return self.partition_by_year and table in PARTITIONED_TABLES
+
+
+    def __target(self, table) -> str:
+        """
+        @return: the name of the table the rows of a load of the table are inserted into
+        """
+        return f"{table}_staging" if self.__is_partitioned(table) else table
+
+
+    def __create_partition_scheme(self, table) -> str:
+        """
+        Creates the year partition function and scheme for the type of the table's year column, if they do not exist.
+        The function starts without boundaries, __add_year_boundaries adds one per year.
+
+        @return: the name of the partition scheme
+        """
+        type_ = PARTITIONED_TABLES[table]
+        self.__cursor.execute(f"""
+            IF NOT EXISTS (SELECT 1 FROM sys.partition_functions WHERE name = 'pf_year_{type_}')
+                CREATE PARTITION FUNCTION pf_year_{type_} ({type_}) AS RANGE RIGHT FOR VALUES ();
+            IF NOT EXISTS (SELECT 1 FROM sys.partition_schemes WHERE name = 'ps_year_{type_}')
+                CREATE PARTITION SCHEME ps_year_{type_} AS PARTITION pf_year_{type_} ALL TO ([PRIMARY]);
+        """)
+        return f"ps_year_{type_}"
+
+
+    def __add_year_boundaries(self, table, first_year, last_year):
+        """
+        Makes sure every year from first_year through last_year has its own partition, before any of its rows are inserted.
+        The boundary after last_year is added too, so the last partition stays empty and every split is a metadata operation.
+        """
+        type_ = PARTITIONED_TABLES[table]
+        self.__create_partition_scheme(table)
+        for year in range(first_year, last_year + 2):
+            self.__cursor.execute(f"""
+                IF NOT EXISTS (
+                    SELECT 1 FROM sys.partition_range_values v JOIN sys.partition_functions f ON f.function_id = v.function_id
+                    WHERE f.name = 'pf_year_{type_}' AND CAST(v.value AS int) = {int(year)}
+                )
+                BEGIN
+                    ALTER PARTITION SCHEME ps_year_{type_} NEXT USED [PRIMARY];
+                    ALTER PARTITION FUNCTION pf_year_{type_}() SPLIT RANGE ({int(year)});
+                END;
+            """)
+
+
+    def __get_partition_years(self, table, partition_function) -> dict:
+        """
+        Reads the non empty partitions of a partitioned table from the catalog (without scanning the table).
+
+        @return: dict of year -> partition number
+        """
+        rows = self.__read(f"""
+            SELECT CAST(v.value AS int), p.partition_number
+            FROM sys.partitions p
+            JOIN sys.partition_functions f ON f.name = '{partition_function}'
+            JOIN sys.partition_range_values v ON v.function_id = f.function_id AND v.boundary_id = p.partition_number - 1
+            WHERE p.object_id = OBJECT_ID('dbo.{table}') AND p.index_id IN (0, 1) AND p.rows > 0;
+        """).fetchall()
+        return {year: partition for year, partition in rows}
+
+
+    def __years_to_load(self, table, first_year, last_year) -> list:
+        """
+        @param table: the name of the table being loaded
+        @param first_year: the first year of the table's window
+        @param last_year: the last year of the table's window
+
+        @return: list of the years a load of the table requests. For a partitioned table with refresh_years set,
+                 only the last refresh_years years and the years missing from the table, otherwise every year.
+        """
+        years = list(range(first_year, last_year + 1))
+        if not self.__is_partitioned(table):
+            return years
+        self.__add_year_boundaries(table, first_year, last_year)
+        if self.refresh_years is None:
+            return years
+        loaded = self.__get_partition_years(table, f"pf_year_{PARTITIONED_TABLES[table]}")
+        return [year for year in years if year not in loaded or year > last_year - self.refresh_years]
+
+
+    def __switch_in_years(self, table, first_year=None):
+        """
+        Replaces the years loaded into dbo.<table>_staging in the table and switches out the years before first_year,
+        in one transaction. Both are metadata operations, so readers are never blocked for long and never see a
+        partial year. The staging table (holding the switched out years) is dropped afterwards.
+
+        @param table: the name of the partitioned table
+        @param first_year: the first year kept in the table (None -> the first loaded year)
+        """
+        staging = self.__target(table)
+        partition_function = f"pf_year_{PARTITIONED_TABLES[table]}"
+        loaded = self.__get_partition_years(staging, partition_function)
+        if first_year is None:
+            first_year = min(loaded, default=None)
+        retired = [] if first_year is None else \
+            [partition for year, partition in self.__get_partition_years(table, partition_function).items() if year < first_year]
+
+        self.__connection.autocommit = False
+        try:
+            for partition in loaded.values():
+                self.__cursor.execute(f"""
+                    TRUNCATE TABLE dbo.{table} WITH (PARTITIONS ({partition}));
+                    ALTER TABLE dbo.{staging} SWITCH PARTITION {partition} TO dbo.{table} PARTITION {partition};
+                """)
+            for partition in retired:
+                self.__cursor.execute(f"ALTER TABLE dbo.{table} SWITCH PARTITION {partition} TO dbo.{staging} PARTITION {partition};")
+            self.__connection.commit()
+        except Exception:
+            self.__connection.rollback()
+            raise
+        finally:
+            self.__connection.autocommit = True
+        self.__cursor.execute(f"DROP TABLE dbo.{staging};")
+
+
+    def __record_load_version(self, table):
+        """
+        Records that the table has just been (re)loaded in dbo.table_load_versions.
+        The rollups are rebuilt when the version of one of their sources changes.
+
+        @param table: the name of the table that has been loaded
+        """
+        self.__cursor.execute("""
+            IF OBJECT_ID('dbo.table_load_versions', 'U') IS NULL
+                CREATE TABLE dbo.table_load_versions (
+                    table_name varchar(50) NOT NULL,
+                    loaded_at datetime2 NOT NULL,
+                    PRIMARY KEY (table_name)
+                );
+            UPDATE dbo.table_load_versions SET loaded_at = SYSUTCDATETIME() WHERE table_name = ?;
+            IF @@ROWCOUNT = 0
+                INSERT INTO dbo.table_load_versions (table_name, loaded_at) VALUES (?, SYSUTCDATETIME());
+        """, table, table)
+
+
+    def refresh_rollups(self, force=False):
+        """
+        Rebuilds the rollup tables (see rollups.py) whose source tables have been reloaded since the rollup was built.
+        Rollups whose sources have never been loaded are skipped, and so are (with a message) the rollups whose source
+        tables or configured columns are missing and the rollups that fail to build, so the loads they follow still succeed.
+
+        @param force: rebuild every rollup regardless of the source versions
+
+        @return: list of the rollups that were rebuilt
+        """
+        self.__cursor.execute("""
+            IF OBJECT_ID('dbo.table_load_versions', 'U') IS NULL
+                CREATE TABLE dbo.table_load_versions (
+                    table_name varchar(50) NOT NULL,
+                    loaded_at datetime2 NOT NULL,
+                    PRIMARY KEY (table_name)
+                );
+            IF OBJECT_ID('dbo.rollup_versions', 'U') IS NULL
+                CREATE TABLE dbo.rollup_versions (
+                    rollup_name varchar(50) NOT NULL,
+                    source_table varchar(50) NOT NULL,
+                    loaded_at datetime2 NOT NULL,
+                    PRIMARY KEY (rollup_name, source_table)
+                );
+        """)
+        versions = dict(self.__read("SELECT table_name, loaded_at FROM dbo.table_load_versions;").fetchall())
+
+        with open("request_info.json", 'r') as f:
+            census_variables = [x.split(',')[0].strip() for x in json.load(f)['tables']['census_data_tables']]
+        if get_population_variable(census_variables) is None and {"county_gdp", "census_county_data"} <= set(versions):
+            print(f"Skipping rollup county_gdp_per_capita: none of {', '.join(POPULATION_VARIABLES)} is in census_data_tables")
+
+        rebuilt = []
+        for rollup, definition in get_rollups(get_bea_tables_and_linecodes_combined(), census_variables).items():
+            sources = definition["sources"]
+            if any(source not in versions for source in sources):
+                continue
+            built_from = dict(self.__read(
+                "SELECT source_table, loaded_at FROM dbo.rollup_versions WHERE rollup_name = ?;", rollup).fetchall())
+            if not force and all(built_from.get(source) == versions[source] for source in sources):
+                continue
+            missing = self.__get_missing_columns(sources, definition.get("columns", {}))
+            if missing:
+                print(f"Skipping rollup {rollup}: {', '.join(missing)} not found")
+                continue
+
+            # rebuilt in one transaction, so readers see either the old or the new rollup
+            self.__connection.autocommit = False
+            try:
+                self.__cursor.execute(f"""
+                    IF OBJECT_ID('dbo.{rollup}', 'U') IS NOT NULL
+                        DROP TABLE dbo.{rollup};
+                    SELECT * INTO dbo.{rollup} FROM ({definition["select"]}) AS rollup;
+                    ALTER TABLE dbo.{rollup} ADD CONSTRAINT pk_{rollup} PRIMARY KEY CLUSTERED ({definition["key"]});
+                    DELETE FROM dbo.rollup_versions WHERE rollup_name = ?;
+                """, rollup)
+                self.__cursor.executemany("INSERT INTO dbo.rollup_versions (rollup_name, source_table, loaded_at) VALUES (?, ?, ?);",
+                    [(rollup, source, versions[source]) for source in sources])
+                self.__connection.commit()
+            except pyodbc.Error as e:
+                self.__connection.rollback()
+                print(f"Could not rebuild rollup {rollup}, the previous one is kept: {e}")
+                continue
+            except Exception:
+                self.__connection.rollback()
+                raise
+            finally:
+                self.__connection.autocommit = True
+            rebuilt.append(rollup)
+        return rebuilt
+
+
+    def __get_missing_columns(self, tables, columns):
+        """
+        @param tables: the names of the tables (or views)
+        @param columns: dict of table name -> the columns it must have
+
+        @return: list of the tables that do not exist and of the missing columns ("table.column")
+        """
+        missing = []
+        for table in tables:
+            existing = {row[0].lower() for row in self.__read(
+                "SELECT name FROM sys.columns WHERE object_id = OBJECT_ID(?);", f"dbo.{table}").fetchall()}
+            if not existing:
+                missing.append(f"dbo.{table}")
+                continue
+            missing += [f"dbo.{table}.{x}" for x in columns.get(table, []) if x.lower() not in existing]
+        return missing
+
+
+    def __bulk_insert(self, table, columns, rows):
+        """
+        Inserts the rows into the table with a single executemany.
+        With the "sorted" index strategy the rows are first sorted by the table's primary key,
+        so they arrive in clustered index order.
+
+        @param table: the name of the table (without the dbo. prefix)
+        @param columns: comma separated names of the columns, in the order of the values in each row
+        @param rows: iterable of the rows to insert
+        """
+        self.__check_cancelled()
+        columns = [x.strip() for x in columns.split(',') if x.strip()]
+        rows = list(rows)
+        if not rows:
+            return
+
+        if self.index_strategy == "sorted" and table in self.__primary_keys:
+            key = [columns.index(x) for x in self.__primary_keys[table] if x in columns]
+            rows.sort(key=lambda row: tuple((row[i] is None, row[i]) for i in key))
+
+        query = f"""
+            INSERT INTO dbo.{self.__target(table)} ({', '.join(columns)})
+            VALUES ({self.__generate_num_blanks(len(columns))});
+        """
+        if self.__active_writer and "state" in columns:
+            self.__active_writer.insert(query, rows, columns.index("state"))
+        else:
+            self.__cursor.executemany(query, rows)
+        self.rows_inserted += len(rows)
+
+
+    def __start_load(self, table) -> set:
+        """
+        Prepares the checkpoint table for loading the given table.
+        When not resuming, the checkpoints of any previous load of the table are cleared.
+
+        @param table: the name of the table being loaded
+
+        @return: set of the units that have already been completed
+        """
+        self.__cursor.execute("""
+            IF OBJECT_ID('dbo.load_checkpoints', 'U') IS NULL
+                CREATE TABLE dbo.load_checkpoints (
+                    table_name varchar(50) NOT NULL,
+                    unit varchar(100) NOT NULL,
+                    completed_at datetime NOT NULL DEFAULT GETDATE(),
+                    PRIMARY KEY (table_name, unit)
+                );
+        """)
+        if not self.resume:
+            self.__cursor.execute("DELETE FROM dbo.load_checkpoints WHERE table_name = ?;", table)
+            self.__completed_units[table] = set()
+            return set()
+        units = self.__read("SELECT unit FROM dbo.load_checkpoints WHERE table_name = ?;", table).fetchall()
+        self.__completed_units[table] = {unit[0] for unit in units}
+        return self.__completed_units[table]
+
+
+    @contextmanager
+    def __checkpointed_unit(self, table, unit):
+        """
+        Runs the inserts of a single work unit in one transaction and records the unit as completed
+        in the same transaction, so a failure leaves neither partial rows nor a checkpoint behind.
+
+        With more than one writer connection, the rows are written by the sharded writer. Every shard records
+        "<unit>@<shard>/<number of shards>" in its own transaction, and a resumed unit skips the shards that already
+        committed. If any shard fails, every shard is rolled back.
+
+        @param table: the name of the table being loaded (or a list of names if the unit feeds several tables)
+        @param unit: the identifier of the work unit (e.g. "01001/2021/3")
+        """
+        self.__check_cancelled()
+        tables = [table] if isinstance(table, str) else table
+        writer = self.__get_sharded_writer()
+        if writer:
+            completed = set().union(*[self.__completed_units.get(t, set()) for t in tables])
+            shard_unit = lambda shard: f"{unit}@{shard}/{writer.n_shards}"
+            writer.begin(skip_shards=[i for i in range(writer.n_shards) if shard_unit(i) in completed])
+            self.__active_writer = writer
+
+        checkpoint_query = "INSERT INTO dbo.load_checkpoints (table_name, unit) VALUES (?, ?);"
+        self.__connection.autocommit = False
+        try:
+            yield
+            if writer:
+                writer.commit(checkpoint_query, lambda shard: [(t, shard_unit(shard)) for t in tables])
+            self.__cursor.executemany(checkpoint_query, [(t, unit) for t in tables])
+            self.__connection.commit()
+            if self.progress_callback:
+                self.progress_callback(", ".join(tables), unit)
+        except Exception:
+            if writer:
+                writer.rollback()
+            self.__connection.rollback()
+            raise
+        finally:
+            self.__active_writer = None
+            self.__connection.autocommit = True
+
+
+    def __check_cancelled(self):
+        """
+        @raise LoadCancelled: if the cancel_event is set
+        """
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise LoadCancelled()
+
+
+    def __get_sharded_writer(self):
+        """
+        @return: the ShardedWriter (created on first use), or None if only one writer connection is used
+        """
+        if self.writer_connections <= 1:
+            return None
+        if self.__sharded_writer is None or self.__sharded_writer.n_shards != self.writer_connections:
+            self.__close_sharded_writers()
+            writers = {target: ShardedWriter(x, self.writer_connections) for target, x in self.__connection_strings.items()}
+            self.__sharded_writers = writers
+            self.__sharded_writer = writers[self.__targets.names[0]] if len(writers) == 1 else FanOut(self.__targets, writers)
+        return self.__sharded_writer
+
+
+    def __close_sharded_writers(self):
+        """
+        Closes the ShardedWriter of every target, including the targets that failed (a FanOut only reaches the healthy ones)
+        """
+        for writer in self.__sharded_writers.values():
+            try:
+                writer.close()
+            except Exception:
+                pass
+        self.__sharded_writers = {}
+        self.__sharded_writer = None
+
+
+    def __read(self, query, *args):
+        """
+        Runs a query that returns rows on the first healthy target only. The targets hold the same rows,
+        so running it on the others too would only add load to them.
+
+        @return: the cursor, to fetch the rows from
+        """
+        return self.__cursors[self.__targets.healthy()[0]].execute(query, *args)
 
 
     def __get_curr_year(self) -> int:
-        return int(self.__cursor.execute("SELECT YEAR(GETDATE());").fetchone()[0])
+        return int(self.__read("SELECT YEAR(GETDATE());").fetchone()[0])
 
 
     def __get_all_state_fips(self) -> list:
-        states = self.__cursor.execute("SELECT FIP FROM dbo.states where FIP != '00';").fetchall()
+        states = self.__read("SELECT FIP FROM dbo.states where FIP != '00';").fetchall()
         return [fip[0] for fip in states]
 
 
     def __get_all_county_fips(self, state_code) -> list:
-        counties = self.__cursor.execute(f"SELECT county FROM dbo.counties where county != '000' and state = '{state_code}';").fetchall()
+        counties = self.__read(f"SELECT county FROM dbo.counties where county != '000' and state = '{state_code}';").fetchall()
         return [county[0] for county in counties]
 
 
     def __del__(self):
-        self.__connection.close()
+        self.__targets.close()
 
 
-    def __census_insert_generator(self, data, exclude_indexes=[]):
+    def __census_insert_generator(self, rows, exclude_indexes=[]):
         """
         Generator method that excludes indexes
 
-        @param data: the data to be inserted
+        @param rows: the data rows (without the header) to be inserted
         @param exclude_indexes: list of the indexes to be excluded
         """
-        for d in data:
-            for i, values in enumerate(d):
-                if i != 0: # <- excludes headers
-                    yield [values[j] for j in range(len(values)) if j not in exclude_indexes]
+        for values in rows:
+            yield [values[j] for j in range(len(values)) if j not in exclude_indexes]
     
 
     def __generate_num_blanks(self, n_blanks):
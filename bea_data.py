@@ -7,20 +7,45 @@ Specifically:
 Author: Nikolas Kovacs
 """
 import json
+import os
+import time
 import requests
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from rate_limiter import acquire
+
+# base url of the API, can be pointed somewhere else (e.g. mock_api_server.py) with an environment variable
+BEA_API_URL = os.environ.get("BEA_API_URL", "https://apps.bea.gov")
+
+# a linecode whose request fails (error status, BEAAPI.Error in a 200 response or a connection error) is requested
+# up to BEA_MAX_ATTEMPTS times, waiting BEA_RETRY_DELAY * 2^attempt seconds (or the Retry-After) in between
+BEA_MAX_ATTEMPTS = 4
+BEA_RETRY_DELAY = 5 # seconds
+# statuses that are worth retrying, any other non-200 status fails the linecode at once
+BEA_RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+
+class BEAError(Exception):
+    """
+    Raised when a linecode could not be retrieved, so a gdp load fails rather than silently missing a column
+    """
+    pass
+
 
 def get_bea_user_id():
     with open("request_info.json", 'r') as f:
         request_info = json.load(f)
         return request_info['keys']['bea_user_id']
 
-def get_gdp_data(for_):
+def get_gdp_data(for_, workers=4):
     """
     This function gets the last 5 years of GDP data for either the states or counties as according
-    to the tables and linecodes as specified in request_info.json
+    to the tables and linecodes as specified in request_info.json. The linecodes are requested concurrently
+    (within the BEA rate limits, see rate_limiter.py) and yielded in order.
 
     @param for_: "STATE" or "COUNTY"
+    @param workers: The number of concurrent requests
+
+    @raise BEAError: if a linecode could not be retrieved
     """
     if not isinstance(for_, str):
         raise TypeError("for_ must be a string")
@@ -28,17 +53,86 @@ def get_gdp_data(for_):
     if for_ not in ["STATE", "COUNTY"]:
         raise ValueError("for_ must be either 'STATE' or 'COUNTY'")
 
-    user_id = get_bea_user_id()
-    tables_linecodes = get_bea_tables_and_linecodes_combined()
-
-    for table_linecode in tables_linecodes:
-        url_table, url_line_code = table_linecode.split('_')
-        url = f"https://apps.bea.gov/api/data/?&UserID={user_id}&method=GetData&datasetname=Regional&TableName={url_table}&LineCode={url_line_code}&GeoFIPS={for_}&Year=LAST5"
-        response = requests.get(url)
-        if response.status_code == 200:
-            response = response.json()
-            for data in response["BEAAPI"]["Results"]["Data"]:
-                yield data
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for content in executor.map(lambda x: fetch_gdp_linecode(for_, x), get_bea_tables_and_linecodes_combined()):
+            yield from parse_gdp_response(content)
+
+
+def fetch_gdp_linecode(for_, table_linecode):
+    """
+    Downloads the last 5 years of one table_linecode without decoding it (see pipeline.py).
+    Failed requests, including the BEAAPI.Error responses BEA sends with a 200 status, are retried.
+
+    @param for_: "STATE" or "COUNTY"
+    @param table_linecode: e.g. "CAGDP9_1"
+
+    @return: The content (bytes) of the response
+
+    @raise BEAError: if the table_linecode still fails after BEA_MAX_ATTEMPTS requests
+    """
+    url = get_gdp_url(for_.upper(), table_linecode)
+    for attempt in range(BEA_MAX_ATTEMPTS):
+        delay = BEA_RETRY_DELAY * 2**attempt
+        acquire(url)
+        try:
+            response = requests.get(url)
+        except requests.RequestException as e:
+            error = f"{type(e).__name__}: {e}"
+        else:
+            if response.status_code == 200:
+                error = get_bea_error(response.content)
+                if error is None:
+                    return response.content
+            elif response.status_code in BEA_RETRY_STATUSES:
+                error = f"HTTP {response.status_code}"
+                if response.headers.get("Retry-After", "").isdigit():
+                    delay = int(response.headers["Retry-After"])
+            else:
+                raise BEAError(f"{for_} {table_linecode}: HTTP {response.status_code}")
+        print(f"{for_} {table_linecode}: {error} (attempt {attempt + 1} of {BEA_MAX_ATTEMPTS})")
+        if attempt + 1 < BEA_MAX_ATTEMPTS:
+            time.sleep(delay)
+    raise BEAError(f"{for_} {table_linecode}: {error}")
+
+
+def get_bea_error(content):
+    """
+    @param content: The content of a 200 response of the BEA API
+
+    @return: The description of the error reported in the response (BEAAPI.Error or BEAAPI.Results.Error),
+             or None if the response has no error
+    """
+    if b'"Error"' not in content: # <- only decoded here when it can be an error, the data is decoded by the parser
+        return None
+    data = json.loads(content).get("BEAAPI", {})
+    error = data.get("Error") or (data.get("Results") or {}).get("Error")
+    if not error:
+        return None
+    if isinstance(error, list):
+        error = error[0]
+    return f"BEAAPI.Error {error.get('APIErrorCode', '')}: {error.get('APIErrorDescription', '')}"
+
+
+def parse_gdp_response(content):
+    """
+    Decodes a whole response at once: it runs in a parser process of the pipeline (see pipeline.py), which returns
+    the items as one list anyway, so decoding it incrementally would not lower the memory held per linecode.
+
+    @param content: The content returned by fetch_gdp_linecode
+
+    @return: A list of the data items (dicts) of the response
+    """
+    data = json.loads(content)
+    for key in ["BEAAPI", "Results", "Data"]:
+        if not isinstance(data, dict) or key not in data:
+            return []
+        data = data[key]
+    return data
+
+
+def get_gdp_url(for_, table_linecode):
+    url_table, url_line_code = table_linecode.split('_')
+    return f"{BEA_API_URL}/api/data/?&UserID={get_bea_user_id()}&method=GetData&datasetname=Regional&TableName={url_table}&LineCode={url_line_code}&GeoFIPS={for_}&Year=LAST5"
 
 
 def get_bea_tables_and_linecodes_combined():
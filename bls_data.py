@@ -5,15 +5,74 @@ Specfically:
     County Unemployment Rate
     County Workers Data
 
-NOTE: The BLS API cannot request more than 50 series at a time. 
+NOTE: The BLS API cannot request more than 50 series (or 20 years) at a time. 
+The county series can also be read from the LAUS flat files instead, which have no such limits.
 
 Author: Nikolas Kovacs
 """
 
-from urllib.error import HTTPError
+import io
+import os
 import requests
 import json
-import pandas as pd
+import tempfile
+import time
+import zipfile
+from datetime import date
+from rate_limiter import acquire
+from qcew_cache import get_missing_files, record_missing_file, get_latest_quarter, set_latest_quarter
+
+# base urls of the APIs, can be pointed somewhere else (e.g. mock_api_server.py) with environment variables
+BLS_API_URL = os.environ.get("BLS_API_URL", "https://api.bls.gov")
+QCEW_URL = os.environ.get("QCEW_URL", "https://data.bls.gov")
+LAUS_URL = os.environ.get("LAUS_URL", "https://download.bls.gov")
+
+BLS_TIMESERIES_URL = f"{BLS_API_URL}/publicAPI/v2/timeseries/data/"
+# a timeseries request answered with one of BLS_RETRY_STATUSES is made up to BLS_MAX_ATTEMPTS times, waiting
+# BLS_RETRY_DELAY * 2^attempt seconds (or the Retry-After) in between. Any other error status fails at once
+BLS_MAX_ATTEMPTS = 4
+BLS_RETRY_DELAY = 5 # seconds
+BLS_RETRY_STATUSES = [429, 500, 502, 503, 504]
+# with a registration key, BLS v2 returns up to 20 years per request
+BLS_MAX_YEARS_PER_REQUEST = 20
+
+# the LAUS flat file with every county series (all measures, every year since 1990), tab separated
+LAUS_COUNTY_FILE_URL = f"{LAUS_URL}/pub/time.series/la/la.data.64.County"
+# the downloaded flat files are kept here with their ETag/Last-Modified, so they are only downloaded again once changed
+LAUS_CACHE_DIR = "laus_cache"
+# the measure codes of the LAUS series (the last 2 characters of the series id)
+LAUS_UNEMPLOYMENT_RATE = "03"
+LAUS_LABOR_FORCE = "06"
+
+QCEW_AREA_URL = QCEW_URL + "/cew/data/api/{year}/{qtr}/area/{area}.csv"
+QCEW_SINGLEFILE_URL = QCEW_URL + "/cew/data/files/{year}/csv/{year}_qtrly_singlefile.zip"
+# the schema of the QCEW csv columns that are loaded into the employment tables (in table order)
+EMPLOYMENT_DTYPES = {
+    "area_fips": "string",
+    "own_code": "int8",
+    "industry_code": "category",
+    "agglvl_code": "int16",
+    "size_code": "int8",
+    "year": "int16",
+    "qtr": "int8",
+    "disclosure_code": "category",
+    "qtrly_estabs": "int32",
+    "month1_emplvl": "int32",
+    "month2_emplvl": "int32",
+    "month3_emplvl": "int32",
+    "total_qtrly_wages": "int64",
+    "taxable_qtrly_wages": "int64",
+    "qtrly_contributions": "int64",
+    "avg_wkly_wage": "int32",
+}
+EMPLOYMENT_COLUMNS = list(EMPLOYMENT_DTYPES)
+# built once and shared by every QCEW read, so no file is type-inferred or parses columns that are thrown away
+EMPLOYMENT_READ_OPTIONS = {
+    "usecols": EMPLOYMENT_COLUMNS,
+    "dtype": EMPLOYMENT_DTYPES,
+    "keep_default_na": False,
+    "na_values": {"disclosure_code": [""]},
+}
 
 def get_bls_key():
     """
@@ -26,6 +85,21 @@ def get_bls_key():
     return bls_key
 
 
+def get_year_windows(start_year, end_year, max_years=BLS_MAX_YEARS_PER_REQUEST):
+    """
+    This generator splits the years from start_year through end_year into the fewest windows
+    that can each be requested in a single BLS request.
+
+    @param start_year: The first year
+    @param end_year: The last year
+    @param max_years: The most years allowed per request
+
+    @return: A generator that yields tuples of (window_start, window_end)
+    """
+    for window_start in range(start_year, end_year + 1, max_years):
+        yield window_start, min(window_start + max_years - 1, end_year)
+
+
 def get_unemployment_data(state_codes=None, county_codes=None, start_year=None, end_year=None) -> dict:
     """
     This function retrieves the unemployment data for the specified states or counties.
@@ -68,14 +142,7 @@ def get_unemployment_data(state_codes=None, county_codes=None, start_year=None,
             codes.append(f"{series_type}{st_code}{cn_code}0000000003")
         return codes
     
-    return requests.post("https://api.bls.gov/publicAPI/v2/timeseries/data/",
-    json={
-        "seriesid":generate_state_county_codes(state_codes, county_codes), 
-        "startyear":f"{start_year}", "endyear":f"{end_year}",
-        "catalog":False, "calculations":False, "annualaverage":False,"aspects":False,
-        "registrationkey":get_bls_key()
-        }
-    ).json()
+    return post_timeseries(generate_state_county_codes(state_codes, county_codes), start_year, end_year)
 
     
 
@@ -109,14 +176,39 @@ def get_county_workers(state_codes, county_codes, start_year, end_year):
             state_county_codes_for_workers.append(f"LAUCN{state_code}{county_code}0000000006")
         return state_county_codes_for_workers
 
-    return requests.post("https://api.bls.gov/publicAPI/v2/timeseries/data/",
-        json={
-            "seriesid":generate_state_county_codes_for_workers(state_codes, county_codes), 
-            "startyear":f"{start_year}", "endyear":f"{end_year}",
-            "catalog":False, "calculations":False, "annualaverage":False,"aspects":False,
-            "registrationkey":get_bls_key()
-            }
-        ).json()
+    return post_timeseries(generate_state_county_codes_for_workers(state_codes, county_codes), start_year, end_year)
+
+
+def post_timeseries(series_ids, start_year, end_year):
+    """
+    This function requests timeseries from the BLS API. Requests answered with one of BLS_RETRY_STATUSES
+    (rate limited or a server error) are retried, so their non-JSON body is never decoded.
+
+    @param series_ids: The ids of the series (50 or less)
+    @param start_year: The start year of the data
+    @param end_year: The end year of the data
+
+    @return: A dictionary(JSON) containing the timeseries data
+
+    @raise requests.HTTPError: if the request fails with another error status, or still fails after BLS_MAX_ATTEMPTS requests
+    """
+    for attempt in range(BLS_MAX_ATTEMPTS):
+        acquire(BLS_TIMESERIES_URL)
+        response = requests.post(BLS_TIMESERIES_URL,
+            json={
+                "seriesid":series_ids,
+                "startyear":f"{start_year}", "endyear":f"{end_year}",
+                "catalog":False, "calculations":False, "annualaverage":False,"aspects":False,
+                "registrationkey":get_bls_key()
+                }
+            )
+        if response.status_code not in BLS_RETRY_STATUSES or attempt + 1 == BLS_MAX_ATTEMPTS:
+            response.raise_for_status()
+            return response.json()
+        retry_after = response.headers.get("Retry-After", "")
+        delay = int(retry_after) if retry_after.isdigit() else BLS_RETRY_DELAY * 2**attempt
+        print(f"BLS timeseries: HTTP {response.status_code} (attempt {attempt + 1} of {BLS_MAX_ATTEMPTS})")
+        time.sleep(delay)
 
 def get_employment_data(for_, start_year, end_year, state_codes=None, county_codes_list=None):
     """
@@ -132,6 +224,25 @@ def get_employment_data(for_, start_year, end_year, state_codes=None, county_cod
 
     @return: A dataframe containing the data for the specified years and for the specified for.
     """
+    latest_quarter, missing = get_latest_qcew_quarter(), get_missing_files()
+    for area, year, qtr in get_employment_units(for_, start_year, end_year, state_codes, county_codes_list, latest_quarter):
+        if (area, year, qtr) in missing:
+            continue
+        output = get_employment_file(area, year, qtr)
+        if output is not None:
+            yield output
+
+
+def get_employment_units(for_, start_year, end_year, state_codes=None, county_codes_list=None, latest_quarter=None):
+    """
+    This generator yields every (area, year, qtr) work unit that get_employment_data requests.
+    Takes the same arguments as get_employment_data, and:
+
+    @param latest_quarter: optional (year, qtr) of the latest published quarter (see get_latest_qcew_quarter),
+                           the quarters after it are left out
+
+    @return: A generator of (area, year, qtr) tuples where area is the QCEW area file name (e.g. "01001")
+    """
     files = []
     if for_.lower() == "us":
         files.append("US000")
@@ -152,13 +263,214 @@ def get_employment_data(for_, start_year, end_year, state_codes=None, county_cod
     for file in files:
         for year in range(start_year, end_year + 1):
             for qtr in range(1,5):
-                print(f"Year: {year}, Quarter: {qtr}, File: {file}")
-                try:
-                    output = pd.read_csv(f"http://data.bls.gov/cew/data/api/{year}/{qtr}/area/{file}.csv")
-                except HTTPError:
-                    continue
-                yield output
-    
+                if latest_quarter is None or (year, qtr) <= tuple(latest_quarter):
+                    yield file, year, qtr
+
+
+def get_employment_file(area, year, qtr):
+    """
+    This function retrieves a single QCEW area file.
 
+    @param area: The QCEW area file name (e.g. "US000", "01000", "01001")
+    @param year: The year of the data
+    @param qtr: The quarter of the data
 
+    @return: A dataframe with the EMPLOYMENT_COLUMNS, or None if the file does not exist
+    """
+    return parse_employment_file(fetch_employment_file(area, year, qtr))
+
+
+def fetch_employment_file(area, year, qtr):
+    """
+    The download half of get_employment_file (see pipeline.py).
+    A 404 for a published quarter is remembered (see qcew_cache.py), so the file is not requested again for a while.
+
+    @return: The content (bytes) of the QCEW area file, or None if the file does not exist
+    """
+    print(f"Year: {year}, Quarter: {qtr}, File: {area}")
+    response = requests.get(QCEW_AREA_URL.format(area=area, year=year, qtr=qtr))
+    if response.status_code == 404:
+        latest = get_latest_quarter()
+        if latest and (year, qtr) <= tuple(latest[:2]): # <- a quarter that is not published yet will be
+            record_missing_file(area, year, qtr)
+    if response.status_code != 200:
+        return None
+    return response.content
+
+
+def get_latest_qcew_quarter():
+    """
+    This function finds the latest published QCEW quarter by probing the US file of the quarter after the
+    latest one known, which is a single request once the latest quarter has been found. The result is kept for
+    the day (see qcew_cache.py).
+
+    @return: tuple of (year, qtr), or None if no recent quarter could be found (then no quarter should be left out)
+    """
+    today = date.today()
+    cached = get_latest_quarter()
+    if cached and cached[2] == today.isoformat():
+        return cached[0], cached[1]
+
+    def exists(year, qtr):
+        print(f"Probing QCEW Year: {year}, Quarter: {qtr}")
+        with requests.get(QCEW_AREA_URL.format(area="US000", year=year, qtr=qtr), stream=True) as response:
+            return response.status_code == 200
+    def step(year, qtr, n):
+        index = year * 4 + qtr - 1 + n
+        return index // 4, index % 4 + 1
+
+    current_quarter = (today.year, (today.month - 1) // 3 + 1)
+    probe_next = True
+    if cached:
+        year, qtr = cached[0], cached[1]
+    else:
+        # a quarter is usually published 5 to 6 months after it ends
+        year, qtr = step(*current_quarter, -2)
+        for i in range(8):
+            if exists(year, qtr):
+                probe_next = i == 0 # <- otherwise the next quarter was just found missing
+                break
+            year, qtr = step(year, qtr, -1)
+        else:
+            return None
+    while probe_next and step(year, qtr, 1) < current_quarter and exists(*step(year, qtr, 1)):
+        year, qtr = step(year, qtr, 1)
+    set_latest_quarter(year, qtr)
+    return year, qtr
+
+
+def parse_employment_file(content):
+    """
+    The parsing half of get_employment_file (see pipeline.py).
+
+    @param content: The content returned by fetch_employment_file
+
+    @return: A dataframe with the EMPLOYMENT_COLUMNS, or None if content is None
+    """
+    if content is None:
+        return None
+    import pandas as pd # <- imported when needed, so importing this module stays light
+
+    return pd.read_csv(io.BytesIO(content), **EMPLOYMENT_READ_OPTIONS)[EMPLOYMENT_COLUMNS]
+
+
+def get_employment_singlefile(year, areas, chunksize=500000):
+    """
+    This generator downloads the QCEW quarterly singlefile archive for a year (every area, every quarter) once,
+    decompresses it as a stream and yields the rows of the wanted areas, one chunk at a time.
+
+    @param year: The year of the data
+    @param areas: The QCEW area codes to keep (e.g. "US000", "01000", "01001")
+    @param chunksize: The number of csv rows parsed at a time
+
+    @return: A generator of dataframes with the EMPLOYMENT_COLUMNS. Yields nothing if the archive is not published.
+    """
+    import pandas as pd
+
+    areas = set(areas)
+    url = QCEW_SINGLEFILE_URL.format(year=year)
+    print(f"Year: {year}, File: {url}")
+    with requests.get(url, stream=True) as response:
+        if response.status_code != 200:
+            return
+        # zip archives keep their index at the end, so the download is spooled to disk rather than memory
+        with tempfile.TemporaryFile() as archive:
+            for block in response.iter_content(chunk_size=1 << 20):
+                archive.write(block)
+            archive.seek(0)
+            with zipfile.ZipFile(archive) as zf, zf.open(zf.namelist()[0]) as csv:
+                for chunk in pd.read_csv(csv, chunksize=chunksize, **EMPLOYMENT_READ_OPTIONS):
+                    chunk = chunk[chunk["area_fips"].isin(areas)]
+                    if len(chunk):
+                        yield chunk[EMPLOYMENT_COLUMNS]
+
+
+def download_laus_file(url=LAUS_COUNTY_FILE_URL, cache_dir=LAUS_CACHE_DIR):
+    """
+    This function downloads a LAUS flat file into the cache directory, streaming it to disk.
+    When the file was downloaded before, the request is conditional (If-None-Match/If-Modified-Since), so an
+    unchanged file is not downloaded again.
+
+    NOTE: download.bls.gov rejects requests without a User-Agent identifying the requester, which is
+    taken from the optional "contact_email" of request_info.json
+
+    @param url: The url of the flat file
+    @param cache_dir: The directory the file is kept in
+
+    @return: The path of the (cached) file
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, url.rsplit('/', 1)[-1])
+    meta_path = path + ".json"
+
+    headers = {"User-Agent": "db_updater"}
+    with open('request_info.json') as f:
+        contact = json.load(f).get("contact_email")
+    if contact:
+        headers["User-Agent"] = f"db_updater ({contact})"
+    meta = {}
+    if os.path.exists(path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    print(f"File: {url}")
+    acquire(url)
+    with requests.get(url, headers=headers, stream=True) as response:
+        if response.status_code == 304:
+            return path
+        response.raise_for_status()
+        # written next to the cached file and swapped in once complete, so an interrupted download keeps the old file
+        with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as f:
+            try:
+                for block in response.iter_content(chunk_size=1 << 20):
+                    f.write(block)
+            except BaseException:
+                f.close()
+                os.remove(f.name)
+                raise
+        os.replace(f.name, path)
+        with open(meta_path, 'w') as f:
+            json.dump({"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}, f)
+    return path
+
+
+def get_laus_county_data(measure_code, start_year, end_year, areas=None, chunksize=500000):
+    """
+    This generator reads the monthly values of one measure for every county from the LAUS county flat file
+    (see download_laus_file), filtering each chunk of the file in a single vectorized pass.
+
+    @param measure_code: The measure of the series, e.g. LAUS_UNEMPLOYMENT_RATE or LAUS_LABOR_FORCE
+    @param start_year: The start year of the data
+    @param end_year: The end year of the data
+    @param areas: The state + county codes to keep (e.g. "01001"), None -> every county
+    @param chunksize: The number of lines parsed at a time
+
+    @return: A generator of dataframes with the columns state, county, year, period, value (NaN if not available),
+             in the same shape as the rows of the timeseries API
+    """
+    import pandas as pd
 
+    path = download_laus_file()
+    areas = None if areas is None else set(areas)
+    # series_id year period value footnote_codes, with the series ids and values padded with spaces
+    for chunk in pd.read_csv(path, sep="\t", usecols=[0, 1, 2, 3], names=["series_id", "year", "period", "value"],
+                             header=0, dtype=str, chunksize=chunksize):
+        series_id = chunk["series_id"].str.strip()
+        year = chunk["year"].astype("int16")
+        keep = (series_id.str[-2:] == measure_code) & year.between(start_year, end_year) & (chunk["period"] != "M13") # <- M13 is the annual average
+        if areas is not None:
+            keep &= series_id.str[5:10].isin(areas)
+        if not keep.any():
+            continue
+        series_id = series_id[keep]
+        yield pd.DataFrame({
+            "state": series_id.str[5:7],
+            "county": series_id.str[7:10],
+            "year": year[keep],
+            "period": chunk["period"][keep],
+            "value": pd.to_numeric(chunk["value"][keep].str.strip(), errors="coerce"), # <- "-" when not available
+        })
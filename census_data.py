@@ -11,7 +11,18 @@ Specfically:
 Author: Nikolas Kovacs
 """
 import json
+import os
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from rate_limiter import acquire
+from streaming_json import iter_json_items
+
+# base url of the API, can be pointed somewhere else (e.g. mock_api_server.py) with an environment variable
+CENSUS_API_URL = os.environ.get("CENSUS_API_URL", "https://api.census.gov")
+# the census api rejects requests for more than 50 variables (NAME and YEAR included)
+CENSUS_MAX_VARIABLES = 50
+# the statuses the census api answers with when there is no data (e.g. a year that is not released yet)
+CENSUS_NO_DATA_STATUSES = [204, 404]
 
 def get_census_timeseries(for_, type_, start_year, end_year):
     """
@@ -24,6 +35,23 @@ def get_census_timeseries(for_, type_, start_year, end_year):
 
     @return: A list (json) containing the requested data
     """
+    output = []
+    for year in range(start_year, end_year+1):
+        rows = list(iter_census_timeseries(for_, type_, year))
+        if rows:
+            output.append(rows)
+    return output
+
+def iter_census_timeseries(for_, type_, year):
+    """
+    This generator requests one year of time series data from the census API and decodes the response as a stream.
+    Takes the same for_ and type_ as get_census_timeseries.
+
+    @param year: The year of the data
+
+    @return: A generator that yields the header row and then the data rows. Yields nothing if there is no data
+             (e.g. the year is not released yet), see fetch_census_rows.
+    """
     if for_.lower() != "counties" and for_.lower() != "states":
         raise ValueError("for_ must be either 'states' or 'counties'")
     if type_.lower() != "poverty":
@@ -36,18 +64,11 @@ def get_census_timeseries(for_, type_, start_year, end_year):
         for_ = "county"
         in_keyword = get_in_keyword_val_for_states()
 
-    with open("request_info.json", 'r') as f:
-        request_info = json.load(f)
-        tables = request_info['tables']["poverty_tables"]
-        tables = ','.join([x.split(',')[0] for x in tables])
-    
-    output = []
-    for year in range(start_year, end_year+1):
-        api_url = f"https://api.census.gov/data/timeseries/poverty/saipe?get={tables},YEAR,NAME&for={for_}:*&time={year}{in_keyword}&key={get_census_key()}"
-        response = requests.get(api_url)
-        if response.status_code == 200:
-            output.append(response.json())
-    return output
+    census_key = get_census_key()
+    def get_url(variables):
+        return f"{CENSUS_API_URL}/data/timeseries/poverty/saipe?get={','.join(variables)}&for={for_}:*&time={year}{in_keyword}&key={census_key}"
+
+    yield from iter_census_rows(get_url, get_poverty_variables())
 
 def get_census_data(for_, start_year, end_year):
     """
@@ -59,6 +80,24 @@ def get_census_data(for_, start_year, end_year):
 
     @return: A list(json) containing the requested data
     """
+    output = []
+    for year in range(start_year, end_year + 1):
+        rows = list(iter_census_data(for_, year))
+        if rows:
+            output.append(rows)
+    return output
+
+def iter_census_data(for_, year):
+    """
+    This generator requests one year of non-timeseries data from the census API and decodes the response as a stream,
+    so the rows can be inserted while the rest of the response is still downloading.
+    Takes the same for_ as get_census_data.
+
+    @param year: The year of the data
+
+    @return: A generator that yields the header row and then the data rows, each with the year appended.
+             Yields nothing if there is no data (e.g. the year is not released yet), see fetch_census_rows.
+    """
     # set up for_ and in_keyword variables
     in_keyword = ""
     if for_.lower() == "states":
@@ -75,19 +114,82 @@ def get_census_data(for_, start_year, end_year):
     else:
         raise ValueError("for_ must be either 'states' or 'counties' or 'school_districts' or 'zipcodes'")
 
-    output = []
-    for year in range(start_year, end_year + 1):
-        api_url = f"https://api.census.gov/data/{year}/acs/acs5/profile?get={get_appropriate_tables(for_)},NAME&for={for_}:*{in_keyword}&key={get_census_key()}"
-        response = requests.get(api_url)
-        if response.status_code == 200:
-            response = response.json()
-            # add year to the data
-            response[0].append("year")
-            for i in range(1, len(response)):
-                response[i].append(year)
-            output.append(response)
-    return output
-    
+    census_key = get_census_key()
+    def get_url(variables):
+        return f"{CENSUS_API_URL}/data/{year}/acs/acs5/profile?get={','.join(variables)}&for={for_}:*{in_keyword}&key={census_key}"
+
+    rows = iter_census_rows(get_url, get_appropriate_variables(for_) + ["NAME"])
+    # add year to the data
+    header = next(rows, None)
+    if header is None:
+        return
+    yield header + ["year"]
+    for row in rows:
+        yield row + [year]
+
+
+def iter_census_rows(get_url, variables):
+    """
+    This generator requests the variables from the census API in groups of at most CENSUS_MAX_VARIABLES.
+    A single group is decoded as a stream. Several groups are fetched concurrently and their columns are joined
+    back per geography key (the columns the API appends after the requested variables) in memory.
+
+    @param get_url: function taking a list of variables and returning the api url requesting them
+    @param variables: list of the variables to request, in the order of the columns
+
+    @return: A generator that yields the header row (the variables, then the geography columns) and then the data rows.
+             Yields nothing if any of the requests has no data, see fetch_census_rows.
+    """
+    groups = split_variables(variables)
+    if len(groups) == 1:
+        yield from fetch_census_rows(get_url(groups[0]))
+        return
+
+    with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+        results = list(executor.map(lambda group: list(fetch_census_rows(get_url(group))), groups))
+    if not all(results):
+        return
+
+    geo_columns = results[0][0][len(groups[0]):]
+    joined = {}
+    for i, (group, rows) in enumerate(zip(groups, results)):
+        key_indexes = [rows[0].index(x) for x in geo_columns]
+        for row in rows[1:]:
+            key = tuple(row[x] for x in key_indexes)
+            joined.setdefault(key, [None] * len(groups))[i] = row[:len(group)]
+
+    yield variables + geo_columns
+    for key, parts in joined.items():
+        row = []
+        for group, part in zip(groups, parts):
+            row += part if part is not None else [None] * len(group)
+        yield row + list(key)
+
+
+def fetch_census_rows(api_url):
+    """
+    @param api_url: the api url
+
+    @return: A generator that yields the header row and then the data rows.
+             Yields nothing if there is no data (one of CENSUS_NO_DATA_STATUSES).
+
+    @raise requests.HTTPError: if the request fails with any other error status, so a failed year is not taken for
+                               one that is not released yet and left out of the table
+    """
+    acquire(api_url)
+    with requests.get(api_url, stream=True) as response:
+        if response.status_code in CENSUS_NO_DATA_STATUSES:
+            return
+        response.raise_for_status()
+        yield from iter_json_items(response, "item")
+
+
+def split_variables(variables, max_variables=CENSUS_MAX_VARIABLES):
+    """
+    @return: list of the groups (lists) of at most max_variables variables, in order
+    """
+    return [variables[i:i+max_variables] for i in range(0, len(variables), max_variables)]
+
 
 def get_appropriate_tables(for_):
     """
@@ -97,6 +199,13 @@ def get_appropriate_tables(for_):
 
     @return: A string of tables to be used in the api call
     """
+    return ",".join(get_appropriate_variables(for_))
+
+
+def get_appropriate_variables(for_):
+    """
+    Same as get_appropriate_tables, but returns a list of the variables
+    """
     with open('request_info.json', 'r') as f:
         request_info = json.load(f)
         if for_ == "state" or for_ == "county":
@@ -106,8 +215,17 @@ def get_appropriate_tables(for_):
         else:
             tables = request_info['tables']["zipcode_tables"]
 
-    # convert tables from list of str to str with each element separated by comma
-    return ",".join([x.split(',')[0] for x in tables])
+    return [x.split(',')[0] for x in tables]
+
+
+def get_poverty_variables():
+    """
+    @return: list of the variables requested for the poverty time series (YEAR and NAME included)
+    """
+    with open('request_info.json', 'r') as f:
+        request_info = json.load(f)
+        tables = request_info['tables']["poverty_tables"]
+    return [x.split(',')[0] for x in tables] + ["YEAR", "NAME"]
 
 
 def get_census_key():
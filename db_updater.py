@@ -5,113 +5,215 @@ Double click or run with no args for GUI interface.
 
 Author: Nikolas Kovacs
 """
-from api_db_mediator import API_DB_Mediator
 import argparse
-import threading
-
-def update(tables_to_update, table_args, ui=None):
-    def update_table(method_args, event_to_set):
-        if len(method_args) == 1: # method takes no args
-            method_args[0]()
-        else:
-            method_args[0](method_args[1])
-        event_to_set.set()
-
-    def update_ui(ui, table_to_update, stop, end_thread_event):
-        # time_estimates = get_estimate_times_for_updates()
-        still_updating = True
-        progress_bar = 0
-        while still_updating and not stop():
-            if progress_bar < 100:
-                ui.progressChanged.emit(progress_bar + 1) # temporary solution until we have estimated times
-                progress_bar += 1
-                time.sleep(0.2)
-            else:
-                still_updating = False
-            ui.update_label(f"Updating {table_to_update}... Do not close this window.")
-        end_thread_event.set()
-    
-
-
-    for table_to_update in tables_to_update:
-        ui_stop_thread_event = threading.Event()
-        ui_thread_ended_event = threading.Event()
-        ui_stop_thread = False
-
-        if ui:
-            ui_updater_thread = threading.Thread(target=update_ui, args=(ui, table_to_update, lambda: ui_stop_thread, ui_thread_ended_event), daemon=True, name="ui_updater_thread")
-            ui_updater_thread.start()
-
-        update_table(table_args[table_to_update], ui_stop_thread_event)
-        
-        ui_stop_thread_event.wait()
-        ui_stop_thread = True
-        ui_thread_ended_event.wait()
-    
-    if ui:
-        ui.progressChanged.emit(100)
-        time.sleep(0.5)
-        ui.update_label("Done updating. You may close this window.")
-
-
-def get_estimate_times_for_updates():
-    pass
+import multiprocessing
+import time
+
+def update(tables_to_update, table_args, db=None, progress=None, status=None, cancel_event=None, rollups=True,
+        profile=None, trace_memory=False):
+    """
+    Updates the given tables one after another.
+
+    @param tables_to_update: list of the table names (keys of table_args)
+    @param table_args: the dict returned by init_args
+    @param db: the API_DB_Mediator the table_args belong to (needed for status and cancellation)
+    @param progress: optional function that takes the overall progress (0-100)
+    @param status: optional function that takes a status message
+    @param cancel_event: optional threading.Event that cancels the update between batches when set
+    @param rollups: whether to refresh the rollups whose sources changed once the tables are updated
+    @param profile: None, "cprofile" or "sample", profiles each table (see profiling.py)
+    @param trace_memory: whether to trace the allocations of each table with tracemalloc
+    """
+    from api_db_mediator import LoadCancelled
+    from profiling import profile_table
+
+    progress = progress or (lambda value: None)
+    status = status or (lambda message: None)
+    if db:
+        db.cancel_event = cancel_event
+        db.progress_callback = lambda table, unit: status(f"Updating {table} ({unit} done)... Do not close this window.")
+
+    try:
+        for i, table_to_update in enumerate(tables_to_update):
+            progress(int(100 * i / len(tables_to_update)))
+            status(f"Updating {table_to_update}... Do not close this window.")
+            start_time, start_rows = time.time(), db.rows_inserted if db else 0
+            method_args = table_args[table_to_update]
+            with profile_table(table_to_update, profile, trace_memory):
+                if len(method_args) == 1: # method takes no args
+                    method_args[0]()
+                else:
+                    method_args[0](method_args[1])
+            if db:
+                record_table_metrics(table_to_update, db, time.time() - start_time, db.rows_inserted - start_rows)
+        if db and rollups:
+            status("Refreshing rollups...")
+            db.refresh_rollups()
+    except LoadCancelled:
+        status("Update cancelled. Run the update with --resume to continue where it stopped.")
+        return
+
+    progress(100)
+    failures = db.get_target_failures() if db else {}
+    if failures:
+        status(f"Done updating, but {', '.join(failures)} failed and must be reloaded. You may close this window.")
+    else:
+        status("Done updating. You may close this window.")
+
+
+def record_table_metrics(table, db, seconds, rows):
+    """
+    Records the totals of a finished table load, which --plan uses to estimate future loads.
+    Loads made of several tables (initalize_all, all_employment, all_gdp) are not recorded.
+    """
+    from planner import record_metrics, count_requests, TABLE_SOURCES
+    if table in TABLE_SOURCES and not db.resume and not db.queue_mode: # <- a resumed or queued load only makes part of the requests
+        record_metrics(table, count_requests(table, db.backfill_start_year, db.employment_source, db.laus_source), rows, seconds)
+
+# table name -> [name of the API_DB_Mediator method that initializes it, optional argument]
+# (method names rather than bound methods, so the arguments can be parsed before the database is connected)
+TABLE_METHODS = {
+    "initalize_all": ["initialize_db"],
+    "states": ["_API_DB_Mediator__init_states_table"],
+    "counties": ["_API_DB_Mediator__init_counties_table"],
+    "county_unemployment": ["_API_DB_Mediator__init_county_unemployment_table"],
+    "state_unemployment": ["_API_DB_Mediator__init_state_unemployment_table"],
+    "county_workers": ["_API_DB_Mediator__init_county_workers_table"],
+    "county_employment": ["_API_DB_Mediator__init_employment_table", "COUNTY"],
+    "state_employment": ["_API_DB_Mediator__init_employment_table", "STATE"],
+    "us_employment": ["_API_DB_Mediator__init_employment_table", "US"],
+    "all_employment": ["_API_DB_Mediator__init_employment_tables"],
+    "county_data": ["_API_DB_Mediator__init_census_county_data_table"],
+    "state_data": ["_API_DB_Mediator__init_census_state_data_table"],
+    "county_poverty": ["_API_DB_Mediator__init_census_county_poverty_table"],
+    "state_poverty": ["_API_DB_Mediator__init_census_state_poverty_table"],
+    "school_districts": ["_API_DB_Mediator__init_census_school_districts_table"],
+    "zipcodes": ["_API_DB_Mediator__init_zipcodes_table"],
+    "county_gdp": ["_API_DB_Mediator__init_gdp_table", "COUNTY"],
+    "state_gdp": ["_API_DB_Mediator__init_gdp_table", "STATE"],
+    "all_gdp": ["_API_DB_Mediator__init_gdp_tables"],
+    "rollups": ["refresh_rollups", True], # <- rebuilds every rollup
+}
+
+# the tables whose loads can be spread over workers with --queue
+QUEUE_TABLES = ["us_employment", "state_employment", "county_employment", "state_unemployment", "county_unemployment", "county_workers"]
 
 def init_args(db):
-    return {
-        "initalize_all": [db.initialize_db],
-        "states": [db._API_DB_Mediator__init_states_table],
-        "counties": [db._API_DB_Mediator__init_counties_table],
-        "county_unemployment": [db._API_DB_Mediator__init_county_unemployment_table],
-        "state_unemployment": [db._API_DB_Mediator__init_state_unemployment_table],
-        "county_workers": [db._API_DB_Mediator__init_county_workers_table],
-        "county_employment": [db._API_DB_Mediator__init_employment_table, "COUNTY"],
-        "state_employment": [db._API_DB_Mediator__init_employment_table, "STATE"],
-        "us_employment": [db._API_DB_Mediator__init_employment_table, "US"],
-        "county_data": [db._API_DB_Mediator__init_census_county_data_table],
-        "state_data": [db._API_DB_Mediator__init_census_state_data_table],
-        "county_poverty": [db._API_DB_Mediator__init_census_county_poverty_table],
-        "state_poverty": [db._API_DB_Mediator__init_census_state_poverty_table],
-        "school_districts": [db._API_DB_Mediator__init_census_school_districts_table],
-        "zipcodes": [db._API_DB_Mediator__init_zipcodes_table],
-        "county_gdp": [db._API_DB_Mediator__init_gdp_table, "COUNTY"],
-        "state_gdp": [db._API_DB_Mediator__init_gdp_table, "STATE"],
-    }
+    return {table: [getattr(db, method_args[0]), *method_args[1:]] for table, method_args in TABLE_METHODS.items()}
 
-if __name__ == "__main__":
-    db = API_DB_Mediator()
-    table_args = init_args(db)
 
+def get_parser():
     parser = argparse.ArgumentParser(description="CLI for updating tables in the Demographic Database\n"\
         "Run with no arguments to open GUI"\
         "Run with single table argument to update that table"\
         "./db_updater.exe -h for help")
-    parser.add_argument("-t", "--table", type=str, choices=table_args.keys(), help="Enter a table to update")
+    parser.add_argument("-t", "--table", type=str, choices=TABLE_METHODS.keys(), help="Enter a table to update")
+    parser.add_argument("-p", "--plan", action="store_true",
+        help="Print the estimated requests, rows, bytes and duration of the table (or every table) without running it")
+    parser.add_argument("--no-rollups", action="store_true", help="Don't refresh the rollup tables after the update")
+    parser.add_argument("--profile", choices=["cprofile", "sample"],
+        help="Profile each table with cProfile or a stack sampler, writing the reports to profiles/")
+    parser.add_argument("--trace-memory", action="store_true",
+        help="Trace the allocations of each table with tracemalloc, writing the top allocations to profiles/")
+    parser.add_argument("-r", "--resume", action="store_true", help="Resume a failed update, skipping the work already completed")
+    parser.add_argument("-b", "--backfill", type=int, metavar="START_YEAR", help="Load the BLS timeseries tables from START_YEAR instead of the last 3 years")
+    parser.add_argument("-w", "--workers", type=int, default=4, help="Number of concurrent requests per table (default: 4)")
+    parser.add_argument("--parse-workers", type=int, metavar="N",
+        help="Number of processes parsing the QCEW and BEA responses (default: one per cpu, 0: parse in the download threads)")
+    parser.add_argument("-e", "--employment-source", choices=["area", "singlefile"], default="area",
+        help="Load the employment tables from the per-area csv files (default) or the per-year singlefile archives")
+    parser.add_argument("-l", "--laus-source", choices=["api", "flatfile"], default="api",
+        help="Load the county unemployment and workers tables from the BLS timeseries API (default) or the LAUS county flat file")
+    parser.add_argument("-g", "--gdp-format", choices=["wide", "long"], default="wide",
+        help="Store the gdp tables with one column per table_linecode (default) or as a long columnstore table with a wide view")
+    parser.add_argument("-i", "--index-strategy", choices=["upfront", "deferred", "sorted"], default="upfront",
+        help="Create the primary keys with the tables (default), build them after the load, or insert in key order")
+    parser.add_argument("-c", "--connections", type=int, default=1,
+        help="Number of database connections a table load writes through, sharded by state (default: 1)")
+    parser.add_argument("--target", action="append", metavar="CONFIG_FILE",
+        help="Config file of a database to load, repeat to load several databases from the same requests (default: config.json)")
+    parser.add_argument("-y", "--partition-by-year", action="store_true",
+        help="Keep the employment, unemployment, workers, census data and gdp tables partitioned by year and switch the loaded years in")
+    parser.add_argument("--refresh-years", type=int, metavar="N",
+        help="With --partition-by-year, only request the last N years (and the missing years) of a table, keeping the others")
+    parser.add_argument("-q", "--queue", choices=["coordinator", "worker"],
+        help="Load the QCEW area files and BLS series batches of the table through dbo.work_queue: the coordinator creates the table "
+             "and enqueues the units, any number of workers (run with the same table and options) help load them")
+    parser.add_argument("--change-feed", choices=["table", "jsonl"],
+        help="Record the rows inserted, updated and deleted by each load in dbo.change_log or in changes/<table>.jsonl")
+    return parser
+
+
+def create_db(args):
+    """
+    Imports the API_DB_Mediator (and with it pyodbc, pandas, ...), connects to the database and applies the arguments.
+    This is only done once a table is actually updated, so --help, argument errors and opening the gui stay fast.
+
+    @param args: the parsed arguments
+
+    @return: the API_DB_Mediator
+    """
+    from api_db_mediator import API_DB_Mediator
+    db = API_DB_Mediator(resume=args.resume, targets=args.target)
+    db.backfill_start_year = args.backfill
+    db.fetch_workers = args.workers
+    db.parse_workers = args.parse_workers
+    db.employment_source = args.employment_source
+    db.laus_source = args.laus_source
+    db.gdp_format = args.gdp_format
+    db.index_strategy = args.index_strategy
+    db.writer_connections = args.connections
+    db.partition_by_year = args.partition_by_year
+    db.refresh_years = args.refresh_years
+    db.change_feed = args.change_feed
+    db.queue_mode = args.queue
+    return db
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support() # <- the parser processes of the load pipeline re-run the frozen executable
+    parser = get_parser()
     args = parser.parse_args()
     table_to_update = args.table
+    if args.queue and (table_to_update not in QUEUE_TABLES or args.employment_source == "singlefile" or args.laus_source == "flatfile"):
+        parser.error(f"--queue only loads {', '.join(QUEUE_TABLES)}, from the area employment source and the laus api")
+
+    if args.plan:
+        from planner import print_plan, expand_tables
+        print_plan(expand_tables(table_to_update or "initalize_all"),
+            backfill_start_year=args.backfill, employment_source=args.employment_source, laus_source=args.laus_source)
+        raise SystemExit()
 
     # if table argument provided, update that table
     # otherwise, open gui and let user select table(s) to update
     if table_to_update:
-        update([table_to_update], table_args)
+        db = create_db(args)
+        update([table_to_update], init_args(db), db, rollups=not args.no_rollups and args.queue != "worker",
+            profile=args.profile, trace_memory=args.trace_memory)
+        failures = db.get_target_failures()
+        for target, error in failures.items():
+            print(f"{target} failed and must be reloaded: {error}")
+        if failures:
+            raise SystemExit(1)
     else:
+        import os
         import sys
-        import time
         from db_updater_gui import GUI
-        from PyQt5 import QtWidgets
+        from PyQt5 import QtCore, QtWidgets
         app = QtWidgets.QApplication(sys.argv)
         MainWindow = QtWidgets.QMainWindow()
-        ui = GUI(MainWindow)
-        MainWindow.show()
 
-        def try_to_get_tables_and_update():
-            tables_to_update = None
-            while not tables_to_update:
-                tables_to_update = ui.get_tables_to_update()
-                time.sleep(0.5)
-            update(tables_to_update, table_args, ui)
+        dbs = []
+        def run_update(tables, progress, status, cancel_event):
+            if not dbs: # <- connect on the first update, on the worker thread
+                status("Connecting to the database...")
+                dbs.append(create_db(args))
+            update(tables, init_args(dbs[0]), dbs[0], progress, status, cancel_event)
+
+        ui = GUI(MainWindow, run_update)
+        MainWindow.show()
 
-        thread = threading.Thread(target=try_to_get_tables_and_update, daemon=True)
-        thread.start()
+        if os.environ.get("DB_UPDATER_STARTUP_BENCHMARK"):
+            QtCore.QTimer.singleShot(0, app.quit) # <- see startup_benchmark.py
 
         sys.exit(app.exec_())
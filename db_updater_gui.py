@@ -1,28 +1,69 @@
 """
 An exntension of the ui.py output from pyuic5
 
-This class contains the logic and methods necessary for the simple checkbox-based gui to function and be 
-updated by the db_updater.py script.
+This class contains the logic and methods necessary for the simple checkbox-based gui to function.
+Updates run on a QThread (see UpdateWorker) and report back to the gui through signals, so the window stays
+responsive and a running update can be cancelled.
 
 Author: Nikolas Kovacs
 """
 
 
+import threading
 from PyQt5 import QtCore, QtGui, QtWidgets
 from ui import Ui_MainWindow
 
 
-class GUI(Ui_MainWindow): 
+class UpdateWorker(QtCore.QObject):
+    """
+    Runs an update on a QThread. Progress and status are emitted as signals, which Qt delivers to the
+    gui thread, so the worker never touches a widget itself.
+    """
     progressChanged = QtCore.pyqtSignal(int)
+    statusChanged = QtCore.pyqtSignal(str)
+    finished = QtCore.pyqtSignal()
+
+    def __init__(self, run_update, tables_to_update):
+        """
+        @param run_update: function taking (tables_to_update, progress, status, cancel_event) that runs the update
+        @param tables_to_update: list of the tables to update
+        """
+        super().__init__()
+        self.run_update = run_update
+        self.tables_to_update = tables_to_update
+        self.cancel_event = threading.Event()
+
+
+    def run(self):
+        try:
+            self.run_update(self.tables_to_update, self.progressChanged.emit, self.statusChanged.emit, self.cancel_event)
+        except Exception as e:
+            self.statusChanged.emit(f"Update failed: {e}")
+        finally:
+            self.finished.emit()
+
 
-    def __init__(self, MainWindow):
+    def cancel(self):
+        """
+        Asks the update to stop. The load stops before its next batch and the batch in progress is rolled back.
+        """
+        self.cancel_event.set()
+
+
+class GUI(Ui_MainWindow): 
+    def __init__(self, MainWindow, run_update):
+        """
+        @param MainWindow: the QMainWindow to set up
+        @param run_update: function taking (tables_to_update, progress, status, cancel_event) that runs the update
+        """
         super().__init__()
         self.setupUi(MainWindow)
-        self.progressChanged.connect(self.update_progress)
+        self.run_update = run_update
+        self.thread = None
+        self.worker = None
 
         self.set_of_check_boxes = set()
         self.set_of_checked_check_boxes = set()
-        self.update_button_pressed = False
 
         self.set_of_check_boxes.add(self.checkBox_initialize_all)
         self.checkBox_initialize_all.clicked.connect(self.check_all)
@@ -88,9 +129,39 @@ class GUI(Ui_MainWindow):
 
 
     def update_button_clicked(self):
-        self.update_button_pressed = True
+        if self.worker:
+            self.worker.cancel()
+            self.update_button.setEnabled(False)
+            self.update_label("Cancelling... Do not close this window.")
+            return
+
+        tables_to_update = self.get_tables_to_update()
+        if not tables_to_update:
+            return
+
+        self.thread = QtCore.QThread()
+        self.worker = UpdateWorker(self.run_update, tables_to_update)
+        self.worker.moveToThread(self.thread)
+        self.thread.started.connect(self.worker.run)
+        self.worker.progressChanged.connect(self.update_progress)
+        self.worker.statusChanged.connect(self.update_label)
+        self.worker.finished.connect(self.thread.quit)
+        self.worker.finished.connect(self.update_finished)
+
+        self.update_button_text = self.update_button.text()
+        self.update_button.setText("Cancel")
+        self.update_progress(0)
+        self.thread.start()
+
+
+    def update_finished(self):
+        self.thread.wait()
+        self.thread, self.worker = None, None
+        self.update_button.setText(self.update_button_text)
+        self.update_button.setEnabled(True)
 
     
     def get_tables_to_update(self):
-        if self.update_button_pressed:
-            return ['_'.join(x.objectName().split('_')[1:]) for x in self.set_of_checked_check_boxes]
\ No newline at end of file
+        if self.checkBox_initialize_all.isChecked():
+            return ["initalize_all"] # <- initialize_db already updates every table
+        return ['_'.join(x.objectName().split('_')[1:]) for x in self.set_of_checked_check_boxes]
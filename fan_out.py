@@ -0,0 +1,112 @@
+"""
+This file contains the fan-out that lets a single API_DB_Mediator write every fetched batch to several target
+databases (e.g. production, a reporting replica and a staging copy), so the APIs are only called once.
+
+A FanOut stands in for one object (the connection, the cursor or the ShardedWriter) and forwards every method call
+and attribute assignment to the same object of every healthy target, concurrently. The return value (e.g. the
+cursor of an execute) is the one of the first healthy target. Queries that return rows are not fanned out:
+API_DB_Mediator runs them on the first healthy target only.
+
+Failures are tracked per target: when a call fails on some targets but succeeds on others, the failed targets are
+rolled back and left out for the rest of the run, and the others carry on. When a call fails on every target, the
+error is raised as usual (it is a problem of the load, not of a target).
+
+The targets do not commit atomically with each other: a target that fails is behind the others and has to be
+reloaded (or resumed with --resume) on its own.
+
+Author: Nikolas Kovacs
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Targets:
+    """
+    The target databases of a load and their failures
+    """
+    def __init__(self, names):
+        """
+        @param names: the names of the targets (their config files), in order of preference for reads
+        """
+        self.names = list(names)
+        self.failures = {} # <- target name -> the exception that took it out
+        self.connections = {}
+        self.__executor = ThreadPoolExecutor(max_workers=len(self.names), thread_name_prefix="fan_out")
+
+
+    def healthy(self) -> list:
+        return [name for name in self.names if name not in self.failures]
+
+
+    def run(self, calls, objects={}):
+        """
+        Runs one call per healthy target concurrently.
+
+        @param calls: dict of target name -> function taking no arguments
+        @param objects: dict of target name -> the object called (rolled back too if its target fails)
+
+        @return: the result of the first healthy target
+        """
+        futures = {name: self.__executor.submit(call) for name, call in calls.items()}
+        results, errors = {}, {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                errors[name] = e
+        if not results:
+            raise next(iter(errors.values()))
+        for name, error in errors.items():
+            self.fail(name, error, objects.get(name))
+        return results[next(name for name in self.names if name in results)]
+
+
+    def fail(self, name, error, obj=None):
+        """
+        Leaves the target out for the rest of the run, rolling back its open transactions
+        """
+        self.failures[name] = error
+        for x in [self.connections.get(name), obj]:
+            try:
+                x.rollback()
+            except Exception:
+                pass
+
+
+    def close(self):
+        """
+        Closes the connection of every target, including the targets that failed
+        """
+        self.__executor.shutdown()
+        for connection in self.connections.values():
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+
+class FanOut:
+    def __init__(self, targets, objects):
+        """
+        @param targets: the Targets
+        @param objects: dict of target name -> the object of that target
+        """
+        object.__setattr__(self, "_targets", targets)
+        object.__setattr__(self, "_objects", objects)
+
+
+    def __getattr__(self, name):
+        primary = self._objects[self._targets.healthy()[0]]
+        if not callable(getattr(primary, name)):
+            return getattr(primary, name)
+
+        def call(*args, **kwargs):
+            return self._targets.run({
+                target: (lambda obj=self._objects[target]: getattr(obj, name)(*args, **kwargs))
+                for target in self._targets.healthy()
+            }, self._objects)
+        return call
+
+
+    def __setattr__(self, name, value):
+        for target in self._targets.healthy():
+            setattr(self._objects[target], name, value)
@@ -0,0 +1,478 @@
+"""
+A local stand-in for the BLS, QCEW, Census and BEA APIs, for load and concurrency testing without spending quota
+or getting throttled. It implements the endpoints that bls_data.py, census_data.py and bea_data.py call:
+
+    BLS_API_URL     http://<host>:<port>     POST /publicAPI/v2/timeseries/data/
+    QCEW_URL        http://<host>:<port+1>   GET  /cew/data/api/<year>/<qtr>/area/<area>.csv
+                                             GET  /cew/data/files/<year>/csv/<year>_qtrly_singlefile.zip
+    LAUS_URL        http://<host>:<port+1>   GET  /pub/time.series/la/la.data.64.County (last LAUS_YEARS years)
+    CENSUS_API_URL  http://<host>:<port+2>   GET  /data/<year>/acs/acs5/profile, /data/timeseries/poverty/saipe
+    BEA_API_URL     http://<host>:<port+3>   GET  /api/data/?method=GetData
+
+Every API has its own port, so the rate limiter keeps separate limits for them (e.g. "127.0.0.1:8500" in the
+"rate_limits" of request_info.json). Start the server, then set the printed environment variables before running
+db_updater.py.
+
+The payloads are synthetic but deterministic: the same request always returns the same values, for every state
+and county in states.csv and counties.csv, and only for the periods that would be published today.
+The latency, the error and throttling rates, a per-minute limit and a daily quota can be configured.
+
+Usage: py mock_api_server.py [--port 8500] [--latency 0.2] [--error-rate 0.01] [--throttle-rate 0.01] [--per-minute 0] [--per-day 0]
+
+Author: Nikolas Kovacs
+"""
+import argparse
+import csv
+import io
+import json
+import random
+import threading
+import time
+import zipfile
+import zlib
+from collections import Counter, deque
+from datetime import date
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from bls_data import EMPLOYMENT_COLUMNS, BLS_MAX_YEARS_PER_REQUEST, LAUS_UNEMPLOYMENT_RATE, LAUS_LABOR_FORCE
+
+APIS = ["bls", "qcew", "census", "bea"] # <- in port order
+URL_VARIABLES = {"bls": ["BLS_API_URL"], "qcew": ["QCEW_URL", "LAUS_URL"], "census": ["CENSUS_API_URL"], "bea": ["BEA_API_URL"]}
+
+CENSUS_MAX_VARIABLES = 50
+BLS_MAX_SERIES = 50
+LAUS_YEARS = 5
+
+# (own_code, industry_code) of the rows in every QCEW area file
+QCEW_INDUSTRIES = [
+    (0, "10"), (1, "10"), (2, "10"), (3, "10"), (5, "10"), (5, "101"), (5, "102"),
+    (5, "1011"), (5, "1012"), (5, "1013"), (5, "1021"), (5, "1022"), (5, "1023"),
+    (5, "1024"), (5, "1025"), (5, "1026"), (5, "1027"),
+]
+SCHOOL_DISTRICTS_PER_STATE = 40
+ZIPCODES_PER_STATE = 200
+
+
+def fraction(*key):
+    """
+    @return: a deterministic number in [0, 1) for the key
+    """
+    return zlib.crc32("/".join(str(x) for x in key).encode()) / 2**32
+
+
+def get_geography():
+    """
+    @return: tuple of (list of state fips, dict of state fips -> list of county fips)
+    """
+    with open("states.csv", 'r') as f:
+        states = [row["FIP"] for row in csv.DictReader(f) if row["FIP"] != "00"]
+    counties = {state: [] for state in states}
+    with open("counties.csv", 'r') as f:
+        for row in csv.DictReader(f):
+            if row["County"] != "000" and row["State"] in counties:
+                counties[row["State"]].append(row["County"])
+    return states, counties
+
+
+STATES, COUNTIES = get_geography()
+
+
+def qcew_published(year, qtr):
+    # a quarter is published about 5 months after it ends
+    months = (date.today().year - year) * 12 + date.today().month - qtr * 3
+    return months >= 6
+
+
+def annual_published(year):
+    # the ACS 5 year estimates, SAIPE and county GDP of a year are published in December of the following year
+    today = date.today()
+    return year < today.year - 1 or (year == today.year - 1 and today.month == 12)
+
+
+class MockState:
+    """
+    The options and the request counters shared by the handlers of every API
+    """
+    def __init__(self, latency=0.0, error_rate=0.0, throttle_rate=0.0, per_minute=0, per_day=0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.per_minute = per_minute
+        self.per_day = per_day
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.recent = {api: deque() for api in APIS}
+        self.daily = Counter()
+        self.responses = Counter()
+
+
+    def admit(self, api):
+        """
+        Applies the latency and decides the fate of a request.
+
+        @return: None if the request is served, otherwise "quota", "throttled" or "error"
+        """
+        with self.lock:
+            latency = self.latency * self.random.uniform(0.5, 1.5)
+            roll_throttle, roll_error = self.random.random(), self.random.random()
+        time.sleep(latency)
+
+        with self.lock:
+            now = time.time()
+            today = date.today().isoformat()
+            if self.per_day and self.daily[(api, today)] >= self.per_day:
+                return "quota"
+            self.daily[(api, today)] += 1
+
+            recent = self.recent[api]
+            while recent and recent[0] < now - 60:
+                recent.popleft()
+            if self.per_minute and len(recent) >= self.per_minute:
+                return "throttled"
+            recent.append(now)
+
+        if roll_throttle < self.throttle_rate:
+            return "throttled"
+        if roll_error < self.error_rate:
+            return "error"
+        return None
+
+
+class MockAPIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, api, state):
+        super().__init__(address, RequestHandler)
+        self.api = api
+        self.state = state
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass # <- the counters are printed on exit instead
+
+
+    def do_GET(self):
+        self.__handle(None)
+
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.__handle(self.rfile.read(length))
+
+
+    def __handle(self, body):
+        api = self.server.api
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        fate = self.server.state.admit(api)
+        if fate == "quota" and api == "bls":
+            # BLS answers with 200 and a status once the daily threshold is reached
+            return self.__send_json({"status": "REQUEST_NOT_PROCESSED", "responseTime": 0, "Results": {},
+                "message": ["Request could not be serviced, as the daily threshold for total number of requests allocated to the user has been reached."]}, fate)
+        if fate in ["quota", "throttled"]:
+            retry_after = "3600" if fate == "quota" else "1"
+            return self.__send(429, "text/plain", b"Too Many Requests", fate, {"Retry-After": retry_after})
+        if fate == "error" and api == "bea":
+            # BEA reports errors inside a 200 response
+            return self.__send_json({"BEAAPI": {"Error": {"APIErrorCode": "201", "APIErrorDescription": "Internal error (mock)"}}}, fate)
+        if fate == "error":
+            return self.__send(500, "text/plain", b"Internal Server Error", fate)
+
+        try:
+            if api == "bls" and body is not None and url.path.rstrip('/') == "/publicAPI/v2/timeseries/data":
+                return self.__send_json(bls_timeseries(json.loads(body)))
+            if api == "qcew" and url.path.startswith("/cew/data/api/"):
+                return self.__send_payload("text/csv", qcew_area_file(url.path))
+            if api == "qcew" and url.path.startswith("/cew/data/files/"):
+                return self.__send_payload("application/zip", qcew_singlefile(url.path))
+            if api == "qcew" and url.path == "/pub/time.series/la/la.data.64.County":
+                content, etag = laus_county_file(date.today())
+                if etag in [x.strip() for x in self.headers.get("If-None-Match", "").split(',')]:
+                    return self.__send(304, "text/plain", b"", "not_modified", {"ETag": etag})
+                return self.__send(200, "text/plain", content, headers={"ETag": etag})
+            if api == "census" and url.path == "/data/timeseries/poverty/saipe":
+                return self.__send_census(census_saipe(params))
+            if api == "census" and url.path.endswith("/acs/acs5/profile"):
+                return self.__send_census(census_profile(url.path, params))
+            if api == "bea" and url.path.rstrip('/') == "/api/data":
+                return self.__send_json(bea_data(params))
+        except (KeyError, ValueError) as e:
+            return self.__send(400, "text/plain", f"error: {e}".encode(), "bad_request")
+        return self.__send(404, "text/plain", b"Not Found", "not_found")
+
+
+    def __send_payload(self, content_type, payload):
+        if payload is None:
+            return self.__send(404, "text/plain", b"Not Found", "not_found")
+        self.__send(200, content_type, payload if isinstance(payload, bytes) else payload.encode())
+
+
+    def __send_census(self, rows):
+        if isinstance(rows, str): # <- error message
+            return self.__send(400, "text/plain", f"error: {rows}".encode(), "bad_request")
+        if not rows:
+            return self.__send(204, "text/plain", b"", "no_content")
+        self.__send_json(rows)
+
+
+    def __send_json(self, data, outcome="ok"):
+        self.__send(200, "application/json", json.dumps(data).encode(), outcome)
+
+
+    def __send(self, status, content_type, body, outcome="ok", headers={}):
+        with self.server.state.lock:
+            self.server.state.responses[(self.server.api, outcome)] += 1
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def bls_timeseries(request):
+    """
+    @param request: the json body of a BLS v2 timeseries request
+
+    @return: the json response, monthly values from startyear through endyear for every series
+    """
+    series_ids = request["seriesid"]
+    start_year, end_year = int(request["startyear"]), int(request["endyear"])
+    if len(series_ids) > BLS_MAX_SERIES or end_year - start_year + 1 > BLS_MAX_YEARS_PER_REQUEST:
+        return {"status": "REQUEST_NOT_PROCESSED", "responseTime": 0, "Results": {},
+            "message": [f"No more than {BLS_MAX_SERIES} series and {BLS_MAX_YEARS_PER_REQUEST} years can be requested at a time."]}
+
+    today = date.today()
+    series = []
+    for series_id in series_ids:
+        data = []
+        for year in range(end_year, start_year - 1, -1):
+            for month in range(12, 0, -1):
+                if laus_published(today, year, month):
+                    data.append({"year": str(year), "period": f"M{month:02}", "periodName": date(2000, month, 1).strftime("%B"),
+                        "value": laus_value(series_id, year, month), "footnotes": [{}]})
+        series.append({"seriesID": series_id, "data": data})
+    return {"status": "REQUEST_SUCCEEDED", "responseTime": 1, "message": [], "Results": {"series": series}}
+
+
+def laus_published(today, year, month):
+    return (year, month) < (today.year, today.month - 1) # <- a month is published at the start of the next one
+
+
+def laus_value(series_id, year, month):
+    """
+    @return: the value of a LAUS series for a month, the same in the timeseries API and the flat file
+    """
+    x = fraction(series_id, year, month)
+    if series_id.endswith("3"): # <- unemployment rate
+        return f"{2 + 8 * x:.1f}"
+    return str(int(1_000 + 5_000_000 * fraction(series_id) * (0.95 + 0.1 * x))) # <- labor force
+
+
+@lru_cache(maxsize=1)
+def laus_county_file(today):
+    """
+    @param today: the date, the file changes (and gets a new ETag) once a day
+
+    @return: tuple of (the LAUS county flat file, its ETag), with the unemployment rate and labor force series of
+             every county for the last LAUS_YEARS years, the annual averages (M13) included
+    """
+    lines = ["series_id                     \tyear\tperiod\t       value\tfootnote_codes"]
+    for state in STATES:
+        for county in COUNTIES[state]:
+            for measure_code in [LAUS_UNEMPLOYMENT_RATE, LAUS_LABOR_FORCE]:
+                series_id = f"LAUCN{state}{county}00000000{measure_code}"
+                for year in range(today.year - LAUS_YEARS + 1, today.year + 1):
+                    values = [(f"M{month:02}", laus_value(series_id, year, month)) for month in range(1, 13) if laus_published(today, year, month)]
+                    if len(values) == 12:
+                        values.append(("M13", values[0][1]))
+                    for period, value in values:
+                        lines.append(f"{series_id:<30}\t{year}\t{period}\t{value:>12}\t")
+    return ("\n".join(lines) + "\n").encode(), f'"{today.isoformat()}"'
+
+
+def qcew_rows(area, year, qtr):
+    """
+    @return: list of the rows (EMPLOYMENT_COLUMNS) of an area for a quarter
+    """
+    base = 10 if area == "US000" else 50 if area.endswith("000") else 70
+    rows = []
+    for own_code, industry_code in QCEW_INDUSTRIES:
+        x = fraction(area, own_code, industry_code)
+        suppressed = base == 70 and fraction(area, own_code, industry_code, year) < 0.05
+        employment = 0 if suppressed else int(50 + 200_000 * x * (0.98 + 0.04 * fraction(area, industry_code, year, qtr)))
+        wages = employment * (9_000 + int(6_000 * x))
+        agglvl_code = base + len(industry_code) - 2 + (0 if own_code == 0 else 1)
+        rows.append([area, own_code, industry_code, agglvl_code, 0, year, qtr, "N" if suppressed else "",
+            0 if suppressed else max(1, employment // 12), employment, employment, employment,
+            wages, wages // 2, wages // 100, 0 if not employment else wages // employment // 13])
+    return rows
+
+
+def to_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EMPLOYMENT_COLUMNS)
+    writer.writerows(rows)
+    return buffer.getvalue()
+
+
+def qcew_area_file(path):
+    """
+    @param path: /cew/data/api/<year>/<qtr>/area/<area>.csv
+
+    @return: the csv, or None if the area or quarter does not exist
+    """
+    _, _, _, year, qtr, _, file = path.strip('/').split('/')
+    year, qtr, area = int(year), int(qtr), file.removesuffix(".csv")
+    known = area == "US000" or area[:2] in COUNTIES and (area[2:] == "000" or area[2:] in COUNTIES[area[:2]])
+    if not known or not 1 <= qtr <= 4 or not qcew_published(year, qtr):
+        return None
+    return to_csv(qcew_rows(area, year, qtr))
+
+
+@lru_cache(maxsize=4)
+def qcew_singlefile(path):
+    """
+    @param path: /cew/data/files/<year>/csv/<year>_qtrly_singlefile.zip
+
+    @return: the zip archive with every area and every published quarter of the year, or None if none is published
+    """
+    year = int(path.strip('/').split('/')[3])
+    quarters = [qtr for qtr in range(1, 5) if qcew_published(year, qtr)]
+    if not quarters:
+        return None
+    areas = ["US000"] + [f"{state}000" for state in STATES] + [f"{state}{county}" for state in STATES for county in COUNTIES[state]]
+    rows = [row for qtr in quarters for area in areas for row in qcew_rows(area, year, qtr)]
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(f"{year}.q1-q{quarters[-1]}.singlefile.csv", to_csv(rows))
+    return archive.getvalue()
+
+
+def census_geographies(params):
+    """
+    @return: tuple of (geography column names, list of the geographies as lists of codes)
+    """
+    for_ = params["for"].split(':')[0]
+    if for_ == "state":
+        return ["state"], [[state] for state in STATES]
+    if for_ == "county":
+        return ["state", "county"], [[state, county] for state in STATES for county in COUNTIES[state]]
+    if for_ == "school district (unified)":
+        return ["state", for_], [[state, f"{i * 10:05}"] for state in STATES for i in range(1, SCHOOL_DISTRICTS_PER_STATE + 1)]
+    if for_ == "zip code tabulation area":
+        return ["state", for_], [[state, f"{(int(state) * 1000 + i) % 100000:05}"] for state in STATES for i in range(ZIPCODES_PER_STATE)]
+    raise ValueError(f"unknown geography: {for_}")
+
+
+def census_value(variable, geography, year):
+    x = fraction(variable, *geography, year)
+    if variable.endswith("PE") or variable.endswith("_PT") and "RT" in variable:
+        return f"{100 * x:.1f}"
+    return str(int(100 + 1_000_000 * fraction(variable, *geography) * (0.97 + 0.06 * x)))
+
+
+def census_rows(variables, geo_columns, geographies, year, extra=[]):
+    if len(variables) > CENSUS_MAX_VARIABLES:
+        return f"cannot request more than {CENSUS_MAX_VARIABLES} variables"
+    rows = [variables + [x for x, _ in extra] + geo_columns]
+    for geography in geographies:
+        values = []
+        for variable in variables:
+            if variable == "NAME":
+                values.append(f"Area {'-'.join(geography)}")
+            elif variable == "YEAR":
+                values.append(str(year))
+            else:
+                values.append(census_value(variable, geography, year))
+        rows.append(values + [x for _, x in extra] + geography)
+    return rows
+
+
+def census_profile(path, params):
+    """
+    @param path: /data/<year>/acs/acs5/profile
+
+    @return: the rows (header first), None if the year is not published or an error message
+    """
+    year = int(path.strip('/').split('/')[1])
+    if not annual_published(year):
+        return None
+    geo_columns, geographies = census_geographies(params)
+    return census_rows(params["get"].split(','), geo_columns, geographies, year)
+
+
+def census_saipe(params):
+    """
+    @return: the rows (header first, with the time predicate before the geography), None if the year is not published
+             or an error message
+    """
+    year = int(params["time"])
+    if not annual_published(year):
+        return None
+    geo_columns, geographies = census_geographies(params)
+    return census_rows(params["get"].split(','), geo_columns, geographies, year, extra=[("time", str(year))])
+
+
+def bea_data(params):
+    """
+    @return: the json response of a Regional GetData request for the last 5 published years
+    """
+    if not params.get("UserID"):
+        return {"BEAAPI": {"Error": {"APIErrorCode": "3", "APIErrorDescription": "The UserID provided in the request is not valid."}}}
+    table, line_code, geo = params["TableName"], params["LineCode"], params["GeoFIPS"].upper()
+    if geo == "STATE":
+        geographies = [f"{state}000" for state in STATES]
+    elif geo == "COUNTY":
+        geographies = [f"{state}{county}" for state in STATES for county in COUNTIES[state]]
+    else:
+        raise ValueError(f"unknown GeoFIPS: {geo}")
+
+    last_year = date.today().year - 1 if annual_published(date.today().year - 1) else date.today().year - 2
+    data = []
+    for geo_fips in geographies:
+        for year in range(last_year - 4, last_year + 1):
+            x = fraction(table, line_code, geo_fips, year)
+            suppressed = geo == "COUNTY" and x < 0.02
+            value = "(D)" if suppressed else f"{int(10_000 + 50_000_000 * fraction(table, line_code, geo_fips) * (0.95 + 0.1 * x)):,}"
+            data.append({"Code": f"{table}-{line_code}", "GeoFips": geo_fips, "GeoName": f"Area {geo_fips}",
+                "TimePeriod": str(year), "CL_UNIT": "Thousands of dollars", "UNIT_MULT": "3", "DataValue": value})
+    return {"BEAAPI": {"Request": {"RequestParam": [{"ParameterName": k.upper(), "ParameterValue": v} for k, v in params.items() if k != "UserID"]},
+        "Results": {"Statistic": "Mock", "UnitOfMeasure": "Thousands of dollars", "Data": data}}}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local mock of the BLS, QCEW, Census and BEA APIs")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8500, help="Port of the BLS API, the others use the next 3 ports (default: 8500)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Mean latency of a response in seconds (default: 0)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of the requests that fail (default: 0)")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of the requests answered with 429 (default: 0)")
+    parser.add_argument("--per-minute", type=int, default=0, help="Requests per minute per API before 429s (default: unlimited)")
+    parser.add_argument("--per-day", type=int, default=0, help="Requests per day per API before the quota responses (default: unlimited)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the latency, error and throttling rolls (default: 0)")
+    args = parser.parse_args()
+
+    state = MockState(args.latency, args.error_rate, args.throttle_rate, args.per_minute, args.per_day, args.seed)
+    servers = [MockAPIServer((args.host, args.port + i), api, state) for i, api in enumerate(APIS)]
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True, name=f"mock_{server.api}").start()
+
+    print("Set the following environment variables before running db_updater.py:")
+    for i, api in enumerate(APIS):
+        for variable in URL_VARIABLES[api]:
+            print(f"    {variable}=http://{args.host}:{args.port + i}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for (api, outcome), n in sorted(state.responses.items()):
+            print(f"{api:<8}{outcome:<14}{n:>8}")
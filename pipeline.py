@@ -0,0 +1,145 @@
+"""
+This file contains the staged pipeline the table loads run their work units through:
+
+    downloaders (threads) --queue--> parsers (process pool) --queue--> writer (the calling thread)
+
+Every stage works on a different unit at the same time, so a load takes about as long as its slowest stage
+instead of the sum of the three. The queues are bounded: when the parsers or the writer fall behind, the
+downloaders wait, so only a few units are ever held in memory.
+
+The writer runs in the calling thread, which owns the database connection and the checkpointed transactions.
+The parse function runs in other processes, so it has to be a module level function and its input and output
+have to be picklable (bytes in, rows or dataframes out).
+
+Author: Nikolas Kovacs
+"""
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+
+QUEUE_SIZE = 8
+
+_DONE = object() # <- sent by a stage once it has no more items
+
+
+def run_pipeline(units, fetch, write, parse=None, fetch_workers=4, parse_workers=None, queue_size=QUEUE_SIZE, stop=None,
+                 on_error=None):
+    """
+    Runs every unit through fetch, parse and write. Stops at the first exception (from any stage), which is raised
+    once the downloads in progress have returned, unless on_error is given.
+
+    @param units: iterable of the work units
+    @param fetch: function taking a unit and returning its raw data, run in fetch_workers threads
+    @param write: function taking a unit and its parsed data, run in the calling thread
+    @param parse: optional function taking the raw data and returning the parsed data (None -> write the raw data)
+    @param fetch_workers: the number of downloader threads
+    @param parse_workers: the number of parser processes (None -> one per cpu, 0 -> parse in the downloader threads)
+    @param queue_size: the capacity of each queue between two stages
+    @param stop: optional threading.Event that is set once the pipeline stops, for a units generator that waits
+                 for more units to know when to give up
+    @param on_error: optional function taking a unit and the exception (an Exception) its fetch, parse or write raised,
+                     run in the calling thread. The pipeline then carries on with the other units, unless it re-raises.
+    """
+    units = iter(units)
+    units_lock = threading.Lock()
+    fetched = queue.Queue(maxsize=queue_size)
+    parsed = queue.Queue(maxsize=queue_size)
+    stop = stop or threading.Event()
+
+    pool = None
+    if parse is not None and parse_workers != 0:
+        # spawn (the only option on Windows) rather than forking a process that is running threads
+        pool = ProcessPoolExecutor(max_workers=parse_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def put(q, item):
+        """
+        @return: False if the pipeline stopped before the item could be queued
+        """
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def download():
+        try:
+            while not stop.is_set():
+                with units_lock:
+                    unit = next(units, _DONE)
+                if unit is _DONE:
+                    break
+                try:
+                    data = fetch(unit)
+                    if parse is not None and pool is None:
+                        data = parse(data)
+                except Exception as e:
+                    if on_error is None:
+                        raise
+                    if not put(fetched, (unit, None, e)): # <- handed to on_error by the writer
+                        return
+                    continue
+                if not put(fetched, (unit, data, None)):
+                    return
+        except BaseException as e:
+            put(fetched, (None, None, e))
+        put(fetched, _DONE)
+
+    def dispatch():
+        try:
+            remaining = fetch_workers
+            while remaining and not stop.is_set():
+                try:
+                    item = fetched.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is _DONE:
+                    remaining -= 1
+                    continue
+                unit, data, error = item
+                if error is None and pool is not None:
+                    data = pool.submit(parse, data) # <- raises e.g. BrokenProcessPool once a parser process died
+                if not put(parsed, (unit, data, error)):
+                    return
+        except BaseException as e:
+            put(parsed, (None, None, e))
+        finally:
+            put(parsed, _DONE)
+
+    threads = [threading.Thread(target=download, daemon=True, name=f"pipeline_fetch_{i}") for i in range(fetch_workers)]
+    threads.append(threading.Thread(target=dispatch, daemon=True, name="pipeline_parse"))
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            try:
+                item = parsed.get(timeout=0.1)
+            except queue.Empty:
+                if stop.is_set(): # <- stopped by the caller
+                    break
+                if not threads[-1].is_alive() and parsed.empty():
+                    raise RuntimeError("the parse stage of the pipeline stopped without finishing")
+                continue
+            if item is _DONE:
+                break
+            unit, data, error = item
+            if error is None:
+                try:
+                    write(unit, data.result() if isinstance(data, Future) else data)
+                    continue
+                except Exception as e:
+                    if on_error is None:
+                        raise
+                    error = e
+            if unit is None or on_error is None: # <- the error of a stage rather than of a unit
+                raise error
+            on_error(unit, error)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
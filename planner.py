@@ -0,0 +1,224 @@
+"""
+This file contains the request/cost planner behind `db_updater.py --plan`.
+
+It enumerates the work units of a table load from states.csv, counties.csv, request_info.json and the year
+windows, and estimates the number of requests, quota units, rows, bytes and seconds without touching the
+network or the database.
+
+Rows and seconds per request are taken from the metrics of previous loads (load_metrics.json, written by
+db_updater.py after every table) when there are any, otherwise from DEFAULT_METRICS.
+
+Author: Nikolas Kovacs
+"""
+import csv
+import json
+import math
+from datetime import date
+from bls_data import get_year_windows
+from qcew_cache import get_latest_quarter
+from census_data import get_appropriate_variables, get_poverty_variables, split_variables
+from rate_limiter import get_limits
+
+METRICS_FILE = "load_metrics.json"
+
+# rough per-request defaults by source: rows inserted, bytes downloaded and seconds taken
+DEFAULT_METRICS = {
+    "bls_timeseries": {"rows": 50 * 12 * 3, "bytes": 150_000, "seconds": 2.0},
+    "qcew_area": {"rows": 120, "bytes": 25_000, "seconds": 0.5},
+    "qcew_singlefile": {"rows": 4_000_000, "bytes": 500_000_000, "seconds": 600.0},
+    "laus_flatfile": {"rows": 115_000, "bytes": 350_000_000, "seconds": 240.0},
+    "census": {"rows": 3_000, "bytes": 2_000_000, "seconds": 5.0},
+    "census_zipcodes": {"rows": 33_000, "bytes": 25_000_000, "seconds": 30.0},
+    "census_poverty": {"rows": 3_200, "bytes": 500_000, "seconds": 2.0},
+    "bea": {"rows": 3_100 * 5, "bytes": 3_000_000, "seconds": 4.0},
+    "local": {"rows": 0, "bytes": 0, "seconds": 0.0},
+}
+
+# table -> (source, API host the requests are made to or None). The requests only count as quota use if the host
+# has a daily quota (see rate_limiter.get_limits)
+TABLE_SOURCES = {
+    "states": ("local", None),
+    "counties": ("local", None),
+    "state_unemployment": ("bls_timeseries", "api.bls.gov"),
+    "county_unemployment": ("bls_timeseries", "api.bls.gov"),
+    "county_workers": ("bls_timeseries", "api.bls.gov"),
+    "us_employment": ("qcew_area", None),
+    "state_employment": ("qcew_area", None),
+    "county_employment": ("qcew_area", None),
+    "county_data": ("census", "api.census.gov"),
+    "state_data": ("census", "api.census.gov"),
+    "county_poverty": ("census_poverty", "api.census.gov"),
+    "state_poverty": ("census_poverty", "api.census.gov"),
+    "school_districts": ("census", "api.census.gov"),
+    "zipcodes": ("census_zipcodes", "api.census.gov"),
+    "county_gdp": ("bea", "apps.bea.gov"),
+    "state_gdp": ("bea", "apps.bea.gov"),
+}
+
+# census table -> for_ passed to census_data.get_appropriate_variables
+CENSUS_GEOGRAPHIES = {
+    "county_data": "county",
+    "state_data": "state",
+    "school_districts": r"school%20district%20(unified)",
+    "zipcodes": "zip code tabulation area",
+}
+
+
+def get_state_fips():
+    with open("states.csv", 'r') as f:
+        return [row["FIP"] for row in csv.DictReader(f) if row["FIP"] != "00"]
+
+
+def get_county_fips():
+    """
+    @return: dict of state fips -> list of county fips (including the statewide "000", like dbo.counties)
+    """
+    counties = {}
+    with open("counties.csv", 'r') as f:
+        for row in csv.DictReader(f):
+            counties.setdefault(row["State"], []).append(row["County"])
+    return counties
+
+
+def count_requests(table, backfill_start_year=None, employment_source="area", laus_source="api"):
+    """
+    Counts the requests a load of the table makes.
+
+    @param table: the table name (as in db_updater.TABLE_METHODS)
+    @param backfill_start_year: the first year of the BLS timeseries tables (None -> the last 3 years)
+    @param employment_source: "area" or "singlefile"
+    @param laus_source: "api" or "flatfile"
+
+    @return: the number of requests
+    """
+    curr_year = date.today().year
+    states = get_state_fips()
+
+    if TABLE_SOURCES[table][0] == "local":
+        return 0
+    if table in ["county_unemployment", "county_workers"] and laus_source == "flatfile":
+        return 1 # <- one download of the county flat file
+    if table in ["state_unemployment", "county_unemployment", "county_workers"]:
+        windows = len(list(get_year_windows(backfill_start_year or curr_year-2, curr_year)))
+        if table == "state_unemployment":
+            return math.ceil(len(states) / 50) * windows
+        counties = get_county_fips()
+        return sum(math.ceil(len(counties.get(state, [])) / 50) for state in states) * windows
+    if table.endswith("_employment"):
+        if employment_source == "singlefile":
+            return 4 # <- one archive per year
+        areas = {"us_employment": 1, "state_employment": len(states)}.get(table)
+        if areas is None:
+            counties = get_county_fips()
+            areas = sum(len([c for c in counties.get(state, []) if c != "000"]) for state in states)
+        # 4 years of 4 quarters, without those after the latest published quarter if it was probed before
+        latest = get_latest_quarter()
+        quarters = [(year, qtr) for year in range(curr_year-3, curr_year+1) for qtr in range(1, 5)]
+        return areas * len([x for x in quarters if latest is None or x <= tuple(latest[:2])])
+    if TABLE_SOURCES[table][0].startswith("census"):
+        if table in CENSUS_GEOGRAPHIES:
+            variables = get_appropriate_variables(CENSUS_GEOGRAPHIES[table]) + ["NAME"]
+        else:
+            variables = get_poverty_variables()
+        return len(split_variables(variables)) * 4 # <- one request per variable group per year
+    if TABLE_SOURCES[table][0] == "bea":
+        with open("request_info.json", 'r') as f:
+            line_codes = json.load(f)["tables"]["bea_gdp"]["line_codes"]
+        return sum(len(x) for x in line_codes)
+    raise ValueError(f"Unknown table: {table}")
+
+
+def expand_tables(table):
+    """
+    @param table: a table name, "initalize_all", "all_employment" or "all_gdp"
+
+    @return: list of the tables the name stands for
+    """
+    if table == "initalize_all":
+        return list(TABLE_SOURCES)
+    if table == "rollups":
+        return [] # <- computed in the database, no requests
+    if table == "all_employment":
+        return ["us_employment", "state_employment", "county_employment"]
+    if table == "all_gdp":
+        return ["state_gdp", "county_gdp"]
+    return [table]
+
+
+def load_metrics():
+    try:
+        with open(METRICS_FILE, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def record_metrics(table, requests, rows, seconds):
+    """
+    Adds the totals of a finished load to the metrics file used by future plans.
+
+    @param table: the table name
+    @param requests: the number of requests the load made (as planned)
+    @param rows: the number of rows inserted
+    @param seconds: the duration of the load
+    """
+    metrics = load_metrics()
+    totals = metrics.setdefault(table, {"loads": 0, "requests": 0, "rows": 0, "seconds": 0.0})
+    totals["loads"] += 1
+    totals["requests"] += requests
+    totals["rows"] += rows
+    totals["seconds"] += seconds
+    with open(METRICS_FILE, 'w') as f:
+        json.dump(metrics, f, indent=4)
+
+
+def plan_table(table, backfill_start_year=None, employment_source="area", laus_source="api"):
+    """
+    @param table: the table name (as in db_updater.TABLE_METHODS)
+
+    @return: dict with the estimated "requests", "quota" (dict of host with a daily quota -> requests), "rows",
+             "bytes" and "seconds"
+    """
+    source, host = TABLE_SOURCES[table]
+    limits = get_limits(host) if host else None
+    quota_host = host if limits and limits.get("per_day") is not None else None
+    if source == "qcew_area" and employment_source == "singlefile":
+        source = "qcew_singlefile"
+    if table in ["county_unemployment", "county_workers"] and laus_source == "flatfile":
+        source, quota_host = "laus_flatfile", None
+    requests = count_requests(table, backfill_start_year, employment_source, laus_source)
+
+    per_request = dict(DEFAULT_METRICS[source])
+    history = load_metrics().get(table)
+    if history and history["requests"]:
+        per_request["rows"] = history["rows"] / history["requests"]
+        per_request["seconds"] = history["seconds"] / history["requests"]
+
+    return {
+        "requests": requests,
+        "quota": {quota_host: requests} if quota_host and requests else {},
+        "rows": int(requests * per_request["rows"]),
+        "bytes": int(requests * per_request["bytes"]),
+        "seconds": requests * per_request["seconds"],
+    }
+
+
+def print_plan(tables, **options):
+    """
+    Prints the estimates for each table and the total.
+
+    @param tables: list of table names
+    @param options: passed on to plan_table
+    """
+    print(f"{'table':<22}{'requests':>10}{'rows':>14}{'MB':>10}{'minutes':>10}  quota")
+    total = {"requests": 0, "rows": 0, "bytes": 0, "seconds": 0.0, "quota": {}}
+    for table in tables:
+        plan = plan_table(table, **options)
+        quota = ", ".join(f"{host}: {n}" for host, n in plan["quota"].items())
+        print(f"{table:<22}{plan['requests']:>10}{plan['rows']:>14}{plan['bytes'] / 1e6:>10.1f}{plan['seconds'] / 60:>10.1f}  {quota}")
+        for key in ["requests", "rows", "bytes", "seconds"]:
+            total[key] += plan[key]
+        for host, n in plan["quota"].items():
+            total["quota"][host] = total["quota"].get(host, 0) + n
+    quota = ", ".join(f"{host}: {n}" for host, n in total["quota"].items())
+    print(f"{'total':<22}{total['requests']:>10}{total['rows']:>14}{total['bytes'] / 1e6:>10.1f}{total['seconds'] / 60:>10.1f}  {quota}")
@@ -0,0 +1,172 @@
+"""
+This file contains the profiling hooks behind `db_updater.py --profile` and `--trace-memory`.
+
+profile_table wraps a table initializer and writes, to the profiles directory:
+    --profile cprofile   <table>_<time>.prof (open with pstats/snakeviz) and <table>_<time>_top.txt
+    --profile sample     <table>_<time>.collapsed, stacks of every thread sampled every few ms, in the
+                         collapsed format read by flamegraph.pl and speedscope
+    --trace-memory       <table>_<time>_memory.txt, the peak and the top allocations held at the peak, by line (tracemalloc)
+
+cProfile only sees the thread that runs the initializer, the sampler also sees the fetch and writer threads.
+
+Author: Nikolas Kovacs
+"""
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+PROFILE_DIR = "profiles"
+TOP_N = 30
+SAMPLE_INTERVAL = 0.005 # seconds
+PEAK_INTERVAL = 0.05 # seconds between the checks of the traced memory
+PEAK_GROWTH = 1.05 # <- a new snapshot is taken once the traced memory is 5% above the one of the last snapshot
+
+
+class StackSampler:
+    """
+    Samples the stacks of every thread (except its own) on an interval and counts them in collapsed form
+    """
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, daemon=True, name="stack_sampler")
+
+
+    def start(self):
+        self.__thread.start()
+
+
+    def stop(self):
+        self.__stop.set()
+        self.__thread.join()
+
+
+    def write_collapsed(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                print(f"{stack} {count}", file=f)
+
+
+    def __run(self):
+        own_id = threading.get_ident()
+        while not self.__stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+
+class PeakSnapshotter:
+    """
+    Takes a tracemalloc snapshot every time the traced memory reaches a new high (by PEAK_GROWTH), so the
+    allocations behind the peak can be reported after they have been freed
+    """
+    def __init__(self, interval=PEAK_INTERVAL):
+        self.interval = interval
+        self.snapshot = None
+        self.snapshot_size = 0
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, daemon=True, name="peak_snapshotter")
+
+
+    def start(self):
+        self.__thread.start()
+
+
+    def stop(self):
+        self.__stop.set()
+        self.__thread.join()
+        self.check() # <- the end of the load can be the peak too
+
+
+    def check(self):
+        current, _ = tracemalloc.get_traced_memory()
+        if current > self.snapshot_size * PEAK_GROWTH:
+            self.snapshot = tracemalloc.take_snapshot()
+            self.snapshot_size = current
+
+
+    def __run(self):
+        while not self.__stop.wait(self.interval):
+            self.check()
+
+
+@contextmanager
+def profile_table(table, profile=None, trace_memory=False, out_dir=PROFILE_DIR):
+    """
+    Profiles the code run inside the with block and writes the reports for the table.
+
+    @param table: the name of the table being loaded (used for the file names)
+    @param profile: None, "cprofile" or "sample"
+    @param trace_memory: whether to trace the allocations with tracemalloc
+    @param out_dir: the directory the reports are written to
+    """
+    if not profile and not trace_memory:
+        yield
+        return
+
+    os.makedirs(out_dir, exist_ok=True)
+    prefix = os.path.join(out_dir, f"{table}_{datetime.now():%Y%m%d_%H%M%S}")
+
+    profiler, sampler = None, None
+    if profile == "cprofile":
+        profiler = cProfile.Profile()
+    elif profile == "sample":
+        sampler = StackSampler()
+    elif profile:
+        raise ValueError("profile must be 'cprofile' or 'sample'")
+
+    snapshotter = None
+    if trace_memory:
+        tracemalloc.start(25)
+        snapshotter = PeakSnapshotter()
+        snapshotter.start()
+    start_time = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    if sampler:
+        sampler.start()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+        if sampler:
+            sampler.stop()
+        if snapshotter:
+            snapshotter.stop()
+        elapsed = time.perf_counter() - start_time
+
+        if profiler:
+            profiler.dump_stats(f"{prefix}.prof")
+            report = io.StringIO()
+            pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(TOP_N)
+            with open(f"{prefix}_top.txt", 'w') as f:
+                print(f"{table}: {elapsed:.1f}s", file=f)
+                f.write(report.getvalue())
+        if sampler:
+            sampler.write_collapsed(f"{prefix}.collapsed")
+        if trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(f"{prefix}_memory.txt", 'w') as f:
+                print(f"{table}: {elapsed:.1f}s, peak {peak / 1e6:.1f} MB, still allocated {current / 1e6:.1f} MB", file=f)
+                print(f"Top {TOP_N} allocations held at the highest snapshot ({snapshotter.snapshot_size / 1e6:.1f} MB), by line:", file=f)
+                for stat in snapshotter.snapshot.statistics("lineno")[:TOP_N]:
+                    print(stat, file=f)
@@ -0,0 +1,62 @@
+"""
+This file contains the negative cache that keeps the employment loads from requesting QCEW files that do not exist.
+
+Two things are remembered in a SQLite file (shared by every thread and process on the machine, like the rate limiter):
+    * the area files that returned 404 (e.g. counties whose data is suppressed), per area and quarter, until they
+      expire after MISSING_DAYS days
+    * the latest published quarter, found by probing (see bls_data.get_latest_qcew_quarter) at most once a day,
+      so the quarters after it are not requested at all
+
+Deleting the file resets the cache.
+
+Author: Nikolas Kovacs
+"""
+import sqlite3
+from datetime import date, timedelta
+
+from rate_limiter import _Transaction
+
+CACHE_FILE = "qcew_cache.sqlite"
+MISSING_DAYS = 30
+
+
+def get_missing_files(today=None) -> set:
+    """
+    @return: set of (area, year, qtr) of the area files that returned 404 and have not expired yet
+    """
+    today = (today or date.today()).isoformat()
+    with _connect() as connection:
+        rows = connection.execute("SELECT area, year, qtr FROM missing WHERE expires > ?;", (today,)).fetchall()
+    return {(area, year, qtr) for area, year, qtr in rows}
+
+
+def record_missing_file(area, year, qtr, days=MISSING_DAYS):
+    """
+    Remembers that an area file returned 404, so it is not requested again for the given number of days.
+    """
+    expires = (date.today() + timedelta(days=days)).isoformat()
+    with _connect() as connection:
+        connection.execute("INSERT OR REPLACE INTO missing (area, year, qtr, expires) VALUES (?, ?, ?, ?);",
+            (area, year, qtr, expires))
+
+
+def get_latest_quarter():
+    """
+    @return: tuple of (year, qtr, date it was last probed as an iso string), or None if it was never probed
+    """
+    with _connect() as connection:
+        return connection.execute("SELECT year, qtr, probed FROM latest_quarter;").fetchone()
+
+
+def set_latest_quarter(year, qtr):
+    with _connect() as connection:
+        connection.execute("DELETE FROM latest_quarter;")
+        connection.execute("INSERT INTO latest_quarter (year, qtr, probed) VALUES (?, ?, ?);",
+            (year, qtr, date.today().isoformat()))
+
+
+def _connect():
+    connection = sqlite3.connect(CACHE_FILE, timeout=60, isolation_level=None)
+    connection.execute("CREATE TABLE IF NOT EXISTS missing (area TEXT, year INTEGER, qtr INTEGER, expires TEXT, PRIMARY KEY (area, year, qtr));")
+    connection.execute("CREATE TABLE IF NOT EXISTS latest_quarter (year INTEGER, qtr INTEGER, probed TEXT);")
+    return _Transaction(connection)
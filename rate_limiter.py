@@ -0,0 +1,161 @@
+"""
+This file contains the rate limiter that every API request goes through.
+
+Each API host gets a token bucket (requests per minute) and a daily quota. The state of the buckets and
+the daily quota ledger are persisted in a SQLite file, so the limits are shared by all threads and
+processes on the machine and the daily usage survives restarts.
+
+The default limits can be overridden in request_info.json:
+    "rate_limits": {
+        "api.bls.gov": {"per_minute": 60, "per_day": 500}
+    }
+
+Author: Nikolas Kovacs
+"""
+import json
+import sqlite3
+import time
+from datetime import date
+from urllib.parse import urlparse
+
+LEDGER_FILE = "api_quota.sqlite"
+
+# per_day of None means the API has no daily quota
+DEFAULT_LIMITS = {
+    "api.bls.gov": {"per_minute": 60, "per_day": 500},
+    "apps.bea.gov": {"per_minute": 100, "per_day": None},
+    "api.census.gov": {"per_minute": 300, "per_day": None},
+}
+
+
+class QuotaExceededError(Exception):
+    """
+    Raised when the daily quota of an API host has been used up
+    """
+    pass
+
+
+def get_host(url):
+    """
+    @param url: A url (or host) of the API
+
+    @return: the host the limits are kept for, with the port if the url has one (e.g. "api.bls.gov", "127.0.0.1:8501")
+    """
+    return urlparse(url).netloc.lower() if "://" in url else url
+
+
+def get_limits(host):
+    """
+    This function retrieves the limits for the given host, taking the overrides in request_info.json into account.
+
+    @param host: The API host (e.g. "api.bls.gov")
+
+    @return: dict with the keys "per_minute" and "per_day", or None if the host is not limited
+    """
+    limits = dict(DEFAULT_LIMITS.get(host, {}))
+    try:
+        with open("request_info.json", 'r') as f:
+            limits.update(json.load(f).get("rate_limits", {}).get(host, {}))
+    except FileNotFoundError:
+        pass
+    return limits or None
+
+
+def acquire(url):
+    """
+    Blocks until a request to the host of the given url is allowed and records it in the daily ledger.
+
+    @param url: The url that is about to be requested
+
+    @raise QuotaExceededError: if the daily quota of the host is used up
+    """
+    host = get_host(url)
+    limits = get_limits(host)
+    if limits is None:
+        return
+
+    per_minute, per_day = limits.get("per_minute"), limits.get("per_day")
+    while True:
+        with _connect() as connection:
+            connection.execute("BEGIN IMMEDIATE;") # <- locks the ledger for every other thread and process
+            today = date.today().isoformat()
+            used = _get_used(connection, host, today)
+            if per_day is not None and used >= per_day:
+                raise QuotaExceededError(f"The daily quota of {per_day} requests to {host} has been used up")
+
+            wait = 0
+            if per_minute:
+                now = time.time()
+                row = connection.execute("SELECT tokens, updated FROM buckets WHERE host = ?;", (host,)).fetchone()
+                tokens, updated = row if row else (per_minute, now)
+                tokens = min(per_minute, tokens + (now - updated) * per_minute / 60)
+                if tokens < 1:
+                    wait = (1 - tokens) * 60 / per_minute
+                else:
+                    tokens -= 1
+                connection.execute("INSERT OR REPLACE INTO buckets (host, tokens, updated) VALUES (?, ?, ?);", (host, tokens, now))
+
+            if not wait:
+                connection.execute("INSERT OR REPLACE INTO ledger (host, day, used) VALUES (?, ?, ?);", (host, today, used + 1))
+                return
+        time.sleep(wait)
+
+
+def remaining_quota(url):
+    """
+    @param url: A url (or host) of the API
+
+    @return: the number of requests left today for the host, or None if the host has no daily quota
+    """
+    host = get_host(url)
+    limits = get_limits(host)
+    if limits is None or limits.get("per_day") is None:
+        return None
+    with _connect() as connection:
+        return max(0, limits["per_day"] - _get_used(connection, host, date.today().isoformat()))
+
+
+def check_quota(url, n_requests):
+    """
+    Raises before a load starts if it is going to need more requests than are left today,
+    so it stops up front instead of failing partway through.
+
+    @param url: A url (or host) of the API
+    @param n_requests: The number of requests the load is going to make
+
+    @raise QuotaExceededError: if there are not enough requests left
+    """
+    remaining = remaining_quota(url)
+    if remaining is not None and remaining < n_requests:
+        raise QuotaExceededError(f"{n_requests} requests are needed but only {remaining} are left today for {url}")
+
+
+def _connect():
+    connection = sqlite3.connect(LEDGER_FILE, timeout=60, isolation_level=None)
+    connection.execute("CREATE TABLE IF NOT EXISTS buckets (host TEXT PRIMARY KEY, tokens REAL, updated REAL);")
+    connection.execute("CREATE TABLE IF NOT EXISTS ledger (host TEXT, day TEXT, used INTEGER, PRIMARY KEY (host, day));")
+    return _Transaction(connection)
+
+
+def _get_used(connection, host, day):
+    row = connection.execute("SELECT used FROM ledger WHERE host = ? AND day = ?;", (host, day)).fetchone()
+    return row[0] if row else 0
+
+
+class _Transaction:
+    """
+    Context manager that commits (or rolls back) the open transaction and closes the connection on exit.
+    sqlite3's own context manager does not close the connection.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self.connection
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if self.connection.in_transaction:
+                self.connection.execute("ROLLBACK;" if exc_type else "COMMIT;")
+        finally:
+            self.connection.close()
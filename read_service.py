@@ -0,0 +1,348 @@
+"""
+A small read-only HTTP service over the loaded tables.
+
+    GET /tables/<table>?<column>=<value>&min_<column>=<value>&max_<column>=<value>&format=json|csv|arrow
+
+For example, the last 3 years of one state's county unemployment rates:
+    GET /tables/county_unemployment_rate?state=01&min_year=2020&format=csv
+
+Only tables recorded in dbo.table_load_versions (i.e. loaded by db_updater.py) are served.
+Responses carry an ETag derived from the table's load version and the query, so clients can revalidate with
+If-None-Match and get a 304 until the next refresh of the table lands. Results up to CACHE_MAX_RESULT_BYTES are
+kept in an in-memory LRU cache; larger results are streamed from the database in batches and not cached.
+
+Arrow output requires pyarrow, which is optional.
+
+Usage: py read_service.py [--host 127.0.0.1] [--port 8080]
+
+Author: Nikolas Kovacs
+"""
+import argparse
+import csv
+import datetime
+import decimal
+import hashlib
+import io
+import json
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import pyodbc
+from api_db_mediator import get_connection_string
+
+BATCH_SIZE = 5000
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+CACHE_MAX_RESULT_BYTES = 16 * 1024 * 1024
+
+
+class ResultCache:
+    """
+    Thread safe LRU cache of encoded results, bounded by their total size
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.__entries = OrderedDict()
+        self.__size = 0
+        self.__lock = threading.Lock()
+
+
+    def get(self, key):
+        with self.__lock:
+            if key not in self.__entries:
+                return None
+            self.__entries.move_to_end(key)
+            return self.__entries[key]
+
+
+    def put(self, key, value):
+        """
+        @param key: the cache key (the ETag)
+        @param value: tuple of (content type, body bytes)
+        """
+        with self.__lock:
+            if key in self.__entries:
+                return
+            self.__entries[key] = value
+            self.__size += len(value[1])
+            while self.__size > self.max_bytes:
+                _, (_, body) = self.__entries.popitem(last=False)
+                self.__size -= len(body)
+
+
+class JSONEncoder:
+    content_type = "application/json"
+
+    def start(self, description):
+        self.columns = [x[0] for x in description]
+        self.first = True
+        return b"["
+
+    def batch(self, rows):
+        out = []
+        for row in rows:
+            out.append(("" if self.first else ",") + json.dumps(dict(zip(self.columns, row)), default=str))
+            self.first = False
+        return "".join(out).encode()
+
+    def end(self):
+        return b"]"
+
+
+class CSVEncoder:
+    content_type = "text/csv"
+
+    def start(self, description):
+        return self.__write([[x[0] for x in description]])
+
+    def batch(self, rows):
+        return self.__write(rows)
+
+    def end(self):
+        return b""
+
+    def __write(self, rows):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        return buffer.getvalue().encode()
+
+
+class ArrowEncoder:
+    content_type = "application/vnd.apache.arrow.stream"
+
+    def __init__(self):
+        import pyarrow # <- optional dependency
+        self.pa = pyarrow
+        self.writer = None
+
+    def start(self, description):
+        """
+        The schema is built once from the column types of the result, so every batch has the same schema
+        (inferring it per batch gives an all-NULL column the null type, or an int column that turns float)
+        """
+        pa = self.pa
+        types = {
+            bool: pa.bool_(), int: pa.int64(), float: pa.float64(), str: pa.string(),
+            datetime.datetime: pa.timestamp("us"), datetime.date: pa.date32(), datetime.time: pa.time64("us"),
+            bytes: pa.binary(), bytearray: pa.binary(),
+        }
+        fields = []
+        for name, type_code, _, _, precision, scale, _ in description:
+            if type_code is decimal.Decimal:
+                fields.append((name, pa.decimal128(precision or 38, scale or 0)))
+            else:
+                fields.append((name, types.get(type_code, pa.string())))
+        self.columns = [x[0] for x in description]
+        self.schema = pa.schema(fields)
+        self.sink = io.BytesIO()
+        self.writer = pa.ipc.new_stream(self.sink, self.schema)
+        return self.__drain()
+
+    def batch(self, rows):
+        columns = {c: [row[i] for row in rows] for i, c in enumerate(self.columns)}
+        self.writer.write_batch(self.pa.RecordBatch.from_pydict(columns, schema=self.schema))
+        return self.__drain()
+
+    def end(self):
+        self.writer.close()
+        return self.__drain()
+
+    def __drain(self):
+        data = self.sink.getvalue()
+        self.sink.seek(0)
+        self.sink.truncate()
+        return data
+
+
+ENCODERS = {"json": JSONEncoder, "csv": CSVEncoder, "arrow": ArrowEncoder}
+
+def parse_bit(value):
+    """
+    @return: the bool of a filter value on a bit column (0, 1, false or true)
+    """
+    values = {"0": False, "1": True, "false": False, "true": True}
+    if value.lower() not in values:
+        raise ValueError(f"{value} is not 0, 1, false or true")
+    return values[value.lower()]
+
+
+def parse_int(low, high):
+    """
+    @return: function parsing a filter value on an integer column whose values range from low to high
+    """
+    def parse(value):
+        value = int(value)
+        if not low <= value <= high:
+            raise ValueError(f"{value} is out of range")
+        return value
+    return parse
+
+
+# sql type (INFORMATION_SCHEMA.COLUMNS.DATA_TYPE) -> function converting a filter value to it, raising ValueError
+# (or decimal.InvalidOperation) if it does not fit. The types not listed are compared as strings
+FILTER_TYPES = {
+    "bit": parse_bit,
+    "tinyint": parse_int(0, 255), "smallint": parse_int(-2**15, 2**15 - 1),
+    "int": parse_int(-2**31, 2**31 - 1), "bigint": parse_int(-2**63, 2**63 - 1),
+    "decimal": decimal.Decimal, "numeric": decimal.Decimal, "money": decimal.Decimal, "smallmoney": decimal.Decimal,
+    "float": float, "real": float,
+    "date": datetime.date.fromisoformat,
+    "datetime": datetime.datetime.fromisoformat, "datetime2": datetime.datetime.fromisoformat,
+    "smalldatetime": datetime.datetime.fromisoformat,
+}
+
+
+class ReadService(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, connection_string):
+        super().__init__(address, RequestHandler)
+        self.connection_string = connection_string
+        self.cache = ResultCache(CACHE_MAX_BYTES)
+        self.__local = threading.local()
+
+
+    def get_cursor(self):
+        """
+        @return: a cursor on this thread's connection (pyodbc connections are not shared between threads)
+        """
+        if getattr(self.__local, "connection", None) is None:
+            self.__local.connection = pyodbc.connect(self.connection_string, autocommit=True)
+        return self.__local.connection.cursor()
+
+
+    def get_load_version(self, table):
+        """
+        @return: the load version of the table, or None if the table is not served
+        """
+        row = self.get_cursor().execute("SELECT loaded_at FROM dbo.table_load_versions WHERE table_name = ?;", table).fetchone()
+        return str(row[0]) if row else None
+
+
+    def get_columns(self, table):
+        """
+        @return: dict of column name -> sql type (e.g. "smallint"), in column order
+        """
+        rows = self.get_cursor().execute("""
+            SELECT COLUMN_NAME, DATA_TYPE FROM INFORMATION_SCHEMA.COLUMNS
+            WHERE TABLE_SCHEMA = 'dbo' AND TABLE_NAME = ? ORDER BY ORDINAL_POSITION;
+        """, table).fetchall()
+        return {row[0]: row[1] for row in rows}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] != "tables":
+            return self.send_error(404, "Use /tables/<table>")
+        table = parts[1]
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        format_ = params.pop("format", "json")
+        if format_ not in ENCODERS:
+            return self.send_error(400, f"format must be one of {', '.join(ENCODERS)}")
+
+        version = self.server.get_load_version(table)
+        if version is None:
+            return self.send_error(404, f"{table} is not a loaded table")
+
+        query_key = json.dumps([table, version, format_, sorted(params.items())])
+        etag = '"' + hashlib.sha1(query_key.encode()).hexdigest() + '"'
+        if etag in [x.strip() for x in self.headers.get("If-None-Match", "").split(',')]:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            return self.end_headers()
+
+        cached = self.server.cache.get(etag)
+        if cached:
+            content_type, body = cached
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return self.wfile.write(body)
+
+        columns = self.server.get_columns(table)
+        where, args = [], []
+        for key, value in params.items():
+            column, operator = key, "="
+            if key.startswith("min_"):
+                column, operator = key[4:], ">="
+            elif key.startswith("max_"):
+                column, operator = key[4:], "<="
+            if column not in columns: # <- only known column names ever reach the sql
+                return self.send_error(400, f"Unknown column: {column}")
+            # converted before the response starts, so a value that does not fit the column is a 400
+            # rather than a conversion error in the middle of the streamed response
+            try:
+                value = FILTER_TYPES.get(columns[column].lower(), str)(value)
+            except (ValueError, ArithmeticError):
+                return self.send_error(400, f"Invalid value for {key}: {value} is not a valid {columns[column]}")
+            where.append(f"[{column}] {operator} ?")
+            args.append(value)
+        query = f"SELECT * FROM dbo.[{table}]" + (" WHERE " + " AND ".join(where) if where else "") + ";"
+
+        try:
+            encoder = ENCODERS[format_]()
+        except ImportError:
+            return self.send_error(406, "pyarrow is not installed")
+        self.__stream(query, args, encoder, etag)
+
+
+    def __stream(self, query, args, encoder, etag):
+        """
+        Sends the result with chunked transfer encoding as it is fetched, keeping a copy for the cache until it
+        grows past CACHE_MAX_RESULT_BYTES
+        """
+        cursor = self.server.get_cursor()
+        try:
+            cursor.execute(query, *args)
+        except pyodbc.DataError as e:
+            return self.send_error(400, f"Invalid filter value: {e}")
+
+        self.send_response(200)
+        self.send_header("Content-Type", encoder.content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("ETag", etag)
+        self.end_headers()
+
+        kept = []
+        kept_size = 0
+        def send(data):
+            nonlocal kept, kept_size
+            if not data:
+                return
+            self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+            if kept is not None:
+                kept.append(data)
+                kept_size += len(data)
+                if kept_size > CACHE_MAX_RESULT_BYTES:
+                    kept = None
+
+        send(encoder.start(cursor.description))
+        while True:
+            rows = cursor.fetchmany(BATCH_SIZE)
+            if not rows:
+                break
+            send(encoder.batch([tuple(row) for row in rows]))
+        send(encoder.end())
+        self.wfile.write(b"0\r\n\r\n")
+
+        if kept is not None:
+            self.server.cache.put(etag, (encoder.content_type, b"".join(kept)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Read-only HTTP service over the Demographic Database tables")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on (default: 8080)")
+    args = parser.parse_args()
+
+    server = ReadService((args.host, args.port), get_connection_string())
+    print(f"Serving on http://{args.host}:{args.port}/tables/<table>")
+    server.serve_forever()
@@ -0,0 +1,96 @@
+"""
+This file contains the definitions of the rollup tables that API_DB_Mediator.refresh_rollups materializes
+after the source tables are loaded, so dashboards read precomputed aggregates instead of scanning the sources.
+
+Each rollup is rebuilt only when the load version (see dbo.table_load_versions) of one of its sources changed.
+
+All SQL is written for MSSQL
+
+Author: Nikolas Kovacs
+"""
+
+# census variables holding the total population, in order of preference (ACS profile, ACS detailed tables)
+POPULATION_VARIABLES = ["DP05_0001E", "B01003_001E", "B01001_001E"]
+
+
+def get_population_variable(census_variables):
+    """
+    @param census_variables: the census variables of request_info.json's census_data_tables (columns of dbo.census_county_data)
+
+    @return: the first of POPULATION_VARIABLES that is configured, or None
+    """
+    configured = {x.upper() for x in census_variables}
+    return next((x for x in POPULATION_VARIABLES if x in configured), None)
+
+
+def get_rollups(tables_linecodes, census_variables):
+    """
+    @param tables_linecodes: the gdp table_linecodes (columns of dbo.county_gdp)
+    @param census_variables: the census variables of request_info.json's census_data_tables. county_gdp_per_capita
+                             is only defined if one of them holds the total population (see get_population_variable)
+
+    @return: dict of rollup table name -> {"sources": [source tables], "columns": {source table: [the configurable
+             columns the query reads]}, "select": query, "key": primary key columns}
+    """
+    yoy_columns = ",\n".join(
+        [f"CAST(cur.{x} - prev.{x} AS FLOAT) / NULLIF(prev.{x}, 0) AS {x}_yoy" for x in tables_linecodes]
+    )
+
+    rollups = {
+        "county_unemployment_rate_annual": {
+            "sources": ["county_unemployment_rate"],
+            # M13 is the annual average that BLS reports for some series, the other periods are months
+            "select": """
+                SELECT state, county, year, AVG(value) AS avg_value, COUNT(value) AS months
+                FROM dbo.county_unemployment_rate
+                WHERE period LIKE 'M%' AND period != 'M13'
+                GROUP BY state, county, year
+            """,
+            "key": "state, county, year",
+        },
+        "county_gdp_yoy": {
+            "sources": ["county_gdp"],
+            "columns": {"county_gdp": list(tables_linecodes)},
+            "select": f"""
+                SELECT cur.state, cur.county, cur.year,
+                {yoy_columns}
+                FROM dbo.county_gdp cur
+                JOIN dbo.county_gdp prev ON prev.state = cur.state AND prev.county = cur.county AND prev.year = cur.year - 1
+            """,
+            "key": "state, county, year",
+        },
+        "state_employment_from_counties": {
+            "sources": ["county_employment"],
+            # suppressed county cells (disclosure_code 'N') are reported as 0, so these are lower bounds
+            "select": """
+                SELECT state, year, qtr, own_code, industry_code, ISNULL(size_code, 0) AS size_code,
+                    SUM(qtrly_estabs) AS qtrly_estabs,
+                    SUM(month1_emplvl) AS month1_emplvl,
+                    SUM(month2_emplvl) AS month2_emplvl,
+                    SUM(month3_emplvl) AS month3_emplvl,
+                    SUM(total_qtrly_wages) AS total_qtrly_wages,
+                    SUM(CASE WHEN disclosure_code = 'N' THEN 1 ELSE 0 END) AS suppressed_counties
+                FROM dbo.county_employment
+                GROUP BY state, year, qtr, own_code, industry_code, ISNULL(size_code, 0)
+            """,
+            "key": "state, year, qtr, own_code, industry_code, size_code",
+        },
+    }
+
+    population = get_population_variable(census_variables)
+    if population:
+        per_capita_columns = ",\n".join(
+            [f"CAST(g.{x} AS FLOAT) / NULLIF(c.{population}, 0) AS {x}_per_capita" for x in tables_linecodes]
+        )
+        rollups["county_gdp_per_capita"] = {
+            "sources": ["county_gdp", "census_county_data"],
+            "columns": {"county_gdp": list(tables_linecodes), "census_county_data": [population]},
+            "select": f"""
+                SELECT g.state, g.county, g.year, c.{population} AS population,
+                {per_capita_columns}
+                FROM dbo.county_gdp g
+                JOIN dbo.census_county_data c ON c.state = g.state AND c.county = g.county AND c.year = g.year
+            """,
+            "key": "state, county, year",
+        }
+    return rollups
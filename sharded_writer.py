@@ -0,0 +1,102 @@
+"""
+This class writes the rows of a single table load through a pool of database connections.
+
+Rows are sharded by their state FIPS, and each shard is inserted by its own connection (and therefore its own
+session and transaction), so the database server can ingest the shards in parallel.
+The shards are committed or rolled back together, see commit() and rollback().
+
+Author: Nikolas Kovacs
+"""
+
+import pyodbc
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ShardedWriter:
+    def __init__(self, connection_string, n_shards):
+        """
+        @param connection_string: the pyodbc connection string of the database
+        @param n_shards: the number of connections (and shards)
+        """
+        self.n_shards = n_shards
+        self.__connections = []
+        self.__cursors = []
+        for _ in range(n_shards):
+            connection = pyodbc.connect(connection_string)
+            connection.autocommit = False
+            cursor = connection.cursor()
+            cursor.fast_executemany = True
+            self.__connections.append(connection)
+            self.__cursors.append(cursor)
+        self.__executor = ThreadPoolExecutor(max_workers=n_shards, thread_name_prefix="sharded_writer")
+        self.__skip_shards = set()
+
+
+    def shard_of(self, state):
+        """
+        @param state: the state FIPS code of a row
+
+        @return: the index of the shard the row belongs to
+        """
+        return int(state) % self.n_shards
+
+
+    def begin(self, skip_shards=()):
+        """
+        Starts a unit of work.
+
+        @param skip_shards: the shards whose rows of this unit were already committed by a previous run
+        """
+        self.__skip_shards = set(skip_shards)
+
+
+    def insert(self, query, rows, state_index):
+        """
+        Splits the rows into shards by state and runs the query for every shard concurrently.
+
+        @param query: the parameterized insert statement
+        @param rows: list of the rows to insert
+        @param state_index: the index of the state FIPS in each row
+        """
+        shards = [[] for _ in range(self.n_shards)]
+        for row in rows:
+            shards[self.shard_of(row[state_index])].append(row)
+
+        futures = [
+            self.__executor.submit(self.__cursors[i].executemany, query, shard)
+            for i, shard in enumerate(shards) if shard and i not in self.__skip_shards
+        ]
+        for future in futures:
+            future.result() # <- re-raises the error of a failed shard
+
+
+    def commit(self, checkpoint_query=None, checkpoint_rows=lambda shard: []):
+        """
+        Commits every shard. If a checkpoint query is given, each shard records its own checkpoint rows in the
+        same transaction as its data, so a shard that committed is never written twice.
+
+        @param checkpoint_query: the parameterized insert statement for the checkpoint rows
+        @param checkpoint_rows: function that takes a shard index and returns its checkpoint rows
+        """
+        for i in range(self.n_shards):
+            if i in self.__skip_shards:
+                continue
+            if checkpoint_query:
+                self.__cursors[i].executemany(checkpoint_query, checkpoint_rows(i))
+        # nothing is committed until every shard has written successfully
+        for i in range(self.n_shards):
+            if i not in self.__skip_shards:
+                self.__connections[i].commit()
+        self.__skip_shards = set()
+
+
+    def rollback(self):
+        for connection in self.__connections:
+            connection.rollback()
+        self.__skip_shards = set()
+
+
+    def close(self):
+        self.__executor.shutdown()
+        for connection in self.__connections:
+            connection.close()
@@ -0,0 +1,50 @@
+"""
+Measures how long db_updater takes to start: answering --help, and opening the gui window.
+
+Use on the script (py startup_benchmark.py) or on the PyInstaller build (py startup_benchmark.py --exe dist/db_updater.exe)
+Neither measurement connects to the database or imports the API modules.
+
+Author: Nikolas Kovacs
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+def time_command(command, runs, env=None):
+    """
+    @param command: the command to run (list)
+    @param runs: the number of times to run it
+    @param env: optional environment variables
+
+    @return: list of the wall times (seconds) of the runs
+    """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def report(name, times):
+    print(f"{name}: min {min(times):.3f}s, median {statistics.median(times):.3f}s, max {max(times):.3f}s ({len(times)} runs)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Startup time benchmark for db_updater")
+    parser.add_argument("--exe", type=str, help="Path to the frozen executable (default: run db_updater.py with this python)")
+    parser.add_argument("--runs", type=int, default=5, help="Number of runs per measurement (default: 5)")
+    parser.add_argument("--no-gui", action="store_true", help="Skip the gui measurement (e.g. when there is no display)")
+    args = parser.parse_args()
+
+    command = [args.exe] if args.exe else [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "db_updater.py")]
+
+    report("--help", time_command(command + ["--help"], args.runs))
+    if not args.no_gui:
+        # db_updater quits as soon as the event loop starts, i.e. once the window has been shown
+        env = dict(os.environ, DB_UPDATER_STARTUP_BENCHMARK="1")
+        report("gui window", time_command(command, args.runs, env=env))
@@ -0,0 +1,36 @@
+"""
+This file contains the incremental JSON decoding used for the large Census responses.
+
+With ijson installed (optional; it uses its C yajl2 backend when available), the items of a response are decoded
+as the response streams in, so the first rows reach the database before the download finishes and the whole
+nested structure is never held in memory. Without ijson, the response is decoded at once with response.json().
+
+Author: Nikolas Kovacs
+"""
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+def iter_json_items(response, path):
+    """
+    This generator yields the items of an array inside a JSON response.
+
+    @param response: a requests response, opened with stream=True
+    @param path: dot separated path to the array, followed by ".item" (ijson prefix notation),
+                 e.g. "item" for a top level array or "BEAAPI.Results.Data.item"
+
+    @return: A generator of the items of the array. Yields nothing if the path does not exist.
+    """
+    if ijson is None:
+        data = response.json()
+        for key in path.split('.')[:-1]:
+            if not isinstance(data, dict) or key not in data:
+                return
+            data = data[key]
+        yield from data
+        return
+
+    response.raw.decode_content = True # <- let urllib3 undo gzip/deflate
+    yield from ijson.items(response.raw, path, use_float=True)
@@ -0,0 +1,172 @@
+"""
+This file contains the durable work queue behind `db_updater.py --queue`, which spreads the units of a table load
+(QCEW area files, BLS series batches) over any number of worker processes, on one host or several.
+
+The queue is the table dbo.work_queue in the (first) target database, so every worker that can reach the database
+can take part. The coordinator creates the table being loaded and enqueues its units, the workers claim a few
+units at a time with a lease, load them and mark them done. A worker renews the leases of the units it is still
+loading, so only the units of a worker that crashed or hung run out of lease; they are claimed again by another
+worker, up to MAX_ATTEMPTS times. A unit that fails (its download, parsing or insert raised) is released right away
+and claimed again the same way, while the worker carries on with its other units.
+
+A unit is done once it is marked done or its checkpoint is in dbo.load_checkpoints. The checkpoint is committed with
+the unit's rows, so a worker crashing between the two never gets the unit loaded twice, and a worker that lost its
+lease finds the checkpoint of the worker that took the unit over instead of loading it again.
+
+Author: Nikolas Kovacs
+"""
+import os
+import socket
+import threading
+import pyodbc
+
+LEASE_SECONDS = 300
+MAX_ATTEMPTS = 3
+POLL_INTERVAL = 5 # seconds, how often an idle worker checks for reclaimable units
+
+
+class WorkQueueError(Exception):
+    """
+    Raised by the coordinator when some units could not be loaded in MAX_ATTEMPTS attempts
+    """
+    pass
+
+
+class WorkQueue:
+    def __init__(self, connection_string, table):
+        """
+        @param connection_string: the pyodbc connection string of the database holding the queue
+        @param table: the name of the table being loaded
+        """
+        self.table = table
+        self.host = socket.gethostname()
+        self.worker = f"{self.host}:{os.getpid()}"
+        self.__connection = pyodbc.connect(connection_string, autocommit=True)
+        self.__cursor = self.__connection.cursor()
+        self.__cursor.fast_executemany = True
+        self.__lock = threading.Lock() # <- units are claimed by the downloader threads, renewed by a heartbeat and marked done by the writer
+        self.__cursor.execute("""
+            IF OBJECT_ID('dbo.work_queue', 'U') IS NULL
+                CREATE TABLE dbo.work_queue (
+                    table_name varchar(50) NOT NULL,
+                    unit varchar(100) NOT NULL,
+                    worker varchar(100),
+                    lease_until datetime2,
+                    attempts int NOT NULL DEFAULT 0,
+                    done bit NOT NULL DEFAULT 0,
+                    coordinator varchar(100), -- <- the host of the coordinator that enqueued the unit
+                    PRIMARY KEY (table_name, unit)
+                );
+        """)
+
+
+    def enqueue(self, units):
+        """
+        Replaces the units of any previous load of the table with the given ones.
+
+        @param units: list of the unit names
+        """
+        with self.__lock:
+            self.__cursor.execute("DELETE FROM dbo.work_queue WHERE table_name = ?;", self.table)
+            if units:
+                self.__cursor.executemany("INSERT INTO dbo.work_queue (table_name, unit, coordinator) VALUES (?, ?, ?);",
+                    [(self.table, unit, self.host) for unit in units])
+
+
+    def get_coordinator(self):
+        """
+        @return: the host of the coordinator that enqueued the units of the table, or None if none are enqueued
+        """
+        with self.__lock:
+            row = self.__cursor.execute("SELECT TOP 1 coordinator FROM dbo.work_queue WHERE table_name = ?;", self.table).fetchone()
+        return row[0] if row else None
+
+
+    def claim(self, n):
+        """
+        Leases up to n units that are not done and not leased (or whose lease ran out) to this worker.
+        READPAST skips the rows other workers are claiming at the same time, so no unit is claimed twice.
+
+        @return: list of the claimed unit names
+        """
+        with self.__lock:
+            rows = self.__cursor.execute(f"""
+                UPDATE TOP ({int(n)}) q
+                SET worker = ?, lease_until = DATEADD(second, {LEASE_SECONDS}, SYSUTCDATETIME()), attempts = attempts + 1
+                OUTPUT inserted.unit
+                FROM dbo.work_queue q WITH (ROWLOCK, READPAST, UPDLOCK)
+                WHERE q.table_name = ? AND q.done = 0 AND q.attempts < {MAX_ATTEMPTS}
+                    AND (q.lease_until IS NULL OR q.lease_until < SYSUTCDATETIME())
+                    AND NOT EXISTS (SELECT 1 FROM dbo.load_checkpoints c WHERE c.table_name = q.table_name AND c.unit = q.unit);
+            """, self.worker, self.table).fetchall()
+        return [row[0] for row in rows]
+
+
+    def renew(self, units):
+        """
+        Extends the lease of the units by LEASE_SECONDS from now. A unit whose lease already ran out and was claimed
+        by another worker is left to that worker.
+
+        @param units: list of the unit names leased to this worker and not done yet
+        """
+        if not units:
+            return
+        with self.__lock:
+            self.__cursor.executemany(f"""
+                UPDATE dbo.work_queue SET lease_until = DATEADD(second, {LEASE_SECONDS}, SYSUTCDATETIME())
+                WHERE table_name = ? AND unit = ? AND worker = ? AND done = 0;
+            """, [(self.table, unit, self.worker) for unit in units])
+
+
+    def release(self, unit):
+        """
+        Gives up the lease of a unit that failed, so it can be claimed again until it runs out of attempts
+        """
+        with self.__lock:
+            self.__cursor.execute("""
+                UPDATE dbo.work_queue SET worker = NULL, lease_until = NULL
+                WHERE table_name = ? AND unit = ? AND worker = ? AND done = 0;
+            """, self.table, unit, self.worker)
+
+
+    def done(self, unit):
+        with self.__lock:
+            self.__cursor.execute("UPDATE dbo.work_queue SET done = 1, lease_until = NULL WHERE table_name = ? AND unit = ?;",
+                self.table, unit)
+
+
+    def counts(self) -> dict:
+        """
+        @return: dict with the number of units of the table that are "done", "pending" (claimable or leased) and
+                 "failed" (out of attempts)
+        """
+        with self.__lock:
+            row = self.__cursor.execute(f"""
+                SELECT
+                    COUNT(*),
+                    SUM(CASE WHEN d.done = 0 AND (d.attempts < {MAX_ATTEMPTS} OR d.lease_until >= SYSUTCDATETIME()) THEN 1 ELSE 0 END),
+                    SUM(CASE WHEN d.done = 0 AND d.attempts >= {MAX_ATTEMPTS} AND (d.lease_until IS NULL OR d.lease_until < SYSUTCDATETIME()) THEN 1 ELSE 0 END)
+                FROM (
+                    SELECT q.attempts, q.lease_until,
+                        CASE WHEN q.done = 1 OR EXISTS (
+                            SELECT 1 FROM dbo.load_checkpoints c WHERE c.table_name = q.table_name AND c.unit = q.unit
+                        ) THEN 1 ELSE 0 END AS done
+                    FROM dbo.work_queue q WHERE q.table_name = ?
+                ) d;
+            """, self.table).fetchone()
+        total, pending, failed = row[0], row[1] or 0, row[2] or 0
+        return {"done": total - pending - failed, "pending": pending, "failed": failed}
+
+
+    def get_failed(self) -> list:
+        with self.__lock:
+            rows = self.__cursor.execute(f"""
+                SELECT q.unit FROM dbo.work_queue q
+                WHERE q.table_name = ? AND q.done = 0 AND q.attempts >= {MAX_ATTEMPTS}
+                    AND NOT EXISTS (SELECT 1 FROM dbo.load_checkpoints c WHERE c.table_name = q.table_name AND c.unit = q.unit);
+            """, self.table).fetchall()
+        return [row[0] for row in rows]
+
+
+    def close(self):
+        self.__connection.close()